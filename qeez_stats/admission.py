@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics admission control module
+
+Samples `save` and `calc` queue lengths and oldest job age (at most once per
+`SAMPLE_INTERVAL` seconds per process; with `SAVE_BACKEND='stream'`, `save`
+backlog of the save stream's consumer group, see `streams.stream_backlog`)
+and, when a queue crosses its thresholds, applies per-route policies (see
+`CFG['ADMISSION']`):
+
+* `save` stage: `direct` (fall back to `direct_stat_save`) or `reject`
+* `calc` stage: `shed` (skip the recalculation) or `reject`; the queue of
+  request's calc lane (see `CFG['CALC_LANES']`) is sampled
+
+`reject` means HTTP 503 with `Retry-After`. Every decision is counted as
+`admission.<route>.<stage>.<decision>` metric. Spooled requests use cached
+samples only (refreshed by the spool drainer, see `refresh_samples`), so
+they do not wait for redis.
+'''
+
+import logging
+import time
+
+from redis.exceptions import RedisError
+from rq.utils import utcnow, utcparse
+
+from qeez_stats import metrics
+from qeez_stats.config import CFG
+from qeez_stats.queues import LANE_INTERACTIVE
+from qeez_stats.streams import stream_backlog
+from qeez_stats.utils import to_str
+
+
+LOG = logging.getLogger(__name__)
+
+QUEUE_KEY_FMT = 'rq:queue:%s'
+JOB_KEY_FMT = 'rq:job:%s'
+
+ACCEPT = 'accept'
+DIRECT = 'direct'
+SHED = 'shed'
+REJECT = 'reject'
+
+
+SAMPLES = {}
+
+
+def sample_queue(name, redis_conn):
+    '''Returns (length, oldest job age in seconds) of rq queue
+    '''
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.llen(QUEUE_KEY_FMT % name)
+    pipe.lindex(QUEUE_KEY_FMT % name, 0)
+    length, job_id = pipe.execute()
+    age = 0.0
+    if job_id is not None:
+        enqueued_at = redis_conn.hget(
+            JOB_KEY_FMT % to_str(job_id), 'enqueued_at')
+        if enqueued_at:
+            age = max(
+                (utcnow() - utcparse(to_str(enqueued_at))).total_seconds(),
+                0.0)
+    return length, age
+
+
+def queue_state(name, redis_conn, now=None, cached=False):
+    '''Returns cached (length, oldest job age) of rq queue (with `cached`,
+    the last sample, if any, without sampling)
+    '''
+    if now is None:
+        now = time.time()
+    sample = SAMPLES.get(name)
+    if cached:
+        if sample is None:
+            return 0, 0.0
+        return sample[1], sample[2]
+    if sample is None or now - sample[0] >= CFG['ADMISSION']['SAMPLE_INTERVAL']:
+        try:
+            if name == 'save' and CFG['SAVE_BACKEND'] == 'stream':
+                length, age = stream_backlog(redis_conn)
+            else:
+                length, age = sample_queue(name, redis_conn)
+        except RedisError as exc:
+            LOG.error('Queue %s not sampled: %s', name, repr(exc))
+            length, age = 0, 0.0
+        sample = SAMPLES[name] = (now, length, age)
+        metrics.gauge('queue.%s.length' % name, length)
+        metrics.gauge('queue.%s.oldest_age' % name, age)
+    return sample[1], sample[2]
+
+
+def stage_queues(stage, lane=None):
+    '''Returns names of queues of a stage (`calc` one of a lane, interactive
+    by default, see `CFG['CALC_LANES']`)
+    '''
+    if stage == 'calc':
+        return (CFG['CALC_LANES'][lane or LANE_INTERACTIVE],)
+    return (stage,)
+
+
+def refresh_samples(stage, redis_conn):
+    '''Samples (if due) queues of a stage (of all calc lanes)
+    '''
+    names = set(stage_queues(stage))
+    if stage == 'calc':
+        names.update(CFG['CALC_LANES'].values())
+    for name in sorted(names):
+        queue_state(name, redis_conn)
+
+
+def is_overloaded(stage, redis_conn, lane=None, cached=False):
+    '''Tests if any queue of a stage (or of a calc lane) crossed configured
+    thresholds
+    '''
+    cfg = CFG['ADMISSION']
+    max_len = cfg['%s_MAX_LEN' % stage.upper()]
+    max_age = cfg['%s_MAX_AGE' % stage.upper()]
+    for name in stage_queues(stage, lane=lane):
+        length, age = queue_state(name, redis_conn, cached=cached)
+        if (max_len and length >= max_len) or (max_age and age >= max_age):
+            return True
+    return False
+
+
+def admit(route, stage, redis_conn, lane=None, cached=False):
+    '''Returns admission decision for a route's stage (`save` / `calc`, in
+    a calc `lane`, interactive by default), of `cached` samples only
+    '''
+    cfg = CFG['ADMISSION']
+    decision = ACCEPT
+    if cfg['ENABLED'] and is_overloaded(
+            stage, redis_conn, lane=lane, cached=cached):
+        decision = cfg['ROUTES'].get(route, {}).get(
+            stage, DIRECT if stage == 'save' else SHED)
+    metrics.incr('admission.%s.%s.%s' % (route, stage, decision))
+    return decision
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics response compression module
+
+JSON bodies of at least `COMPRESS_MIN_SIZE` bytes are compressed with the
+best encoding accepted by the client (`br` if `brotli` is installed, then
+`gzip`). Encoded bodies of versioned results are kept in a small LRU cache,
+so a popular result is encoded and compressed once per version.
+'''
+
+import gzip
+import threading
+import time
+from collections import OrderedDict
+
+from qeez_stats import metrics
+from qeez_stats.config import CFG
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+IDENTITY = 'identity'
+
+
+def _gzip(body):
+    return gzip.compress(body, compresslevel=CFG['COMPRESS_LEVEL'])
+
+
+def _brotli(body):
+    return brotli.compress(body, quality=CFG['COMPRESS_LEVEL'])
+
+
+ENCODERS = OrderedDict([('gzip', _gzip)])
+if brotli is not None:
+    ENCODERS['br'] = _brotli
+    ENCODERS.move_to_end('br', last=False)
+
+
+def negotiate(accept_encodings):
+    '''Returns best supported encoding for werkzeug's `Accept-Encoding`
+    '''
+    best = accept_encodings.best_match(list(ENCODERS))
+    return best or IDENTITY
+
+
+def encode_body(body, encoding):
+    '''Returns (body, applied encoding), compresses only large enough body
+    '''
+    if encoding == IDENTITY or len(body) < CFG['COMPRESS_MIN_SIZE']:
+        return body, IDENTITY
+    metrics.incr('compress.%s' % encoding)
+    return ENCODERS[encoding](body), encoding
+
+
+class BodyCache(object):
+    '''Thread-safe LRU cache of encoded bodies with entry max age
+    '''
+
+    def __init__(self, size, max_age):
+        self.size = size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, now=None):
+        '''Returns cached value or None
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now - entry[0] >= self.max_age:
+                self.entries.pop(key, None)
+                metrics.incr('compress.cache.miss')
+                return None
+            self.entries.move_to_end(key)
+        metrics.incr('compress.cache.hit')
+        return entry[1]
+
+    def put(self, key, value, now=None):
+        '''Stores value, evicts least recently used entries
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.entries[key] = (now, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        '''Drops all entries
+        '''
+        with self.lock:
+            self.entries.clear()
+
+
+BODY_CACHE = BodyCache(CFG['COMPRESS_CACHE_SIZE'], CFG['COMPRESS_CACHE_TTL'])
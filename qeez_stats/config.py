@@ -24,6 +24,13 @@ except ImportError:
 
 REDIS_SOCKET = os.environ.get('REDIS_SOCKET', '/tmp/redis.sock')
 
+
+def make_raven_client():
+    '''Returns new Raven client instance (or None if not configured)
+    '''
+    return Client(RAVEN_DSN) if USE_RAVEN and RAVEN_DSN else None
+
+
 CFG = dict(
     DEBUG=False,
     HOST='127.0.0.1',
@@ -41,7 +48,153 @@ CFG = dict(
         'SOCKET': REDIS_SOCKET,
         'DB': 2,
     },
+    REPLICAS={
+        'STAT_REDIS': [],
+        'QUEUE_REDIS': [],
+    },
+    REPLICA_MAX_LAG=5,
+    REPLICA_CHECK_INTERVAL=5.0,
     ENV_PREPARE_FN='qeez.utils.models.prepare_env',
     STAT_SAVE_FN='qeez.api.models.stat_data_save',
-    RAVEN_CLI=Client(RAVEN_DSN) if USE_RAVEN and RAVEN_DSN else None,
+    RAVEN_CLI=make_raven_client(),
+    STAT_INGEST_LUA=True,
+    PACKET_CACHE_SIZE=256,
+    SHM_CACHE={
+        'DIR': os.environ.get('SHM_CACHE_DIR', '/dev/shm/qeez_stats_cache'),
+        'MAX_BYTES': 256 * 1024 * 1024,
+        'SCAN_INTERVAL': 60.0,
+    },
+    QUEUE_SERIALIZER='pickle',
+    PROFILING={
+        'SAMPLE_RATE': 0.0,
+        'INTERVAL': 0.005,
+        'MAX_DEPTH': 64,
+        'TTL': 24 * 3600,
+    },
+    CALC_LANES={
+        'interactive': 'calc',
+        'bulk': 'calc_bulk',
+    },
+    CALC_LANE_WEIGHTS={
+        'calc': 4,
+        'calc_bulk': 1,
+    },
+    CALC_COALESCE_AGE=300,
+    CALC_RESULT_TTL=600,
+    CALC_MEMOIZE=True,
+    CALC_BULK_CHUNK=1000,
+    CALC_BULK_MAX=100000,
+    RESULT_COMPRESS_MIN=1024,
+    SAVE_BACKEND='rq',
+    METRICS_FLUSH_INTERVAL=5.0,
+    SAVE_STREAM_MAXLEN=100000,
+    SAVE_STREAM_CLAIM_IDLE=60000,
+    ADMISSION={
+        'ENABLED': False,
+        'SAMPLE_INTERVAL': 1.0,
+        'SAVE_MAX_LEN': 100000,
+        'SAVE_MAX_AGE': 300,
+        'CALC_MAX_LEN': 50000,
+        'CALC_MAX_AGE': 300,
+        'RETRY_AFTER': 5,
+        'ROUTES': {
+            'put': {'save': 'direct'},
+            'mput': {'save': 'direct'},
+            'ar_put': {'save': 'direct', 'calc': 'shed'},
+            'ar_mput': {'save': 'direct', 'calc': 'shed'},
+            'proc_enq': {'calc': 'reject'},
+            'proc_enq_bulk': {'calc': 'reject'},
+        },
+    },
+    SUPERVISOR={
+        'INTERVAL': 5.0,
+        'POOLS': {
+            'calc': {
+                'QUEUES': ('calc', 'calc_bulk'),
+                'REDIS': 'QUEUE_REDIS',
+                'WORKER_CLASS': 'qeez_stats.workers.WeightedSimpleWorker',
+                'MIN': 1,
+                'MAX': 8,
+                'UP_LEN': 50,
+                'UP_AGE': 10.0,
+                'UP_CHECKS': 2,
+                'DOWN_LEN': 0,
+                'DOWN_AGE': 1.0,
+                'DOWN_CHECKS': 60,
+            },
+            'save': {
+                'QUEUES': ('save',),
+                'REDIS': 'SAVE_REDIS',
+                'WORKER_CLASS': 'rq.worker.Worker',
+                'MIN': 1,
+                'MAX': 4,
+                'UP_LEN': 200,
+                'UP_AGE': 5.0,
+                'UP_CHECKS': 2,
+                'DOWN_LEN': 0,
+                'DOWN_AGE': 1.0,
+                'DOWN_CHECKS': 60,
+            },
+        },
+    },
+    WORKERS=int(os.environ.get('WORKERS', 1)),
+    REUSE_PORT=False,
+    WORKER_MAX_REQUESTS=0,
+    WORKER_MAX_IDLE=0,
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_LEVEL=6,
+    COMPRESS_CACHE_SIZE=128,
+    COMPRESS_CACHE_TTL=60,
+    DEDUP={
+        'ENABLED': False,
+        'WINDOW': 300,
+        'BLOOM': False,
+        'BLOOM_BITS': 2 ** 24,
+        'BLOOM_HASHES': 4,
+    },
+    SPOOL={
+        'ENABLED': False,
+        'DIR': os.environ.get('SPOOL_DIR', '/tmp/qeez_stats_spool'),
+        'SEGMENT_SIZE': 64 * 1024 * 1024,
+        'FSYNC': False,
+        'BATCH': 500,
+        'INTERVAL': 0.05,
+        'RETRY': 1.0,
+        'RECOVER_INTERVAL': 5.0,
+    },
+    DISTINCT={
+        'ENABLED': False,
+        'COUNTS': {
+            'grp': ('grp_id', None),
+            'loc': ('loc_id', None),
+            'rnd': ('rnd_id', None),
+            'gmr': ('gmr_id', None),
+            'tm': ('tm_id', None),
+            'gmr_rnd': ('gmr_id', 'rnd_id'),
+            'tm_loc': ('tm_id', 'loc_id'),
+        },
+        'EXPIRE': 24 * 3600,
+        'MAX_TOKENS': 100,
+    },
+    LEADERBOARDS={
+        'ENABLED': False,
+        'EXPIRE': 24 * 3600,
+        'MAX_COUNT': 1000,
+    },
+    ROLLUPS={
+        'ENABLED': False,
+        'RESOLUTIONS': {
+            'm': {'STEP': 60, 'RETENTION': 2 * 24 * 3600},
+            'h': {'STEP': 3600, 'RETENTION': 30 * 24 * 3600},
+        },
+        'MAX_BUCKETS': 1440,
+    },
+    SKETCHES={
+        'ENABLED': False,
+        'ACCURACY': 0.01,
+        'MIN_VALUE': 0.001,
+        'MAX_VALUE': 3600.0,
+        'EXPIRE': 24 * 3600,
+        'MAX_TOKENS': 100,
+    },
 )
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics ingestion deduplication module
+
+Clients retry PUTs on flaky networks. With `CFG['DEDUP']['ENABLED']`, a
+request repeating token, stat and body of a successful one within `WINDOW`
+seconds is answered with the original response, without any writes or queue
+work. Seen requests are kept either:
+
+* exactly - one key per request (with the original response), or
+* in a memory-bounded Bloom filter (`BLOOM`) - two rotating bitmaps of
+  `BLOOM_BITS` bits; the response is then rebuilt from the request. False
+  positives (suppressed fresh requests) are possible, at a rate set by
+  `BLOOM_BITS` and `BLOOM_HASHES`.
+'''
+
+import hashlib
+import json
+import struct
+import time
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import to_str
+
+
+DEDUP_ID_FMT = '_dedup:%s'
+BLOOM_ID_FMT = '_dedup_bloom:%d'
+
+
+def request_key(qeez_token, stat, data):
+    '''Returns digest identifying request by token, stat and body
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(('%s\0%s\0' % (qeez_token, stat or '')).encode('utf-8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def _bloom_positions(key):
+    cfg = CFG['DEDUP']
+    raw = hashlib.blake2b(
+        key.encode('utf-8'), digest_size=4 * cfg['BLOOM_HASHES']).digest()
+    return [
+        _hash % cfg['BLOOM_BITS']
+        for _hash in struct.unpack('>%dI' % cfg['BLOOM_HASHES'], raw)]
+
+
+def _bloom_generation(now):
+    return int(now // CFG['DEDUP']['WINDOW'])
+
+
+def seen(key, redis_conn, now=None):
+    '''Returns original response of a seen request (True if not known), None
+    if request was not seen within window
+    '''
+    if not CFG['DEDUP']['BLOOM']:
+        resp = redis_conn.get(DEDUP_ID_FMT % key)
+        return None if resp is None else json.loads(to_str(resp))
+
+    if now is None:
+        now = time.time()
+    generation = _bloom_generation(now)
+    positions = _bloom_positions(key)
+    pipe = redis_conn.pipeline(transaction=False)
+    for gen in (generation, generation - 1):
+        for pos in positions:
+            pipe.getbit(BLOOM_ID_FMT % gen, pos)
+    bits = pipe.execute()
+    hashes = len(positions)
+    if all(bits[:hashes]) or all(bits[hashes:]):
+        return True
+    return None
+
+
+def remember(key, resp, redis_conn, now=None):
+    '''Marks request as seen (with its response)
+    '''
+    window = CFG['DEDUP']['WINDOW']
+    if not CFG['DEDUP']['BLOOM']:
+        redis_conn.set(
+            DEDUP_ID_FMT % key, json.dumps(resp, separators=(',', ':')),
+            ex=window)
+        return
+
+    if now is None:
+        now = time.time()
+    bloom_id = BLOOM_ID_FMT % _bloom_generation(now)
+    pipe = redis_conn.pipeline(transaction=False)
+    for pos in _bloom_positions(key):
+        pipe.setbit(bloom_id, pos, 1)
+    pipe.expire(bloom_id, 2 * window)
+    pipe.execute()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics distinct counts module
+
+With `CFG['DISTINCT']['ENABLED']`, ingest adds packet key parts to
+HyperLogLogs configured in `COUNTS`: `name: (counted field, group field)`,
+e.g. `tm_loc: ('tm_id', 'loc_id')` counts distinct teams per location of a
+token (`_hll:<token>:tm_loc:<loc_id>`), a group field of None counts per
+token (`_hll:<token>:<name>`). Every HyperLogLog takes at most 12 KB (~0.81%
+standard error), counts are O(1) and PFCOUNT of many keys merges them, so
+competition-wide counts need no packet decoding.
+'''
+
+import logging
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import KEY_FIELDS, PACKET_SEP, get_redis, to_str
+
+
+LOG = logging.getLogger(__name__)
+
+HLL_ID_FMT = '_hll:%s:%s'
+HLL_GROUP_ID_FMT = '_hll:%s:%s:%s'
+
+
+def hll_id(qeez_token, name, group=None):
+    '''Returns HyperLogLog's key
+    '''
+    if group is None:
+        return HLL_ID_FMT % (qeez_token, name)
+    return HLL_GROUP_ID_FMT % (qeez_token, name, group)
+
+
+def _members(qeez_token, res_dc):
+    '''Returns {HyperLogLog key: set of members}
+    '''
+    counts = [
+        (name, KEY_FIELDS.index(field),
+         None if group is None else KEY_FIELDS.index(group))
+        for name, (field, group) in CFG['DISTINCT']['COUNTS'].items()]
+    out = {}
+    for key in res_dc:
+        parts = to_str(key).split(PACKET_SEP)
+        if len(parts) != len(KEY_FIELDS):
+            LOG.warning('Bad key: %s', repr(key))
+            continue
+        for name, idx, group_idx in counts:
+            out.setdefault(hll_id(
+                qeez_token, name,
+                None if group_idx is None else parts[group_idx]),
+                set()).add(parts[idx])
+    return out
+
+
+def update(qeez_token, res_dc, redis_conn=None):
+    '''Adds packets' key parts to token's HyperLogLogs (one round trip)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    members = _members(qeez_token, res_dc)
+    if not members:
+        return
+    expire = CFG['DISTINCT']['EXPIRE']
+    pipe = redis_conn.pipeline(transaction=False)
+    for key, values in members.items():
+        pipe.pfadd(key, *sorted(values))
+        pipe.expire(key, expire)
+    pipe.execute()
+
+
+def count(qeez_tokens, name, group=None, redis_conn=None):
+    '''Returns approximate distinct count of tokens' (merged) HyperLogLogs
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    return redis_conn.pfcount(*[
+        hll_id(qeez_token, name, group) for qeez_token in qeez_tokens])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics packets export module
+
+Streams a game's packets (`_packets:<token>` hash) with HSCAN, decodes them
+and writes one `.npy` file per column (memory-mappable with
+`numpy.load(path, mmap_mode='r')`), using constant memory regardless of the
+game size:
+
+* `grp_id` ... `tm_id`, `points`, `answers_len` - int64
+* `ans_time` - float64
+* `answers` - int64, all packets' answers concatenated (split them with
+  `answers_len`)
+
+NOTE: HSCAN may return a packet twice if the hash is being resized during
+the export.
+
+$ python -m qeez_stats.export --out /tmp/export --jobs 4 TOKEN [TOKEN ...]
+'''
+
+import argparse
+import logging
+import os
+import struct
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import (
+    KEY_FIELDS,
+    PACKETS_ID_FMT,
+    decode_raw_packet,
+    get_redis,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_LEN = 128
+COLUMNS = KEY_FIELDS + ('ans_time', 'points', 'answers_len', 'answers')
+FLOAT_COLUMNS = ('ans_time',)
+
+
+def npy_header(descr, count):
+    '''Returns fixed size (`NPY_HEADER_LEN`) .npy v1.0 header of 1-d array
+    '''
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        descr, count)
+    header = header.ljust(NPY_HEADER_LEN - len(NPY_MAGIC) - 3) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpyWriter(object):
+    '''Appends values to 1-d .npy file, fixes its shape up on close
+    '''
+
+    def __init__(self, path, is_float=False):
+        self.descr, self.fmt = ('<f8', 'd') if is_float else ('<i8', 'q')
+        self.count = 0
+        self.fobj = open(path, 'wb')
+        self.fobj.write(npy_header(self.descr, 0))
+
+    def extend(self, values):
+        '''Appends values
+        '''
+        if values:
+            self.fobj.write(
+                struct.pack('<%d%s' % (len(values), self.fmt), *values))
+            self.count += len(values)
+
+    def close(self):
+        '''Writes final header and closes file
+        '''
+        self.fobj.seek(0)
+        self.fobj.write(npy_header(self.descr, self.count))
+        self.fobj.close()
+
+
+def iter_packets(qeez_token, redis_conn, batch=1000):
+    '''Yields decoded packets (`Packet` instances) of a token
+    '''
+    for raw_packet in redis_conn.hscan_iter(
+            PACKETS_ID_FMT % qeez_token, count=batch):
+        packet = decode_raw_packet(raw_packet, compact=True)
+        if packet is not None:
+            yield packet
+
+
+def _flush(writers, columns):
+    for name, values in columns.items():
+        writers[name].extend(values)
+        del values[:]
+
+
+def export_token(qeez_token, out_dir, redis_conn=None, batch=1000):
+    '''Exports token's packets into `<out_dir>/<column>.npy` files, returns
+    number of exported packets
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    writers = dict(
+        (name, NpyWriter(
+            os.path.join(out_dir, name + '.npy'),
+            is_float=name in FLOAT_COLUMNS))
+        for name in COLUMNS)
+    columns = dict((name, []) for name in COLUMNS)
+    count = 0
+    try:
+        for packet in iter_packets(qeez_token, redis_conn, batch=batch):
+            for name in KEY_FIELDS + ('ans_time', 'points'):
+                columns[name].append(getattr(packet, name))
+            columns['answers_len'].append(len(packet.answers))
+            columns['answers'].extend(packet.answers)
+            count += 1
+            if count % batch == 0:
+                _flush(writers, columns)
+        _flush(writers, columns)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return count
+
+
+def export_npz(qeez_token, redis_conn=None, batch=1000):
+    '''Exports token's packets into temporary .npz archive, returns its file
+    object (rewound), None if there are no packets
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not export_token(
+                qeez_token, tmp_dir, redis_conn=redis_conn, batch=batch):
+            return None
+        fobj = tempfile.TemporaryFile()
+        with zipfile.ZipFile(fobj, 'w', zipfile.ZIP_STORED) as zfile:
+            for name in COLUMNS:
+                zfile.write(os.path.join(tmp_dir, name + '.npy'), name + '.npy')
+    fobj.seek(0)
+    return fobj
+
+
+def _export_one(args):
+    qeez_token, out_dir, batch = args
+    return qeez_token, export_token(
+        qeez_token, os.path.join(out_dir, qeez_token), batch=batch)
+
+
+def export_tokens(qeez_tokens, out_dir, jobs=1, batch=1000):
+    '''Exports many tokens (in `jobs` processes), returns {token: count}
+    '''
+    tasks = [(qeez_token, out_dir, batch) for qeez_token in qeez_tokens]
+    if jobs <= 1:
+        return dict(map(_export_one, tasks))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(_export_one, tasks))
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description='Qeez stats packets export')
+    parser.add_argument('tokens', nargs='+', metavar='TOKEN')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='parallel export processes')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='packets per HSCAN call / write')
+    args = parser.parse_args(argv)
+    for qeez_token, count in sorted(export_tokens(
+            args.tokens, args.out, jobs=args.jobs, batch=args.batch).items()):
+        print('%s\t%d' % (qeez_token, count))
+
+
+if __name__ == '__main__':
+    main()
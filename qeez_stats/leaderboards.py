@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics leaderboards module
+
+With `CFG['LEADERBOARDS']['ENABLED']`, ingest keeps sorted sets of points
+accumulated by gamers (`gmr`, packet key's `gmr_id`) and teams (`tm`,
+`tm_id`) per token (`_lb:<token>:<dim>`) and per round
+(`_lb:<token>:<rnd_id>:<dim>`). Points counted for every packet are kept in
+`_lbpts:<token>` hash, so a resent packet only adds its points' change.
+Updates are atomic (a Lua script, or a retried WATCH transaction without
+scripting), so concurrent ingests of a token never lose points.
+Top-K and rank queries then cost O(log N), without any calc job.
+'''
+
+import logging
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import (
+    PACKET_SEP,
+    call_script,
+    get_redis,
+    register_lua,
+    to_str,
+    watch_transaction,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+DIMS = {
+    'gmr': 6,
+    'tm': 7,
+}
+LB_ID_FMT = '_lb:%s:%s'
+LB_RND_ID_FMT = '_lb:%s:%s:%s'
+LB_PTS_ID_FMT = '_lbpts:%s'
+
+# KEYS: points hash, leaderboards
+# ARGV: expire, then per packet: field, points, boards count and (board's
+#   KEYS index, member) pairs
+UPDATE_LUA = '''
+local touched = {}
+local idx = 2
+while idx <= #ARGV do
+    local nboards = tonumber(ARGV[idx + 2])
+    local delta = tonumber(ARGV[idx + 1]) -
+        tonumber(redis.call('HGET', KEYS[1], ARGV[idx]) or 0)
+    if delta ~= 0 then
+        redis.call('HSET', KEYS[1], ARGV[idx], ARGV[idx + 1])
+        for jdx = idx + 3, idx + 1 + 2 * nboards, 2 do
+            local key = tonumber(ARGV[jdx])
+            redis.call('ZINCRBY', KEYS[key], delta, ARGV[jdx + 1])
+            touched[key] = true
+        end
+    end
+    idx = idx + 3 + 2 * nboards
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+for key = 2, #KEYS do
+    if touched[key] then
+        redis.call('EXPIRE', KEYS[key], ARGV[1])
+    end
+end
+'''
+
+register_lua('leaderboards', UPDATE_LUA)
+
+
+def board_id(qeez_token, dim, rnd=None):
+    '''Returns leaderboard's key
+    '''
+    if rnd is None:
+        return LB_ID_FMT % (qeez_token, dim)
+    return LB_RND_ID_FMT % (qeez_token, rnd, dim)
+
+
+def _packet_points(res_dc):
+    '''Returns {packet key: (key parts, points)}
+    '''
+    out = {}
+    for key, val in res_dc.items():
+        if isinstance(val, tuple):
+            val = val[0]
+        key = to_str(key)
+        try:
+            out[key] = (
+                key.split(PACKET_SEP), int(to_str(val).split(PACKET_SEP)[2]))
+        except (IndexError, ValueError):
+            LOG.warning('Bad val: %s', repr(val))
+    return out
+
+
+def update(qeez_token, res_dc, redis_conn=None):
+    '''Adds packets' points changes to token's leaderboards atomically
+    (with `UPDATE_LUA`, or a WATCH/MULTI/EXEC transaction retried until it
+    succeeds)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    points = _packet_points(res_dc)
+    if not points:
+        return
+    pts_id = LB_PTS_ID_FMT % qeez_token
+    fields = sorted(points)
+    expire = CFG['LEADERBOARDS']['EXPIRE']
+    boards = {}
+    keys = [pts_id]
+    args = [expire]
+    for field in fields:
+        key_parts, pts = points[field]
+        boards[field] = [
+            (board_id(qeez_token, dim, rnd), key_parts[idx])
+            for dim, idx in DIMS.items()
+            for rnd in (None, key_parts[3])]
+        args.extend((field, pts, len(boards[field])))
+        for lb_id, member in boards[field]:
+            if lb_id not in keys:
+                keys.append(lb_id)
+            args.extend((keys.index(lb_id) + 1, member))
+
+    def _update(pipe):
+        olds = pipe.hmget(pts_id, fields)
+        pipe.multi()
+        touched = set([pts_id])
+        for field, old in zip(fields, olds):
+            pts = points[field][1]
+            delta = pts - int(old or 0)
+            if not delta:
+                continue
+            pipe.hset(pts_id, field, pts)
+            for lb_id, member in boards[field]:
+                pipe.zincrby(lb_id, delta, member)
+                touched.add(lb_id)
+        for key in touched:
+            pipe.expire(key, expire)
+
+    call_script(
+        'leaderboards', keys, args, redis_conn,
+        lambda: watch_transaction(redis_conn, _update, pts_id))
+
+
+def top(qeez_token, dim, count=10, rnd=None, redis_conn=None):
+    '''Returns top `count` members with points
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    return [
+        {'id': to_str(member), 'points': int(score)}
+        for member, score in redis_conn.zrevrange(
+            board_id(qeez_token, dim, rnd), 0, count - 1, withscores=True)]
+
+
+def rank(qeez_token, dim, member, rnd=None, redis_conn=None):
+    '''Returns member's rank (1-based) and points, None if not ranked
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    lb_id = board_id(qeez_token, dim, rnd)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zrevrank(lb_id, member)
+    pipe.zscore(lb_id, member)
+    pos, score = pipe.execute()
+    if pos is None:
+        return None
+    return {'id': member, 'rank': pos + 1, 'points': int(score)}
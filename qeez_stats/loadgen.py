@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics load generator module
+
+Simulates concurrent games against the stats service and reports throughput
+and latency percentiles per route.
+
+* in-process, against the Flask app (and Redis from the config):
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.loadgen \
+    --games 20 --players 50 --requests 500 \
+    --mix put=4,mput=2,ar_put=3,result=1
+* against a running service:
+$ python -m qeez_stats.loadgen --url http://127.0.0.1:9100 --games 20
+'''
+
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+from random import Random
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from qeez_stats.utils import (
+    decode_raw_packets,
+    retrieve_packets,
+    to_bytes,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+ROUTES = ('put', 'mput', 'ar_put', 'ar_mput', 'proc_enq', 'result')
+DEF_MIX = 'put=4,mput=2,ar_put=3,result=1'
+DEF_STAT = 'qeez_stats.loadgen.count_packets_stat'
+PERCENTILES = (50, 95, 99)
+
+
+def count_packets_stat(qeez_token):
+    '''Stat function used by generated recalculations: counts valid packets
+    '''
+    packets = decode_raw_packets(retrieve_packets(qeez_token), compact=True)
+    return sum(1 for packet in packets if packet is not None)
+
+
+def parse_mix(mix):
+    '''Parses `route=weight,...` string, returns list of (route, weight)
+    '''
+    out = []
+    for part in mix.split(','):
+        route, _, weight = part.strip().partition('=')
+        if route not in ROUTES:
+            raise ValueError('Unknown route: %s' % repr(route))
+        weight = int(weight or 1)
+        if weight > 0:
+            out.append((route, weight))
+    if not out:
+        raise ValueError('Empty mix: %s' % repr(mix))
+    return out
+
+
+def percentile(values, pct):
+    '''Returns nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(idx, 0), len(values) - 1)]
+
+
+class Game(object):
+    '''Simulated game: token, players and packet generator
+    '''
+
+    def __init__(self, qeez_token, players, rnd):
+        self.qeez_token = qeez_token
+        self.rnd = rnd
+        self.grp_id = rnd.randint(1, 100)
+        self.loc_id = rnd.randint(1, 100)
+        self.cmp_id = rnd.randint(1, 1000)
+        self.players = [
+            (gmr_id, rnd.randint(1, max(players // 4, 1)))
+            for gmr_id in range(1, players + 1)]
+
+    def packet(self):
+        '''Returns random valid [key, val] packet
+        '''
+        rnd = self.rnd
+        gmr_id, tm_id = rnd.choice(self.players)
+        key = ':'.join(str(part) for part in (
+            self.grp_id, self.loc_id, self.cmp_id, rnd.randint(1, 10),
+            rnd.randint(1, 5), rnd.randint(1, 20), gmr_id, tm_id))
+        answers = ','.join(
+            str(rnd.randint(0, 3)) for _ in range(rnd.randint(1, 3)))
+        val = '%s:%.3f:%d' % (answers, rnd.uniform(0.5, 30), rnd.randint(0, 10))
+        return [key, val]
+
+    def request(self, route, stat, batch=10):
+        '''Returns (method, path, body) tuple for a route
+        '''
+        token = self.qeez_token
+        if route == 'put':
+            return 'PUT', '/stats/put/' + token, self.packet()
+        if route == 'mput':
+            return 'PUT', '/stats/mput/' + token, [
+                self.packet() for _ in range(batch)]
+        if route == 'ar_put':
+            return 'PUT', '/stats/ar_put/%s/%s' % (stat, token), self.packet()
+        if route == 'ar_mput':
+            return 'PUT', '/stats/ar_mput/%s/%s' % (stat, token), [
+                self.packet() for _ in range(batch)]
+        if route == 'proc_enq':
+            return 'PUT', '/stats/proc_enq/%s/%s' % (stat, token), None
+        return 'GET', '/stats/result/%s/%s' % (stat, token), None
+
+
+class AppTransport(object):
+    '''Sends requests to the in-process Flask app
+    '''
+
+    def __init__(self, app=None):
+        if app is None:
+            from qeez_stats.service import APP as app
+        self.app = app
+        self.local = threading.local()
+
+    def __call__(self, method, path, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        data = None if body is None else json.dumps(body)
+        resp = client.open(
+            path, method=method, data=data, content_type='application/json')
+        return resp.status_code
+
+
+class HTTPTransport(object):
+    '''Sends requests to a running service over HTTP
+    '''
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __call__(self, method, path, body):
+        data = None if body is None else to_bytes(json.dumps(body))
+        req = Request(
+            self.url + path, data=data,
+            headers={'Content-Type': 'application/json'})
+        req.get_method = lambda: method
+        try:
+            resp = urlopen(req)
+            resp.read()
+            return resp.getcode()
+        except HTTPError as exc:
+            return exc.code
+
+
+def _run_game(game, transport, routes, weights, requests, stat, batch, out):
+    '''Issues game's requests, collects (route, status, latency) samples
+    '''
+    rnd = game.rnd
+    samples = out[game.qeez_token] = []
+    for _ in range(requests):
+        route = rnd.choices(routes, weights=weights)[0]
+        method, path, body = game.request(route, stat, batch=batch)
+        start = time.perf_counter()
+        try:
+            status = transport(method, path, body)
+        except Exception as exc:
+            LOG.error('%s %s: %s', method, path, repr(exc))
+            status = None
+        samples.append((route, status, time.perf_counter() - start))
+
+
+def run(games=10, players=20, requests=100, mix=DEF_MIX, stat=DEF_STAT,
+        batch=10, transport=None, seed=None):
+    '''Runs load against the service, returns report dict
+    '''
+    if transport is None:
+        transport = AppTransport()
+    routes, weights = zip(*parse_mix(mix))
+    seed_rnd = Random(seed)
+    out = {}
+    threads = []
+    for nr in range(games):
+        game = Game(
+            'loadgen_%d_%08x' % (nr, seed_rnd.getrandbits(32)), players,
+            Random(seed_rnd.getrandbits(32)))
+        threads.append(threading.Thread(
+            target=_run_game, args=(
+                game, transport, routes, weights, requests, stat, batch,
+                out)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return report(
+        [sample for samples in out.values() for sample in samples], elapsed)
+
+
+def report(samples, elapsed):
+    '''Aggregates (route, status, latency) samples into report dict
+    '''
+    by_route = {}
+    for route, status, latency in samples:
+        by_route.setdefault(route, []).append((status, latency))
+
+    routes = {}
+    for route, route_samples in sorted(by_route.items()):
+        latencies = sorted(latency for _, latency in route_samples)
+        routes[route] = {
+            'requests': len(route_samples),
+            'errors': sum(
+                1 for status, _ in route_samples
+                if status is None or status >= 400),
+            'rps': len(route_samples) / elapsed if elapsed else None,
+            'latency_ms': dict(
+                ('p%d' % pct, percentile(latencies, pct) * 1000.0)
+                for pct in PERCENTILES),
+        }
+
+    return {
+        'requests': len(samples),
+        'elapsed': elapsed,
+        'rps': len(samples) / elapsed if elapsed else None,
+        'routes': routes,
+    }
+
+
+def format_report(rep):
+    '''Formats report dict as text table
+    '''
+    lines = ['%-10s %8s %7s %9s %9s %9s %9s' % (
+        'route', 'reqs', 'errs', 'rps', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for route, stats in sorted(rep['routes'].items()):
+        lat = stats['latency_ms']
+        lines.append('%-10s %8d %7d %9.1f %9.2f %9.2f %9.2f' % (
+            route, stats['requests'], stats['errors'], stats['rps'] or 0,
+            lat['p50'], lat['p95'], lat['p99']))
+    lines.append('total: %d requests in %.2fs (%.1f req/s)' % (
+        rep['requests'], rep['elapsed'], rep['rps'] or 0))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10,
+                        help='concurrent games (threads)')
+    parser.add_argument('--players', type=int, default=20,
+                        help='players per game')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per game')
+    parser.add_argument('--mix', default=DEF_MIX,
+                        help='route ratios, e.g. ' + DEF_MIX)
+    parser.add_argument('--batch', type=int, default=10,
+                        help='packets per multi-packet request')
+    parser.add_argument('--stat', default=DEF_STAT,
+                        help='stat function path for recalculations')
+    parser.add_argument('--url', default=None,
+                        help='service URL (default: in-process app)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='print report as JSON')
+    args = parser.parse_args(argv)
+
+    transport = HTTPTransport(args.url) if args.url else AppTransport()
+    rep = run(
+        games=args.games, players=args.players, requests=args.requests,
+        mix=args.mix, stat=args.stat, batch=args.batch, transport=transport,
+        seed=args.seed)
+    print(json.dumps(rep, indent=2) if args.json else format_report(rep))
+    return rep
+
+
+if __name__ == '__main__':
+    main()
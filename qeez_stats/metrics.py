@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics metrics module
+
+Counters and gauges, exposed by the service at `/stats/metrics`. Both are
+kept per process; counters' increments are also flushed (by a background
+thread, every `METRICS_FLUSH_INTERVAL` seconds, and by exiting prefork
+workers) to the shared `_metrics` redis hash, so counters reported by any
+process sum all processes (recycled ones too). Gauges stay process-local.
+'''
+
+import logging
+import os
+import threading
+from collections import Counter
+
+from redis.exceptions import RedisError
+
+
+LOG = logging.getLogger(__name__)
+
+COUNTERS_ID = '_metrics'
+
+LOCK = threading.Lock()
+FLUSH_LOCK = threading.Lock()
+COUNTERS = Counter()
+FLUSHED = Counter()
+GAUGES = {}
+FLUSHERS = {}
+
+
+def incr(name, value=1):
+    '''Increments counter
+    '''
+    with LOCK:
+        COUNTERS[name] += value
+
+
+def gauge(name, value):
+    '''Sets gauge value
+    '''
+    GAUGES[name] = value
+
+
+def snapshot():
+    '''Returns copy of all counters and gauges
+    '''
+    with LOCK:
+        return {
+            'counters': dict(COUNTERS),
+            'gauges': dict(GAUGES),
+        }
+
+
+def reset():
+    '''Clears all counters and gauges
+    '''
+    with LOCK:
+        COUNTERS.clear()
+        FLUSHED.clear()
+        GAUGES.clear()
+
+
+def flush(redis_conn):
+    '''Adds counters' increments since last flush to the shared hash,
+    returns number of flushed counters
+    '''
+    with FLUSH_LOCK:
+        with LOCK:
+            deltas = dict(
+                (name, value - FLUSHED[name])
+                for name, value in COUNTERS.items()
+                if value != FLUSHED[name])
+        if not deltas:
+            return 0
+        pipe = redis_conn.pipeline(transaction=False)
+        for name, delta in deltas.items():
+            if isinstance(delta, int):
+                pipe.hincrby(COUNTERS_ID, name, delta)
+            else:
+                pipe.hincrbyfloat(COUNTERS_ID, name, delta)
+        pipe.execute()
+        with LOCK:
+            FLUSHED.update(deltas)
+    return len(deltas)
+
+
+def shared_counters(redis_conn):
+    '''Returns counters summed over all processes (flushed ones)
+    '''
+    out = {}
+    for name, value in redis_conn.hgetall(COUNTERS_ID).items():
+        name, value = name.decode('utf-8'), value.decode('utf-8')
+        out[name] = float(value) if '.' in value else int(value)
+    return out
+
+
+def _run_flusher(redis_fn, interval, stopped):
+    while not stopped.wait(interval):
+        try:
+            flush(redis_fn())
+        except RedisError as exc:
+            LOG.warning('Metrics not flushed: %s', repr(exc))
+
+
+def start_flusher(redis_fn, interval):
+    '''Starts this process' flusher thread (if not running), flushing
+    counters to redis (of `redis_fn()`) every `interval` seconds
+    '''
+    pid = os.getpid()
+    if pid in FLUSHERS:
+        return FLUSHERS[pid]
+    with FLUSH_LOCK:
+        if pid not in FLUSHERS:
+            stopped = threading.Event()
+            thread = threading.Thread(
+                target=_run_flusher, args=(redis_fn, interval, stopped),
+                name='metrics-flusher', daemon=True)
+            thread.start()
+            FLUSHERS[pid] = stopped
+    return FLUSHERS[pid]
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics profiling module
+
+Stat function runs can be profiled: per job (`enqueue_stat_calc(...,
+profile=True)`) or by sampling `CFG['PROFILING']['SAMPLE_RATE']` of jobs in
+a worker. A sampler thread records the running thread's stacks every
+`INTERVAL` seconds; collapsed stacks (`frame;frame;... count` lines, ready
+for `flamegraph.pl` / speedscope) are stored in `_prof:<stat>:<token>` key
+for `TTL` seconds.
+
+$ python -m qeez_stats.profiling STAT TOKEN > stat.folded
+'''
+
+import argparse
+import logging
+import random
+import sys
+import threading
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import get_redis, to_str
+
+
+LOG = logging.getLogger(__name__)
+
+PROF_ID_FMT = '_prof:%s:%s'
+
+
+def sampled():
+    '''Tests if a job should be profiled (by `SAMPLE_RATE`)
+    '''
+    rate = CFG['PROFILING']['SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def _frame_name(frame):
+    return '%s.%s' % (
+        frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+class StackSampler(object):
+    '''Samples stacks of the thread it was started in
+    '''
+
+    def __init__(self, interval=None, max_depth=None):
+        self.interval = interval or CFG['PROFILING']['INTERVAL']
+        self.max_depth = max_depth or CFG['PROFILING']['MAX_DEPTH']
+        self.stacks = {}
+        self.thread_id = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        '''Records current stack of the sampled thread
+        '''
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stack = ';'.join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def run(self):
+        '''Sampler loop
+        '''
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        '''Starts sampling the calling thread
+        '''
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(
+            target=self.run, name='stack-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops sampling
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def collapsed(self):
+        '''Returns collapsed stacks text
+        '''
+        return ''.join(
+            '%s %d\n' % (stack, count)
+            for stack, count in sorted(self.stacks.items()))
+
+
+def store(stat, qeez_token, collapsed, redis_conn=None):
+    '''Stores collapsed stacks of token's stat run
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    redis_conn.set(
+        PROF_ID_FMT % (stat, qeez_token), collapsed,
+        ex=CFG['PROFILING']['TTL'])
+
+
+def fetch(stat, qeez_token, redis_conn=None):
+    '''Returns collapsed stacks of token's last profiled stat run, None if
+    missing
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    collapsed = redis_conn.get(PROF_ID_FMT % (stat, qeez_token))
+    return None if collapsed is None else to_str(collapsed)
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(
+        description='Qeez stats profile (collapsed stacks) fetch')
+    parser.add_argument('stat')
+    parser.add_argument('token')
+    args = parser.parse_args(argv)
+    collapsed = fetch(args.stat, args.token)
+    if collapsed is None:
+        sys.stderr.write('No profile: %s %s\n' % (args.stat, args.token))
+        return 1
+    sys.stdout.write(collapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,25 +9,88 @@ or
 $ rqinfo --url unix:///tmp/redis.sock?db=1
 
 * queue worker:
-$ rqworker --url unix:///tmp/redis.sock?db=1 --name my-worker-nr-x --verbose
+$ rqworker --url unix:///tmp/redis.sock?db=1 --name my-worker-nr-x --verbose \
+    calc calc_bulk
 # or
 # python manage.py rqworker --name=my-worker-nr-x queue-of-db-1
+
+* calc worker consuming priority lanes by weight (see `qeez_stats.workers`):
+$ rqworker --url unix:///tmp/redis.sock?db=1 \
+    --worker-class qeez_stats.workers.WeightedSimpleWorker calc calc_bulk
+
+* save stream worker (with `SAVE_BACKEND='stream'`, see `qeez_stats.streams`):
+$ python -m qeez_stats.streams --consumer my-worker-nr-x
+
+* calc and save workers scaled by queues' backlog (see
+  `qeez_stats.supervisor`):
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.supervisor calc save
 '''
 
+import calendar
 import logging
-from time import gmtime
+import uuid
+from time import gmtime, struct_time
 
 from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
+from rq.utils import utcnow, utcparse
 
+from qeez_stats import metrics
 from qeez_stats.config import CFG
-from qeez_stats.stats import stat_collector
-from qeez_stats.utils import get_method_by_path, get_redis, to_str
+from qeez_stats.serializers import get_job_class, loads_result
+from qeez_stats.stats import (
+    BATCH_ID_FMT,
+    CALC_EXTRA_BATCH_FMT,
+    CALC_EXTRA_ID_FMT,
+    CALC_EXTRA_TTL,
+    RES_ID_FMT,
+    RES_IDX_ID_FMT,
+    RES_VER_ID_FMT,
+    run_stat,
+    stat_collector,
+)
+from qeez_stats.utils import (
+    COLL_ID_FMT as COLL_SET_ID_FMT,
+    get_method_by_path,
+    get_redis,
+    to_str,
+)
 
 
 LOG = logging.getLogger(__name__)
 
 COLL_ID_FMT = 'stat:%s'
 STAT_ID_FMT = 'stat:%s:%s'
+BULK_ID_FMT = 'stat_bulk:%s:%s'
+JOB_KEY_FMT = 'rq:job:%s'
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANE_JOB_ID_FMTS = {
+    LANE_INTERACTIVE: STAT_ID_FMT,
+    LANE_BULK: BULK_ID_FMT,
+}
+PENDING_STATUSES = (JobStatus.QUEUED, JobStatus.DEFERRED)
+BATCH_TTL = 7200
+
+
+def get_queue(name, redis_conn):
+    '''Returns rq queue using configured payload serializer
+    '''
+    return Queue(name, connection=redis_conn, job_class=get_job_class())
+
+
+def fetch_job(job_id, redis_conn):
+    '''Fetches calc job (from any lane), returns None if missing
+    '''
+    try:
+        job = get_job_class().fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        return None
+    if job.origin in CFG['CALC_LANES'].values():
+        return job
+    return None
 
 
 def direct_stat_save(qeez_token, res_dc, atime=None, **kwargs):
@@ -50,6 +113,20 @@ def direct_stat_save(qeez_token, res_dc, atime=None, **kwargs):
     return False
 
 
+def run_stat_save(qeez_token, atime, res_dc):
+    '''Saves stat using write method in a worker (`atime` as epoch seconds)
+    '''
+    function = get_method_by_path(CFG['STAT_SAVE_FN'])
+    if not function:
+        raise ValueError('No save function: %s' % CFG['STAT_SAVE_FN'])
+    if not isinstance(atime, struct_time):
+        atime = gmtime(atime)
+    res_dc = dict(
+        (_key, tuple(_val) if isinstance(_val, list) else _val)
+        for _key, _val in res_dc.items())
+    return function(qeez_token, atime, res_dc)
+
+
 def enqueue_stat_save(qeez_token, res_dc, atime=None, redis_conn=None):
     '''Enqueues stat for save
     '''
@@ -57,41 +134,275 @@ def enqueue_stat_save(qeez_token, res_dc, atime=None, redis_conn=None):
         atime = gmtime()
     if redis_conn is None:
         redis_conn = get_redis(CFG['SAVE_REDIS'])
-    queue = Queue('save', connection=redis_conn)
-    return queue.enqueue(
-        CFG['STAT_SAVE_FN'], args=(qeez_token, atime, res_dc),
-        timeout=30, result_ttl=30, ttl=7200)
+    queue = get_queue('save', redis_conn)
+    return queue.enqueue_call(
+        run_stat_save, args=(qeez_token, calendar.timegm(atime), res_dc),
+        timeout=30, result_ttl=0, ttl=7200)
+
+
+def _pending_state(status, created_at, now=None):
+    '''Tests if job's (status, created_at) means it waits in a queue (and was
+    created recently)
+    '''
+    if status is None or created_at is None or \
+            to_str(status) not in PENDING_STATUSES:
+        return False
+    if now is None:
+        now = utcnow()
+    age = (now - utcparse(to_str(created_at))).total_seconds()
+    return age < CFG['CALC_COALESCE_AGE']
+
+
+def _is_pending(job_id, redis_conn):
+    '''Tests if job waits in a queue (and was created recently)
+    '''
+    return _pending_state(*redis_conn.hmget(
+        JOB_KEY_FMT % job_id, 'status', 'created_at'))
 
 
-def enqueue_stat_calc(stat, qeez_token, redis_conn=None):
-    '''Enqueues stat for calc
+def _coalesce(job_ids, redis_conn, force=False, profile=False, batch=None):
+    '''Adds options (and batch) of coalesced requests to pending jobs (see
+    `stats.pop_calc_extras`), returns IDs of jobs no longer pending (already
+    started, so they may miss the options)
+    '''
+    flags = dict(
+        (_name, 1) for _name, _val in (('force', force), ('profile', profile))
+        if _val)
+    if not job_ids or not (flags or batch):
+        return []
+    pipe = redis_conn.pipeline(transaction=False)
+    for job_id in job_ids:
+        if flags:
+            pipe.hset(CALC_EXTRA_ID_FMT % job_id, mapping=flags)
+        if batch is not None:
+            pipe.hincrby(
+                CALC_EXTRA_ID_FMT % job_id, CALC_EXTRA_BATCH_FMT % batch)
+        pipe.expire(CALC_EXTRA_ID_FMT % job_id, CALC_EXTRA_TTL)
+    for job_id in job_ids:
+        pipe.hmget(JOB_KEY_FMT % job_id, 'status', 'created_at')
+    states = pipe.execute()[-len(job_ids):]
+    now = utcnow()
+    return [
+        job_id for job_id, state in zip(job_ids, states)
+        if not _pending_state(*state, now=now)]
+
+
+def calc_job_id(stat, qeez_token, lane=LANE_INTERACTIVE):
+    '''Returns ID of token's stat calc job in a lane
+    '''
+    return LANE_JOB_ID_FMTS[lane] % (stat, qeez_token)
+
+
+def enqueue_stat_calc(stat, qeez_token, redis_conn=None,
+                      lane=LANE_INTERACTIVE, profile=False, force=False):
+    '''Enqueues stat for calc in a priority lane
+
+    Coalesces requests: while a token's stat job (created less than
+    `CALC_COALESCE_AGE` seconds ago) waits in the lane's queue, it is
+    returned instead of enqueueing another one, so a busy game occupies at
+    most one slot per stat and lane (an interactive request never waits for
+    a bulk job). Coalesced `force` / `profile` options are passed to the
+    pending job.
+
+    With `profile`, the stat run's stacks are sampled (see `profiling`),
+    with `force`, the stat is calculated even if the stored result is of the
+    current packets version (see `CALC_MEMOIZE`).
     '''
     if redis_conn is None:
         redis_conn = get_redis(CFG['QUEUE_REDIS'])
     stat_token = STAT_ID_FMT % (stat, qeez_token)
-    queue = Queue('calc', connection=redis_conn)
+    job_id = calc_job_id(stat, qeez_token, lane)
+    if _is_pending(job_id, redis_conn) and not _coalesce(
+            [job_id], redis_conn, force=force, profile=profile):
+        metrics.incr('calc.coalesced')
+        return get_job_class()(id=job_id, connection=redis_conn)
+
+    queue = get_queue(CFG['CALC_LANES'][lane], redis_conn)
     stat_append = queue.enqueue(
         stat_collector, stat, stat_token, timeout=30, result_ttl=7200,
         ttl=7200, job_id=COLL_ID_FMT % stat)
     _ = stat_append.id
+    metrics.incr('calc.enqueued.%s' % lane)
     return queue.enqueue(
-        stat, qeez_token, timeout=30, result_ttl=7200,
-        ttl=7200, job_id=stat_token, depends_on=stat_append)
+        run_stat, stat, qeez_token, profile=profile, force=force, timeout=30,
+        result_ttl=CFG['CALC_RESULT_TTL'], ttl=7200, job_id=job_id,
+        depends_on=stat_append)
 
 
-def pull_stat_res(stat, qeez_token, redis_conn=None):
-    '''Pulls one stat's result
+def _bulk_tokens(stat, qeez_tokens, pattern, stat_redis):
+    '''Yields tokens: given ones or collector set's ones matching glob
+    pattern
+    '''
+    if qeez_tokens is not None:
+        for qeez_token in qeez_tokens:
+            yield qeez_token
+        return
+    prefix = STAT_ID_FMT % (stat, '')
+    for stat_token in stat_redis.sscan_iter(
+            COLL_SET_ID_FMT % stat, match=prefix + pattern,
+            count=CFG['CALC_BULK_CHUNK']):
+        yield to_str(stat_token)[len(prefix):]
+
+
+def _enqueue_chunk(queue, stat, qeez_tokens, batch_id, stat_redis, force,
+                   lane):
+    '''Enqueues stat jobs of not pending tokens (in a few round trips),
+    returns their stat tokens
+
+    Pending jobs get the batch (and `force`) of coalesced tokens, jobs which
+    started meanwhile are enqueued again (without the batch, it is counted
+    by one of the runs, see `stats.run_stat`).
+    '''
+    redis_conn = queue.connection
+    stat_tokens = [
+        STAT_ID_FMT % (stat, qeez_token) for qeez_token in qeez_tokens]
+    job_ids = [
+        calc_job_id(stat, qeez_token, lane) for qeez_token in qeez_tokens]
+    pipe = redis_conn.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hmget(JOB_KEY_FMT % job_id, 'status', 'created_at')
+    now = utcnow()
+    pending = set(
+        job_id for job_id, state in zip(job_ids, pipe.execute())
+        if _pending_state(*state, now=now))
+    requeue = set(_coalesce(
+        sorted(pending), redis_conn, force=force, batch=batch_id))
+    pending.difference_update(requeue)
+    fresh = [
+        (qeez_token, stat_token, job_id)
+        for qeez_token, stat_token, job_id in zip(
+            qeez_tokens, stat_tokens, job_ids)
+        if job_id not in pending]
+    stat_redis.sadd(COLL_SET_ID_FMT % stat, *stat_tokens)
+    if not fresh:
+        return []
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for qeez_token, stat_token, job_id in fresh:
+        kwargs = {}
+        if job_id not in requeue:
+            kwargs = {'batch': batch_id, 'force': force}
+        job = queue.job_class.create(
+            run_stat, args=(stat, qeez_token), kwargs=kwargs,
+            connection=redis_conn, timeout=30,
+            result_ttl=CFG['CALC_RESULT_TTL'], ttl=7200, id=job_id,
+            origin=queue.name)
+        queue.enqueue_job(job, pipeline=pipe)
+    pipe.execute()
+    return [stat_token for _, stat_token, job_id in fresh
+            if job_id not in requeue]
+
+
+def enqueue_stat_calc_bulk(stat, qeez_tokens=None, pattern='*',
+                           redis_conn=None, stat_redis=None, lane=LANE_BULK,
+                           force=True):
+    '''Enqueues stat for calc of many tokens (given ones or collector set's
+    ones matching glob `pattern`), returns batch ID
+
+    Jobs are written with pipelines, in chunks of `CALC_BULK_CHUNK` tokens,
+    tokens are added to the collector set directly (instead of a collector
+    job per token) and pending jobs are coalesced, as by
+    `enqueue_stat_calc`. Batch progress is counted in `_batch:<id>` hash
+    (see `batch_progress`), for coalesced tokens too. Stats are `force`-d by
+    default (bulk runs usually follow a stat function fix, not packets
+    changes).
     '''
     if redis_conn is None:
         redis_conn = get_redis(CFG['QUEUE_REDIS'])
-    queue = Queue('calc', connection=redis_conn)
-    job = queue.fetch_job(STAT_ID_FMT % (stat, qeez_token))
-    res = None
-    if job is not None:
-        res = job.result
-    if res is not None:
-        job.ttl = job.result_ttl = 24 * 3600
-        job.save()
+    if stat_redis is None:
+        stat_redis = get_redis(CFG['STAT_REDIS'])
+    queue = get_queue(CFG['CALC_LANES'][lane], redis_conn)
+    batch_id = uuid.uuid4().hex
+    batch_key = BATCH_ID_FMT % batch_id
+    redis_conn.hset(batch_key, mapping={
+        'stat': stat, 'total': 0, 'enqueued': 0, 'coalesced': 0,
+        'done': 0, 'failed': 0})
+    redis_conn.expire(batch_key, BATCH_TTL)
+
+    chunk = []
+    last_stat_token = None
+    tokens = _bulk_tokens(stat, qeez_tokens, pattern, stat_redis)
+    while True:
+        qeez_token = next(tokens, None)
+        if qeez_token is not None:
+            if qeez_token in chunk:
+                continue
+            chunk.append(qeez_token)
+            if len(chunk) < CFG['CALC_BULK_CHUNK']:
+                continue
+        if not chunk:
+            break
+        stat_tokens = _enqueue_chunk(
+            queue, stat, chunk, batch_id, stat_redis, force, lane)
+        enqueued = len(stat_tokens)
+        if stat_tokens:
+            last_stat_token = stat_tokens[-1]
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hincrby(batch_key, 'total', len(chunk))
+        pipe.hincrby(batch_key, 'enqueued', enqueued)
+        pipe.hincrby(batch_key, 'coalesced', len(chunk) - enqueued)
+        pipe.execute()
+        metrics.incr('calc.enqueued.%s' % lane, enqueued)
+        metrics.incr('calc.coalesced', len(chunk) - enqueued)
+        chunk = []
+
+    if last_stat_token is not None:
+        # NOTE: collector job's result lists tokens for `pull_all_stat_res`
+        queue.enqueue(
+            stat_collector, stat, last_stat_token, timeout=30,
+            result_ttl=7200, ttl=7200, job_id=COLL_ID_FMT % stat)
+    redis_conn.hset(batch_key, 'closed', 1)
+    return batch_id
+
+
+def batch_progress(batch_id, redis_conn=None):
+    '''Returns batch progress counters (`total`, `enqueued`, `coalesced`,
+    `done`, `failed`) and `complete` flag (all tokens enqueued and
+    calculated), None if missing
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    data = redis_conn.hgetall(BATCH_ID_FMT % batch_id)
+    if not data:
+        return None
+    out = dict(
+        (to_str(_key), to_str(_val)) for _key, _val in data.items())
+    for name in ('total', 'enqueued', 'coalesced', 'done', 'failed'):
+        out[name] = int(out.get(name, 0))
+    out['complete'] = bool(int(out.pop('closed', 0))) and \
+        out['done'] + out['failed'] >= out['total']
+    return out
+
+
+def _load_results(stat, qeez_tokens, redis_conn):
+    '''Returns results (None if missing) of tokens from stat's result hash
+    '''
+    if not qeez_tokens:
+        return []
+    return [
+        None if raw is None else loads_result(raw)
+        for raw in redis_conn.hmget(RES_ID_FMT % stat, qeez_tokens)]
+
+
+def _job_res(stat_token, redis_conn):
+    '''Returns result stored in rq job (by stats calculated before the
+    result hash was introduced), None if missing
+    '''
+    job = fetch_job(stat_token, redis_conn)
+    if job is None:
+        return None
+    return job.result
+
+
+def pull_stat_res(stat, qeez_token, redis_conn=None, read_conn=None):
+    '''Pulls one stat's result (from `read_conn` replica, if given)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    read_conn = read_conn or redis_conn
+    res = _load_results(stat, [qeez_token], read_conn)[0]
+    if res is None:
+        res = _job_res(STAT_ID_FMT % (stat, qeez_token), read_conn)
     return res
 
 
@@ -100,8 +411,7 @@ def pull_all_stat_res(stat, redis_conn=None):
     '''
     if redis_conn is None:
         redis_conn = get_redis(CFG['QUEUE_REDIS'])
-    queue = Queue('calc', connection=redis_conn)
-    job = queue.fetch_job(COLL_ID_FMT % stat)
+    job = fetch_job(COLL_ID_FMT % stat, redis_conn)
 
     res = None
     if job is None:
@@ -110,13 +420,79 @@ def pull_all_stat_res(stat, redis_conn=None):
     if res is None:
         return
 
+    prefix = STAT_ID_FMT % (stat, '')
+    stat_tokens = [to_str(stat_token) for stat_token in res]
+    qeez_tokens = [
+        stat_token[len(prefix):] for stat_token in stat_tokens
+        if stat_token.startswith(prefix)]
+    results = dict(zip(
+        qeez_tokens, _load_results(stat, qeez_tokens, redis_conn)))
+
     out = []
-    for stat_token in res:
-        _job = queue.fetch_job(to_str(stat_token))
-        _res = None
-        if _job is not None:
-            _res = _job.result
+    for stat_token in stat_tokens:
+        _res = results.get(stat_token[len(prefix):])
+        if _res is None:
+            _res = _job_res(stat_token, redis_conn)
         if _res is not None:
             out.append(_res)
 
     return out
+
+
+def stat_res_version(stat, qeez_token=None, redis_conn=None):
+    '''Returns current version of stat's results (or of token's result),
+    0 if not versioned
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    if qeez_token is None:
+        version = redis_conn.get(RES_VER_ID_FMT % stat)
+    else:
+        version = redis_conn.zscore(RES_IDX_ID_FMT % stat, qeez_token)
+    return int(version or 0)
+
+
+def pull_stat_res_since(stat, qeez_token, since, redis_conn=None):
+    '''Pulls one stat's result if updated after version `since`
+
+    Returns (result or None, version)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    pipe = redis_conn.pipeline()
+    pipe.zscore(RES_IDX_ID_FMT % stat, qeez_token)
+    pipe.hget(RES_ID_FMT % stat, qeez_token)
+    version, raw = pipe.execute()
+    if version is None or raw is None or int(version) <= since:
+        return None, since
+    return loads_result(raw), int(version)
+
+
+def pull_stat_res_delta(stat, since, redis_conn=None):
+    '''Pulls stat results updated after version `since`
+
+    Returns (list of `{'token', 'version', 'result'}` dicts, high-water
+    version to poll with next time). Results are stored together with their
+    versions, so polling with the high-water version never skips an update.
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    pipe = redis_conn.pipeline()
+    pipe.get(RES_VER_ID_FMT % stat)
+    pipe.zrangebyscore(
+        RES_IDX_ID_FMT % stat, '(%d' % since, '+inf', withscores=True)
+    top, changed = pipe.execute()
+    top = max(int(top or 0), since)
+
+    qeez_tokens = [to_str(qeez_token) for qeez_token, _ in changed]
+    out = []
+    for qeez_token, (_, version), res in zip(
+            qeez_tokens, changed,
+            _load_results(stat, qeez_tokens, redis_conn)):
+        if res is not None:
+            out.append({
+                'token': qeez_token,
+                'version': int(version),
+                'result': res,
+            })
+    return out, top
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics rollups module
+
+With `CFG['ROLLUPS']['ENABLED']`, every ingest adds its packets to time
+buckets of each configured resolution (per minute `m` and per hour `h` by
+default - drop one to skip it): packets count, points and answer time sums
+(hash `_roll:<res>:<bucket>`) and active games (HyperLogLog
+`_rollg:<res>:<bucket>`). Buckets expire after resolution's `RETENTION`, so
+range queries cost O(buckets), regardless of the number of games.
+'''
+
+import logging
+import time
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import PACKET_SEP, get_redis, to_str
+
+
+LOG = logging.getLogger(__name__)
+
+ROLL_ID_FMT = '_roll:%s:%d'
+GAMES_ID_FMT = '_rollg:%s:%d'
+
+
+def bucket_start(step, now):
+    '''Returns start (epoch seconds) of bucket covering `now`
+    '''
+    return int(now // step) * step
+
+
+def _packet_sums(res_dc):
+    '''Returns (packets count, points sum, answer time sum)
+    '''
+    points = 0
+    ans_time = 0.0
+    for val in res_dc.values():
+        if isinstance(val, tuple):
+            val = val[0]
+        parts = to_str(val).split(PACKET_SEP)
+        try:
+            ans_time += float(parts[1])
+            points += int(parts[2])
+        except (IndexError, ValueError):
+            LOG.warning('Bad val: %s', repr(val))
+    return len(res_dc), points, ans_time
+
+
+def record(qeez_token, res_dc, redis_conn=None, now=None):
+    '''Adds ingested packets to rollup buckets (one round trip)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    if now is None:
+        now = time.time()
+    packets, points, ans_time = _packet_sums(res_dc)
+    pipe = redis_conn.pipeline(transaction=False)
+    for res, cfg in CFG['ROLLUPS']['RESOLUTIONS'].items():
+        bucket = bucket_start(cfg['STEP'], now)
+        roll_id = ROLL_ID_FMT % (res, bucket)
+        games_id = GAMES_ID_FMT % (res, bucket)
+        pipe.hincrby(roll_id, 'packets', packets)
+        pipe.hincrby(roll_id, 'points', points)
+        pipe.hincrbyfloat(roll_id, 'ans_time', ans_time)
+        pipe.expire(roll_id, cfg['RETENTION'])
+        pipe.pfadd(games_id, qeez_token)
+        pipe.expire(games_id, cfg['RETENTION'])
+    pipe.execute()
+
+
+def query(res, start, end, redis_conn=None):
+    '''Returns time series of buckets in [start, end] range
+
+    Each point is a dict: `ts` (bucket start), `packets`, `points`,
+    `avg_points`, `avg_ans_time` and `games` (approximate count).
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    step = CFG['ROLLUPS']['RESOLUTIONS'][res]['STEP']
+    buckets = list(range(
+        bucket_start(step, start), bucket_start(step, end) + 1, step))
+    pipe = redis_conn.pipeline(transaction=False)
+    for bucket in buckets:
+        pipe.hmget(
+            ROLL_ID_FMT % (res, bucket), 'packets', 'points', 'ans_time')
+        pipe.pfcount(GAMES_ID_FMT % (res, bucket))
+    replies = pipe.execute()
+
+    out = []
+    for idx, bucket in enumerate(buckets):
+        packets, points, ans_time = replies[2 * idx]
+        packets = int(packets or 0)
+        points = int(points or 0)
+        ans_time = float(ans_time or 0.0)
+        out.append({
+            'ts': bucket,
+            'packets': packets,
+            'points': points,
+            'avg_points': points / packets if packets else None,
+            'avg_ans_time': ans_time / packets if packets else None,
+            'games': replies[2 * idx + 1],
+        })
+    return out
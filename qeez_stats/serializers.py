@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics queue payload serializers module
+
+rq (de)serializes job payloads, results and meta with pickle. Set
+`QUEUE_SERIALIZER` to `json` (or `msgpack`, if installed) to store them in
+a compact, non-executable format instead; workers have to use the matching
+job class:
+
+$ rqworker --url unix:///tmp/redis.sock?db=1 \
+    --job-class qeez_stats.serializers.JSONJob calc
+'''
+
+import json
+import logging
+import pickle
+import zlib
+
+from rq.exceptions import UnpickleError
+from rq.job import UNEVALUATED, Job
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import to_str
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _default(obj):
+    '''Converts types unknown to compact serializers
+    '''
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    if isinstance(obj, bytes):
+        return to_str(obj)
+    raise TypeError('Not serializable: %s' % repr(type(obj)))
+
+
+class JSONSerializer(object):
+    '''Compact JSON serializer
+    '''
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(
+            obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(buf):
+        return json.loads(to_str(buf))
+
+
+class MsgpackSerializer(object):
+    '''msgpack serializer (optional dependency)
+    '''
+
+    name = 'msgpack'
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    @staticmethod
+    def loads(buf):
+        return msgpack.unpackb(buf, raw=False)
+
+
+class PickleSerializer(object):
+    '''pickle serializer (rq's default)
+    '''
+
+    name = 'pickle'
+
+    @staticmethod
+    def dumps(obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(buf):
+        return pickle.loads(buf)
+
+
+SERIALIZERS = {
+    b'p': PickleSerializer,
+    b'j': JSONSerializer,
+    b'm': MsgpackSerializer,
+}
+RESULT_RAW = b'r'
+RESULT_ZLIB = b'z'
+
+
+def dumps_result(value):
+    '''Serializes stat result with configured serializer (zlib-compressed
+    if at least `RESULT_COMPRESS_MIN` bytes long), tagged for `loads_result`
+    '''
+    serializer = getattr(get_job_class(), 'serializer', PickleSerializer)
+    tag = serializer.name[:1].encode('ascii')
+    data = serializer.dumps(value)
+    if len(data) >= CFG['RESULT_COMPRESS_MIN']:
+        return tag + RESULT_ZLIB + zlib.compress(data)
+    return tag + RESULT_RAW + data
+
+
+def loads_result(raw):
+    '''Deserializes stat result stored by `dumps_result`
+
+    Pickled results are rejected (ValueError) unless pickle is the
+    configured serializer, so compact serializers never unpickle.
+    '''
+    serializer = SERIALIZERS[raw[:1]]
+    if serializer is PickleSerializer and \
+            CFG.get('QUEUE_SERIALIZER', 'pickle') != 'pickle':
+        raise ValueError('Pickled result rejected')
+    data = raw[2:]
+    if raw[1:2] == RESULT_ZLIB:
+        data = zlib.decompress(data)
+    return serializer.loads(data)
+
+
+class CompactJob(Job):
+    '''rq job storing payload, result and meta with a compact serializer
+    '''
+
+    serializer = JSONSerializer
+
+    def _unpickle_data(self):
+        try:
+            func_name, instance, args, kwargs = \
+                self.serializer.loads(self.data)
+        except Exception as exc:
+            raise UnpickleError('Could not deserialize', self.data, exc)
+        self._func_name, self._instance = func_name, instance
+        self._args, self._kwargs = tuple(args), kwargs
+
+    @property
+    def data(self):
+        if self._data is UNEVALUATED:
+            if self._func_name is UNEVALUATED:
+                raise ValueError('Cannot build the job data')
+            if self._instance not in (None, UNEVALUATED):
+                raise ValueError('Instance methods are not supported')
+            args = () if self._args is UNEVALUATED else self._args
+            kwargs = {} if self._kwargs is UNEVALUATED else self._kwargs
+            self._data = self.serializer.dumps(
+                (self._func_name, None, list(args), kwargs))
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        Job.data.fset(self, value)
+
+    @property
+    def result(self):
+        if self._result is None:
+            raw = self.connection.hget(self.key, 'result')
+            if raw is not None:
+                self._result = self.serializer.loads(raw)
+        return self._result
+
+    return_value = result
+
+    def restore(self, raw_data):
+        raw_data = dict(raw_data)
+        encoded = {}
+        for name in ('result', 'meta'):
+            for key in (name, name.encode('utf-8')):
+                if key in raw_data:
+                    encoded[name] = raw_data.pop(key)
+        Job.restore(self, raw_data)
+        # NOTE: fields left by differently serialized job (with the same ID)
+        # are treated as missing
+        self._result = self._loads_field(encoded.get('result'), None)
+        self.meta = self._loads_field(encoded.get('meta'), {})
+
+    def _loads_field(self, raw, default):
+        '''Deserializes stored field, returns default if missing or invalid
+        '''
+        if not raw:
+            return default
+        try:
+            return self.serializer.loads(raw)
+        except Exception as exc:
+            LOG.warning('%s: bad field: %s', self.id, repr(exc))
+        return default
+
+    def to_dict(self, include_meta=True):
+        # NOTE: hide result from rq, so it is not pickled needlessly
+        result, self._result = self._result, None
+        try:
+            obj = Job.to_dict(self, include_meta=False)
+        finally:
+            self._result = result
+        if self._result is not None:
+            try:
+                obj['result'] = self.serializer.dumps(self._result)
+            except (TypeError, ValueError):
+                obj['result'] = self.serializer.dumps(
+                    'Unserializable return value')
+        if self.meta and include_meta:
+            obj['meta'] = self.serializer.dumps(self.meta)
+        return obj
+
+    def save_meta(self):
+        self.connection.hset(
+            self.key, 'meta', self.serializer.dumps(self.meta))
+
+
+class JSONJob(CompactJob):
+    '''rq job using compact JSON
+    '''
+
+    serializer = JSONSerializer
+
+
+class MsgpackJob(CompactJob):
+    '''rq job using msgpack
+    '''
+
+    serializer = MsgpackSerializer
+
+
+JOB_CLASSES = {
+    'pickle': Job,
+    'json': JSONJob,
+    'msgpack': MsgpackJob,
+}
+
+
+def get_job_class(name=None):
+    '''Returns rq job class for a serializer name (default: from config)
+    '''
+    if name is None:
+        name = CFG.get('QUEUE_SERIALIZER', 'pickle')
+    if name == 'msgpack' and msgpack is None:
+        LOG.warning('msgpack not installed, using json')
+        name = 'json'
+    return JOB_CLASSES[name]
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics prefork server module
+
+The application (and its environment) is loaded once in the master process,
+then N worker processes are forked. Every worker runs post-fork hooks (new
+redis clients, new Raven client) and is recycled after serving
+`WORKER_MAX_REQUESTS` requests or after `WORKER_MAX_IDLE` seconds of idling.
+Pre-exit hooks run before a worker exits (its spool is drained, its
+counters flushed).
+Workers failing within `SPAWN_MIN_UPTIME` seconds (e.g. at startup) are
+respawned with exponential backoff (up to `SPAWN_BACKOFF_MAX` seconds).
+
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.server --workers 4
+# or, with a per-worker listening socket (Linux >= 3.9):
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.server -w 4 --reuse-port
+'''
+
+import argparse
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+from werkzeug.serving import BaseWSGIServer
+
+from qeez_stats import metrics, spool
+from qeez_stats.config import CFG, make_raven_client
+from qeez_stats.utils import (
+    get_queue_redis,
+    get_stat_redis,
+    load_scripts,
+    reset_redis_conns,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+SPAWN_MIN_UPTIME = 1.0
+SPAWN_BACKOFF = 0.1
+SPAWN_BACKOFF_MAX = 30.0
+POST_FORK_HOOKS = []
+PRE_EXIT_HOOKS = []
+
+
+def post_fork_hook(func):
+    '''Registers function to be called in every freshly forked worker
+    '''
+    POST_FORK_HOOKS.append(func)
+    return func
+
+
+@post_fork_hook
+def reset_raven_client():
+    '''Creates new Raven client (its transport thread does not survive fork)
+    '''
+    CFG['RAVEN_CLI'] = make_raven_client()
+
+
+post_fork_hook(reset_redis_conns)
+
+
+@post_fork_hook
+def preload_scripts():
+    '''Preloads Lua scripts (a failure here is not fatal for the worker)
+    '''
+    try:
+        load_scripts(get_stat_redis())
+    except RedisConnectionError as exc:
+        LOG.warning('Scripts not preloaded: %s', repr(exc))
+
+
+def post_fork():
+    '''Runs all registered post-fork hooks
+    '''
+    for func in POST_FORK_HOOKS:
+        func()
+
+
+def pre_exit_hook(func):
+    '''Registers function to be called in every exiting worker
+    '''
+    PRE_EXIT_HOOKS.append(func)
+    return func
+
+
+@pre_exit_hook
+def drain_spool():
+    '''Replays worker's spooled records (so they are never replayed after
+    newer writes by another process' recovery)
+    '''
+    spool.close_spool(timeout=CFG['SPOOL']['RETRY'])
+
+
+@pre_exit_hook
+def flush_metrics():
+    '''Flushes worker's counters (they would be lost with the process)
+    '''
+    metrics.flush(get_queue_redis())
+
+
+def pre_exit():
+    '''Runs all registered pre-exit hooks (their failures are logged only)
+    '''
+    for func in PRE_EXIT_HOOKS:
+        try:
+            func()
+        except Exception as exc:
+            LOG.exception('Worker %d: pre-exit hook failed: %s',
+                          os.getpid(), repr(exc))
+
+
+def make_socket(host, port, reuse_port=False, backlog=128):
+    '''Returns bound and listening TCP socket
+    '''
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class WorkerServer(BaseWSGIServer):
+    '''Single-threaded WSGI server counting served requests
+    '''
+
+    served = 0
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        BaseWSGIServer.process_request(self, request, client_address)
+
+
+def serve(app, sock, max_requests=0, max_idle=0, stopped=None):
+    '''Serves requests on a listening socket until recycled, returns count
+    '''
+    host, port = sock.getsockname()[:2]
+    server = WorkerServer(host, port, app, fd=sock.fileno())
+    server.timeout = POLL_INTERVAL
+
+    last_served, last_active = 0, time.time()
+    while stopped is None or not stopped():
+        server.handle_request()
+        if server.served != last_served:
+            last_served, last_active = server.served, time.time()
+        if max_requests and server.served >= max_requests:
+            LOG.info('Worker %d: max requests reached', os.getpid())
+            break
+        if max_idle and time.time() - last_active >= max_idle:
+            LOG.info('Worker %d: idle, recycling', os.getpid())
+            break
+
+    server.server_close()
+    return server.served
+
+
+def _spawn(app, sock, host, port, reuse_port, max_requests, max_idle):
+    '''Forks worker process, returns its PID (in the master)
+    '''
+    pid = os.fork()
+    if pid:
+        return pid
+
+    stop = []
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop.append(True))
+    exit_code = 0
+    try:
+        post_fork()
+        if reuse_port:
+            sock = make_socket(host, port, reuse_port=True)
+        serve(app, sock, max_requests=max_requests, max_idle=max_idle,
+              stopped=lambda: bool(stop))
+    except Exception as exc:
+        LOG.exception('Worker %d: %s', os.getpid(), repr(exc))
+        exit_code = 1
+    pre_exit()
+    os._exit(exit_code)
+
+
+def respawn_delay(crashes):
+    '''Returns seconds to wait before respawning a worker after a number of
+    consecutive early failures
+    '''
+    if not crashes:
+        return 0.0
+    return min(SPAWN_BACKOFF * 2 ** (crashes - 1), SPAWN_BACKOFF_MAX)
+
+
+def run(app, host, port, workers=1, reuse_port=False, max_requests=0,
+        max_idle=0):
+    '''Runs the master process: forks workers and keeps them alive
+    '''
+    sock = None
+    if not reuse_port:
+        sock = make_socket(host, port)
+
+    children = {}
+    stopping = [False]
+
+    def _stop(*_):
+        stopping[0] = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    spawn_args = (app, sock, host, port, reuse_port, max_requests, max_idle)
+    for _ in range(workers):
+        pid = _spawn(*spawn_args)
+        children[pid] = time.time()
+
+    LOG.info('Master %d: %d workers on %s:%s', os.getpid(), workers, host,
+             port)
+    crashes = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            raise
+        started = children.pop(pid, None)
+        if stopping[0]:
+            continue
+        if status and started is not None and \
+                time.time() - started < SPAWN_MIN_UPTIME:
+            crashes += 1
+        else:
+            crashes = 0
+        delay = respawn_delay(crashes)
+        if delay:
+            LOG.warning('Worker %d failed early (%d in a row), respawning in'
+                        ' %.1fs', pid, crashes, delay)
+        deadline = time.time() + delay
+        while not stopping[0] and time.time() < deadline:
+            time.sleep(min(deadline - time.time(), POLL_INTERVAL))
+        if not stopping[0]:
+            children[_spawn(*spawn_args)] = time.time()
+
+    if sock is not None:
+        sock.close()
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description='Qeez stats prefork server')
+    parser.add_argument('--host', default=CFG['HOST'])
+    parser.add_argument('--port', type=int, default=CFG['PORT'])
+    parser.add_argument('-w', '--workers', type=int, default=CFG['WORKERS'])
+    parser.add_argument('--reuse-port', action='store_true',
+                        default=CFG['REUSE_PORT'],
+                        help='bind per-worker sockets with SO_REUSEPORT')
+    parser.add_argument('--max-requests', type=int,
+                        default=CFG['WORKER_MAX_REQUESTS'],
+                        help='recycle worker after N requests (0: never)')
+    parser.add_argument('--max-idle', type=float,
+                        default=CFG['WORKER_MAX_IDLE'],
+                        help='recycle worker idle for N seconds (0: never)')
+    args = parser.parse_args(argv)
+
+    from qeez_stats.service import APP
+
+    run(APP, args.host, args.port, workers=args.workers,
+        reuse_port=args.reuse_port, max_requests=args.max_requests,
+        max_idle=args.max_idle)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,28 +5,57 @@
 
 $ pip install -U .
 $ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.service
+or, multi-process (see `qeez_stats.server`):
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.server --workers 4
 '''
 
 import logging
-from time import gmtime
+from functools import partial
+from time import gmtime, time
 
-from flask import Flask, request
+from flask import Flask, request, send_file
 from flask.json import jsonify
-
+from redis.exceptions import RedisError
+
+from qeez_stats import (
+    admission,
+    compress,
+    dedup,
+    distinct,
+    export,
+    leaderboards,
+    metrics,
+    profiling,
+    rollups,
+    sketches,
+    spool,
+    supervisor,
+)
 from qeez_stats.config import CFG
 from qeez_stats.queues import (
+    LANE_BULK,
+    LANE_INTERACTIVE,
+    STAT_ID_FMT,
+    batch_progress,
     direct_stat_save,
     enqueue_stat_save,
     enqueue_stat_calc,
+    enqueue_stat_calc_bulk,
     pull_all_stat_res,
     pull_stat_res,
+    pull_stat_res_delta,
+    pull_stat_res_since,
+    stat_res_version,
 )
+from qeez_stats.streams import stream_stat_save
 from qeez_stats.utils import (
     calc_checksum,
     get_method_by_path,
     get_queue_redis,
+    get_read_redis,
     get_save_redis,
     get_stat_redis,
+    ingest_packets_batch,
     packet_split,
     save_packets_to_stat,
 )
@@ -59,29 +88,98 @@ def prepare_env():
 prepare_env()
 
 
-def _json_response(data_dc, status=200):
-    '''Creates HTTP response object with appropriate headers for JSON data
+def _encoded_body(data_dc, encoding):
+    '''Returns (JSON body, applied encoding)
     '''
-    resp = jsonify(**data_dc)
+    return compress.encode_body(jsonify(**data_dc).get_data(), encoding)
+
+
+def _body_response(body, encoding, status=200):
+    '''Creates HTTP response object with appropriate headers for JSON body
+    '''
+    resp = APP.response_class(
+        body, status=status, mimetype=APP.config['JSONIFY_MIMETYPE'])
     resp.headers['Server'] = 'Flask'
-    resp.status_code = status
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if encoding != compress.IDENTITY:
+        resp.headers['Content-Encoding'] = encoding
     return resp
 
 
+def _json_response(data_dc, status=200):
+    '''Creates HTTP response object with appropriate headers for JSON data
+    '''
+    encoding = compress.negotiate(request.accept_encodings)
+    return _body_response(*_encoded_body(data_dc, encoding), status=status)
+
+
+def _cached_json_response(cache_key, get_data):
+    '''Creates HTTP response object for JSON data, reusing encoded body
+    cached under `cache_key` (which has to change with the data)
+    '''
+    encoding = compress.negotiate(request.accept_encodings)
+    entry = compress.BODY_CACHE.get((cache_key, encoding))
+    if entry is None:
+        entry = _encoded_body(get_data(), encoding)
+        compress.BODY_CACHE.put((cache_key, encoding), entry)
+    return _body_response(*entry)
+
+
+def _enqueue_save(qeez_token, res_dc, atime):
+    '''Hands data packets over to the save backend
+    '''
+    if CFG['SAVE_BACKEND'] == 'stream':
+        return bool(stream_stat_save(
+            qeez_token, res_dc, atime=atime, redis_conn=get_save_redis()))
+
+    job = enqueue_stat_save(
+        qeez_token, res_dc, atime=atime, redis_conn=get_save_redis())
+    return bool(job)
+
+
+def _update_aggregates(qeez_token, res_dc, now=None):
+    '''Updates aggregates maintained at ingest (rollups, leaderboards,
+    sketches, distinct counts)
+    '''
+    if CFG['ROLLUPS']['ENABLED']:
+        rollups.record(
+            qeez_token, res_dc, redis_conn=get_stat_redis(), now=now)
+    if CFG['LEADERBOARDS']['ENABLED']:
+        leaderboards.update(qeez_token, res_dc, redis_conn=get_stat_redis())
+    if CFG['SKETCHES']['ENABLED']:
+        sketches.update(qeez_token, res_dc, redis_conn=get_stat_redis())
+    if CFG['DISTINCT']['ENABLED']:
+        distinct.update(qeez_token, res_dc, redis_conn=get_stat_redis())
+
+
 def _save_packets(qeez_token, res_dc, sync=False):
     '''Saves data packets (to all possible DBs)
     '''
     save_packets_to_stat(qeez_token, res_dc, redis_conn=get_stat_redis())
+    _update_aggregates(qeez_token, res_dc)
     if sync:
         return direct_stat_save(qeez_token, res_dc, atime=gmtime())
 
-    job = enqueue_stat_save(
-        qeez_token, res_dc, atime=gmtime(), redis_conn=get_save_redis())
-    return bool(job)
+    return _enqueue_save(qeez_token, res_dc, gmtime())
 
 
-def _save_data(qeez_token, packets, sync=False):
-    '''Parses and saves data packets
+def _replay_spooled(records):
+    '''Replays spooled (token, atime, packets dict, stat) records
+    '''
+    ingest_packets_batch(
+        [(_rec[0], _rec[2]) for _rec in records], redis_conn=get_stat_redis())
+    for qeez_token, atime, res_dc, stat in records:
+        _update_aggregates(qeez_token, res_dc, now=atime)
+        _enqueue_save(qeez_token, res_dc, gmtime(atime))
+        if stat is not None:
+            enqueue_stat_calc(stat, qeez_token, redis_conn=get_queue_redis())
+    if CFG['ADMISSION']['ENABLED']:
+        # NOTE: spooled requests are admitted by samples taken here
+        admission.refresh_samples('calc', get_queue_redis())
+
+
+def _parse_packets(packets):
+    '''Parses data packets, returns packets dict
     '''
     res_dc = {}
     for packet in packets:
@@ -95,13 +193,32 @@ def _save_data(qeez_token, packets, sync=False):
             else:
                 if packet_split(key, val):
                     res_dc[key] = val
+    return res_dc
+
 
+def _save_data(qeez_token, packets, sync=False):
+    '''Parses and saves data packets
+    '''
+    res_dc = _parse_packets(packets)
     if res_dc:
         return _save_packets(qeez_token, res_dc, sync=sync)
 
     return False
 
 
+def _spool_data(qeez_token, packets, stat=None):
+    '''Parses and spools data packets (with stat to recalculate), returns
+    None if spool is full
+    '''
+    res_dc = _parse_packets(packets)
+    if not res_dc:
+        return False
+    if spool.get_spool(_replay_spooled).append(
+            qeez_token, int(time()), res_dc, stat=stat):
+        return True
+    return None
+
+
 @APP.errorhandler(404)
 def not_found(_):
     '''HTTP 404 error handler
@@ -130,25 +247,91 @@ def internal_server_error(_):
     return _json_response({'error': True, 'status': 500}, status=500)
 
 
-def _process_data(req, qeez_token, multi_data=None, stat=None):
+def service_unavailable():
+    '''HTTP 503 response (with retry hint) for rejected requests
+    '''
+    resp = _json_response({'error': True, 'status': 503}, status=503)
+    resp.headers['Retry-After'] = str(CFG['ADMISSION']['RETRY_AFTER'])
+    return resp
+
+
+def _dedup_remember(dedup_key, resp):
+    '''Runs `dedup.remember` ignoring redis errors
+    '''
+    try:
+        dedup.remember(dedup_key, resp, get_stat_redis())
+    except RedisError:
+        metrics.incr('dedup.errors')
+
+
+def _process_data(req, qeez_token, multi_data=None, stat=None, route=None):
     '''Processes data packets, returns response objects
+
+    Spooled requests (see `spool`) skip dedup and `save` admission and are
+    admitted to `calc` by cached queue samples, so they make no redis calls
+    (and survive its stalls); requests are rejected if spool is full.
     '''
     if not req.json:
         return bad_request(None)
+    checksum = calc_checksum(req.data)
+    sync = 'sync' in req.args
+    spooling = CFG['SPOOL']['ENABLED'] and not sync
+    dedup_key = None
+    if CFG['DEDUP']['ENABLED'] and not spooling:
+        dedup_key = dedup.request_key(qeez_token, stat, req.data)
+        resp = dedup.seen(dedup_key, get_stat_redis())
+        if resp is not None:
+            metrics.incr('dedup.suppressed')
+            if resp is True:
+                resp = {'error': False, 'checksum': checksum}
+                if stat is not None:
+                    resp['job_id'] = STAT_ID_FMT % (stat, qeez_token)
+            return _json_response(resp)
+    if not (sync or spooling):
+        decision = admission.admit(route, 'save', get_save_redis())
+        if decision == admission.REJECT:
+            return service_unavailable()
+        sync = decision == admission.DIRECT
+    calc_decision = None
+    if stat is not None:
+        calc_decision = admission.admit(
+            route, 'calc', get_queue_redis(), cached=spooling)
+        if calc_decision == admission.REJECT:
+            return service_unavailable()
     _json = req.get_json()
     if multi_data is True:
         json_data = _json
     else:
         json_data = [_json]
-    checksum = calc_checksum(req.data)
-    if _save_data(qeez_token, json_data, sync=('sync' in req.args)):
+    if spooling:
+        calc_stat = stat if calc_decision != admission.SHED else None
+        spooled = _spool_data(qeez_token, json_data, stat=calc_stat)
+        if spooled is False:
+            return bad_request(None)
+        if spooled is None:
+            # NOTE: a direct write would be overwritten by older spooled ones
+            return service_unavailable()
         resp = {
             'error': False,
             'checksum': checksum}
-        if stat is not None:
+        if calc_stat is None and stat is not None:
+            resp['shed'] = True
+        elif stat is not None:
+            resp['job_id'] = STAT_ID_FMT % (stat, qeez_token)
+        return _json_response(resp)
+    if _save_data(qeez_token, json_data, sync=sync):
+        resp = {
+            'error': False,
+            'checksum': checksum}
+        if calc_decision == admission.SHED:
+            resp['shed'] = True
+        elif stat is not None:
             job = enqueue_stat_calc(
                 stat, qeez_token, redis_conn=get_queue_redis())
             resp['job_id'] = job.id
+        if dedup_key is not None:
+            # NOTE: data is saved already, a failure must not make it retried
+            _dedup_remember(dedup_key, resp)
         return _json_response(resp)
     return bad_request(None)
 
@@ -157,36 +340,55 @@ def _process_data(req, qeez_token, multi_data=None, stat=None):
 def stats_mput(qeez_token=None):
     '''PUT view to handle multiple packets at a time
     '''
-    return _process_data(request, qeez_token, multi_data=True, stat=None)
+    return _process_data(
+        request, qeez_token, multi_data=True, stat=None, route='mput')
 
 
 @APP.route('/stats/put/<qeez_token>', methods=['PUT'])
 def stats_put(qeez_token=None):
     '''PUT view to handle one packet at a time
     '''
-    return _process_data(request, qeez_token, multi_data=False, stat=None)
+    return _process_data(
+        request, qeez_token, multi_data=False, stat=None, route='put')
 
 
 @APP.route('/stats/ar_mput/<stat>/<qeez_token>', methods=['PUT'])
 def stats_ar_mput(stat=None, qeez_token=None):
     '''PUT view to handle multiple packets at a time with auto-recalculation
     '''
-    return _process_data(request, qeez_token, multi_data=True, stat=stat)
+    return _process_data(
+        request, qeez_token, multi_data=True, stat=stat, route='ar_mput')
 
 
 @APP.route('/stats/ar_put/<stat>/<qeez_token>', methods=['PUT'])
 def stats_ar_put(stat=None, qeez_token=None):
     '''PUT view to handle one packet at a time with auto-recalculation
     '''
-    return _process_data(request, qeez_token, multi_data=False, stat=stat)
+    return _process_data(
+        request, qeez_token, multi_data=False, stat=stat, route='ar_put')
 
 
 @APP.route('/stats/proc_enq/<stat>/<qeez_token>', methods=['PUT'])
 def stats_proc_enq(stat=None, qeez_token=None):
-    '''PUT view to enqueue selected stat processing
+    '''PUT view to enqueue selected stat processing (in the bulk lane, unless
+    `?interactive` is given; `?profile` samples stat run's stacks, `?force`
+    skips memoized result)
     '''
     checksum = calc_checksum(request.data)
-    job = enqueue_stat_calc(stat, qeez_token, redis_conn=get_queue_redis())
+    redis_conn = get_queue_redis()
+    lane = LANE_INTERACTIVE if 'interactive' in request.args else LANE_BULK
+    decision = admission.admit('proc_enq', 'calc', redis_conn, lane=lane)
+    if decision == admission.REJECT:
+        return service_unavailable()
+    if decision == admission.SHED:
+        return _json_response({
+            'error': False,
+            'checksum': checksum,
+            'shed': True,
+        })
+    job = enqueue_stat_calc(
+        stat, qeez_token, redis_conn=redis_conn, lane=lane,
+        profile='profile' in request.args, force='force' in request.args)
     return _json_response({
         'error': False,
         'checksum': checksum,
@@ -194,28 +396,307 @@ def stats_proc_enq(stat=None, qeez_token=None):
     })
 
 
-@APP.route('/stats/result/<stat>/<qeez_token>', methods=['GET'])
-def stats_result_get(qeez_token=None, stat=None):
-    '''GET view to get selected stat result
+@APP.route('/stats/proc_enq_bulk/<stat>', methods=['PUT'])
+def stats_proc_enq_bulk(stat=None):
+    '''PUT view to enqueue selected stat processing of many tokens (in the
+    bulk lane): JSON list of tokens or, without a body, collector set's
+    tokens matching `?pattern=` glob; with `?memoize`, results of unchanged
+    packets are kept
     '''
-    result = pull_stat_res(stat, qeez_token, redis_conn=get_queue_redis())
+    qeez_tokens = None
+    if request.data:
+        qeez_tokens = request.get_json(silent=True)
+        if not isinstance(qeez_tokens, list) or \
+                len(qeez_tokens) > CFG['CALC_BULK_MAX'] or \
+                not all(isinstance(_tok, str) for _tok in qeez_tokens):
+            return bad_request(None)
+    redis_conn = get_queue_redis()
+    decision = admission.admit(
+        'proc_enq_bulk', 'calc', redis_conn, lane=LANE_BULK)
+    if decision == admission.REJECT:
+        return service_unavailable()
+    if decision == admission.SHED:
+        return _json_response({
+            'error': False,
+            'shed': True,
+        })
+    batch_id = enqueue_stat_calc_bulk(
+        stat, qeez_tokens=qeez_tokens,
+        pattern=request.args.get('pattern', '*'), redis_conn=redis_conn,
+        stat_redis=get_stat_redis(), force='memoize' not in request.args)
     return _json_response({
         'error': False,
-        'result': result,
+        'batch_id': batch_id,
+        'progress': batch_progress(batch_id, redis_conn=redis_conn),
     })
 
 
+@APP.route('/stats/batch/<batch_id>', methods=['GET'])
+def stats_batch_get(batch_id=None):
+    '''GET view to get bulk processing batch's progress counters
+    '''
+    progress = batch_progress(batch_id, redis_conn=get_queue_redis())
+    if progress is None:
+        return not_found(None)
+    return _json_response({
+        'error': False,
+        'progress': progress,
+    })
+
+
+def _since_arg():
+    '''Returns `since` version query argument, None if invalid
+    '''
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return None
+    return since
+
+
+def _stat_res_data(stat, qeez_token, redis_conn, read_conn):
+    '''Returns response data with one stat's result
+    '''
+    return {
+        'error': False,
+        'result': pull_stat_res(
+            stat, qeez_token, redis_conn=redis_conn, read_conn=read_conn),
+    }
+
+
+def _all_stat_res_data(stat, redis_conn):
+    '''Returns response data with all stat results
+    '''
+    return {
+        'error': False,
+        'result': pull_all_stat_res(stat, redis_conn=redis_conn),
+    }
+
+
+@APP.route('/stats/result/<stat>/<qeez_token>', methods=['GET'])
+def stats_result_get(qeez_token=None, stat=None):
+    '''GET view to get selected stat result
+
+    With `?since=<version>` the result is returned only if updated after that
+    version (`null` otherwise), along with its current version.
+    '''
+    if 'since' in request.args:
+        since = _since_arg()
+        if since is None:
+            return bad_request(None)
+        result, version = pull_stat_res_since(
+            stat, qeez_token, since,
+            redis_conn=get_read_redis('QUEUE_REDIS'))
+        return _json_response({
+            'error': False,
+            'result': result,
+            'version': version,
+        })
+    read_conn = get_read_redis('QUEUE_REDIS')
+    version = stat_res_version(stat, qeez_token, redis_conn=read_conn)
+    get_data = partial(
+        _stat_res_data, stat, qeez_token, get_queue_redis(), read_conn)
+    if not version:
+        return _json_response(get_data())
+    return _cached_json_response(
+        ('result', stat, qeez_token, version), get_data)
+
+
 @APP.route('/stats/results/<stat>', methods=['GET'])
 def stats_results_get(stat=None):
     '''GET view to get selected stat result
+
+    With `?since=<version>` only results updated after that version are
+    returned (as `{token, version, result}` entries), along with the
+    high-water version to poll with next time.
+    '''
+    if 'since' in request.args:
+        since = _since_arg()
+        if since is None:
+            return bad_request(None)
+        result, version = pull_stat_res_delta(
+            stat, since, redis_conn=get_read_redis('QUEUE_REDIS'))
+        return _json_response({
+            'error': False,
+            'result': result,
+            'version': version,
+        })
+    read_conn = get_read_redis('QUEUE_REDIS')
+    version = stat_res_version(stat, redis_conn=read_conn)
+    get_data = partial(_all_stat_res_data, stat, read_conn)
+    if not version:
+        return _json_response(get_data())
+    return _cached_json_response(('results', stat, version), get_data)
+
+
+@APP.route('/stats/leaderboard/<qeez_token>/<dim>', methods=['GET'])
+def stats_leaderboard_get(qeez_token=None, dim=None):
+    '''GET view to get top gamers (`gmr`) / teams (`tm`) by points
+
+    Optional `?count=` (default: 10) and `?rnd=` (round ID) arguments.
+    '''
+    if dim not in leaderboards.DIMS:
+        return not_found(None)
+    count = request.args.get('count', 10, type=int)
+    if not 0 < count <= CFG['LEADERBOARDS']['MAX_COUNT']:
+        return bad_request(None)
+    return _json_response({
+        'error': False,
+        'result': leaderboards.top(
+            qeez_token, dim, count=count, rnd=request.args.get('rnd'),
+            redis_conn=get_read_redis('STAT_REDIS')),
+    })
+
+
+@APP.route(
+    '/stats/leaderboard/<qeez_token>/<dim>/<member>', methods=['GET'])
+def stats_leaderboard_rank_get(qeez_token=None, dim=None, member=None):
+    '''GET view to get gamer's / team's rank and points
+
+    Optional `?rnd=` (round ID) argument.
+    '''
+    if dim not in leaderboards.DIMS:
+        return not_found(None)
+    return _json_response({
+        'error': False,
+        'result': leaderboards.rank(
+            qeez_token, dim, member, rnd=request.args.get('rnd'),
+            redis_conn=get_read_redis('STAT_REDIS')),
+    })
+
+
+@APP.route('/stats/quantiles', methods=['GET'])
+def stats_quantiles_get():
+    '''GET view to get answer time quantiles of (merged) tokens' sketches
+
+    Tokens are given by `?token=` (repeated), quantiles by `?q=` (repeated,
+    default: 0.5 and 0.9), optional `?question=` (`rnd:cat:stp`).
+    '''
+    qeez_tokens = request.args.getlist('token')
+    try:
+        qs = [float(_q) for _q in request.args.getlist('q')] or [0.5, 0.9]
+    except ValueError:
+        return bad_request(None)
+    if not 0 < len(qeez_tokens) <= CFG['SKETCHES']['MAX_TOKENS'] or \
+            not all(0.0 <= _q <= 1.0 for _q in qs):
+        return bad_request(None)
+    count, values = sketches.quantiles(
+        sketches.merged(
+            qeez_tokens, question=request.args.get('question'),
+            redis_conn=get_read_redis('STAT_REDIS')),
+        qs)
+    return _json_response({
+        'error': False,
+        'count': count,
+        'result': [
+            {'q': _q, 'ans_time': _val} for _q, _val in zip(qs, values)],
+    })
+
+
+@APP.route('/stats/distinct/<name>', methods=['GET'])
+def stats_distinct_get(name=None):
+    '''GET view to get approximate distinct count of (merged) tokens
+
+    Tokens are given by `?token=` (repeated), group (e.g. `rnd_id` value of
+    `gmr_rnd` count) by optional `?group=`.
+    '''
+    cfg = CFG['DISTINCT']
+    if name not in cfg['COUNTS']:
+        return not_found(None)
+    qeez_tokens = request.args.getlist('token')
+    if not 0 < len(qeez_tokens) <= cfg['MAX_TOKENS']:
+        return bad_request(None)
+    return _json_response({
+        'error': False,
+        'result': distinct.count(
+            qeez_tokens, name, group=request.args.get('group'),
+            redis_conn=get_read_redis('STAT_REDIS')),
+    })
+
+
+@APP.route('/stats/rollups/<res>', methods=['GET'])
+def stats_rollups_get(res=None):
+    '''GET view to get rollup time series of a resolution (`m` / `h`)
+
+    Range is given by `?start=` and `?end=` (epoch seconds, default: last 60
+    buckets).
+    '''
+    cfg = CFG['ROLLUPS']
+    if res not in cfg['RESOLUTIONS']:
+        return not_found(None)
+    step = cfg['RESOLUTIONS'][res]['STEP']
+    end = request.args.get('end', type=int)
+    if end is None:
+        end = int(time())
+    start = request.args.get('start', type=int)
+    if start is None:
+        start = end - 59 * step
+    if start > end or (end - start) // step >= cfg['MAX_BUCKETS']:
+        return bad_request(None)
+    return _json_response({
+        'error': False,
+        'step': step,
+        'result': rollups.query(
+            res, start, end, redis_conn=get_read_redis('STAT_REDIS')),
+    })
+
+
+@APP.route('/stats/export/<qeez_token>', methods=['GET'])
+def stats_export_get(qeez_token=None):
+    '''GET view to download token's packets as columnar .npz archive
+    '''
+    fobj = export.export_npz(
+        qeez_token, redis_conn=get_read_redis('STAT_REDIS'))
+    if fobj is None:
+        return not_found(None)
+    return send_file(
+        fobj, mimetype='application/octet-stream', as_attachment=True,
+        attachment_filename='%s.npz' % qeez_token)
+
+
+@APP.route('/stats/profile/<stat>/<qeez_token>', methods=['GET'])
+def stats_profile_get(stat=None, qeez_token=None):
+    '''GET view to get collapsed stacks of token's last profiled stat run
+    '''
+    collapsed = profiling.fetch(
+        stat, qeez_token, redis_conn=get_queue_redis())
+    if collapsed is None:
+        return not_found(None)
+    return APP.response_class(collapsed, mimetype='text/plain')
+
+
+@APP.route('/stats/supervisors', methods=['GET'])
+def stats_supervisors_get():
+    '''GET view to get states (pools, metrics) of running supervisors
+    '''
+    return _json_response({
+        'error': False,
+        'supervisors': supervisor.supervisors_state(
+            redis_conn=get_queue_redis()),
+    })
+
+
+@APP.before_request
+def start_metrics_flusher():
+    '''Starts (per process) flushing of counters to redis
+    '''
+    metrics.start_flusher(get_queue_redis, CFG['METRICS_FLUSH_INTERVAL'])
+
+
+@APP.route('/stats/metrics', methods=['GET'])
+def stats_metrics_get():
+    '''GET view to get service metrics: counters summed over all processes
+    (incl. recycled ones, up to their last flush, see `metrics`), gauges of
+    the process serving the request
     '''
-    result = pull_all_stat_res(stat, redis_conn=get_queue_redis())
+    redis_conn = get_queue_redis()
+    metrics.flush(redis_conn)
+    data = metrics.snapshot()
+    data['counters'] = metrics.shared_counters(redis_conn)
     return _json_response({
         'error': False,
-        'result': result,
+        'metrics': data,
     })
 
 
 if __name__ == '__main__':
-    prepare_env()
     APP.run(host=APP.config['HOST'], port=APP.config['PORT'])
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics host-local shared packets cache module
+
+Stat functions of co-located rq workers can share decoded packets:
+`retrieve_snapshot` returns a read-only, memory-mapped columnar snapshot of
+token's packets (columns as in `qeez_stats.export`), built once per packets
+version by the first worker needing it and mapped zero-copy by others.
+
+The cache is opt-in, per stat function - one calls it instead of
+`qeez_stats.utils.retrieve_decoded_packets`:
+
+    from qeez_stats.shmcache import retrieve_snapshot
+
+    def stat_fn(qeez_token):
+        snapshot = retrieve_snapshot(qeez_token)
+        return sum(snapshot.columns['points'])
+
+Snapshots are files in `CFG['SHM_CACHE']['DIR']` (tmpfs, `/dev/shm`, by
+default): `<token digest>-<packets version>.col`, written to a temporary
+file and renamed, so readers never see partial ones. A miss removes token's
+previous version only; the cache directory is scanned (at most once per
+`SCAN_INTERVAL` seconds, or sooner if this process' estimate of cache size
+crosses `MAX_BYTES`) to remove stale versions and least recently used
+snapshots (by mtime, touched on hit) above `MAX_BYTES`. Removing a file
+does not affect processes which mapped it already.
+'''
+
+import errno
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from array import array
+
+from qeez_stats import metrics
+from qeez_stats.config import CFG
+from qeez_stats.export import COLUMNS, FLOAT_COLUMNS
+from qeez_stats.utils import (
+    DEF_RST,
+    KEY_FIELDS,
+    PACKET_SEP,
+    Packet,
+    decode_raw_packet,
+    get_packets_redis,
+    packets_version,
+    retrieve_packets,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'QCOL'
+HEADER = struct.Struct('<4sQQ')
+SNAPSHOT_FMT = '%s-%d.col'
+ITEM_SIZE = 8
+RST = tuple(int(part) for part in DEF_RST.split(PACKET_SEP))
+
+STATE = {'bytes': 0, 'scanned_at': None}
+
+
+def _digest(qeez_token):
+    return hashlib.blake2b(
+        qeez_token.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def snapshot_path(qeez_token, version):
+    '''Returns path of token's snapshot of a packets version
+    '''
+    return os.path.join(
+        CFG['SHM_CACHE']['DIR'], SNAPSHOT_FMT % (_digest(qeez_token), version))
+
+
+class Snapshot(object):
+    '''Memory-mapped columnar snapshot of token's packets
+
+    `columns` maps column names to (native `q` / `d`) memoryviews over the
+    mapping; `answers` holds all packets' answers, split by `answers_len`.
+    '''
+
+    def __init__(self, fobj, version):
+        self.version = version
+        self.mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, answers = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError('Bad snapshot: %s' % fobj.name)
+        view = memoryview(self.mmap)
+        self.columns = {}
+        offset = HEADER.size
+        for name in COLUMNS:
+            size = (answers if name == 'answers' else self.count) * ITEM_SIZE
+            self.columns[name] = view[offset:offset + size].cast(
+                'd' if name in FLOAT_COLUMNS else 'q')
+            offset += size
+
+    def __len__(self):
+        return self.count
+
+    def packets(self):
+        '''Returns list of `Packet` instances (of valid packets)
+        '''
+        keys = list(zip(*[self.columns[name] for name in KEY_FIELDS]))
+        answers = self.columns['answers']
+        out = []
+        start = 0
+        for idx, length in enumerate(self.columns['answers_len']):
+            out.append(Packet(
+                keys[idx], tuple(answers[start:start + length]),
+                self.columns['ans_time'][idx], self.columns['points'][idx],
+                RST))
+            start += length
+        return out
+
+
+def _columns(raw_packets):
+    '''Returns columns (arrays) of decoded raw packets
+    '''
+    columns = dict(
+        (name, array('d' if name in FLOAT_COLUMNS else 'q'))
+        for name in COLUMNS)
+    for raw_packet in raw_packets.items():
+        packet = decode_raw_packet(raw_packet, compact=True)
+        if packet is None:
+            continue
+        for name in KEY_FIELDS + ('ans_time', 'points'):
+            columns[name].append(getattr(packet, name))
+        columns['answers_len'].append(len(packet.answers))
+        columns['answers'].extend(packet.answers)
+    return columns
+
+
+def _build(qeez_token, version, redis_conn):
+    '''Decodes token's packets into a new snapshot, returns it
+    '''
+    cache_dir = CFG['SHM_CACHE']['DIR']
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    columns = _columns(retrieve_packets(qeez_token, redis_conn=redis_conn))
+    fdesc, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fdesc, 'w+b') as fobj:
+        try:
+            fobj.write(HEADER.pack(
+                MAGIC, len(columns['points']), len(columns['answers'])))
+            for name in COLUMNS:
+                columns[name].tofile(fobj)
+            fobj.flush()
+            os.rename(tmp_path, snapshot_path(qeez_token, version))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return Snapshot(fobj, version)
+
+
+def evict(now=None):
+    '''Scans cache directory, removes snapshots of not current packets
+    versions, then least recently used ones above `MAX_BYTES`
+    '''
+    if now is None:
+        now = time.time()
+    latest = {}
+    entries = []
+    for path in glob.glob(os.path.join(CFG['SHM_CACHE']['DIR'], '*.col')):
+        try:
+            stat = os.stat(path)
+            digest, version = os.path.basename(path)[:-4].rsplit('-', 1)
+            version = int(version)
+        except (OSError, ValueError):
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        if version > latest.get(digest, (-1, None))[0]:
+            latest[digest] = (version, path)
+    current = set(path for _, path in latest.values())
+    total = 0
+    for entry in entries:
+        if entry[2] in current:
+            total += entry[1]
+        else:
+            _unlink(entry[2])
+    for _, size, path in sorted(
+            _entry for _entry in entries if _entry[2] in current):
+        if total <= CFG['SHM_CACHE']['MAX_BYTES']:
+            break
+        _unlink(path)
+        total -= size
+        metrics.incr('shm_cache.evicted')
+    STATE['bytes'] = total
+    STATE['scanned_at'] = now
+
+
+def _maybe_evict(added, now=None):
+    '''Accounts added bytes, runs `evict` if cache may be too big or was not
+    scanned for `SCAN_INTERVAL` seconds
+    '''
+    if now is None:
+        now = time.time()
+    STATE['bytes'] += added
+    if STATE['bytes'] > CFG['SHM_CACHE']['MAX_BYTES'] or \
+            STATE['scanned_at'] is None or \
+            now - STATE['scanned_at'] >= CFG['SHM_CACHE']['SCAN_INTERVAL']:
+        evict(now)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def retrieve_snapshot(qeez_token, redis_conn=None):
+    '''Returns snapshot of token's current packets version (mapping a cached
+    one, or building it)
+    '''
+    if redis_conn is None:
+        redis_conn = get_packets_redis()
+    version = packets_version(qeez_token, redis_conn=redis_conn)
+    path = snapshot_path(qeez_token, version)
+    try:
+        with open(path, 'rb') as fobj:
+            snapshot = Snapshot(fobj, version)
+    except (IOError, OSError) as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    else:
+        metrics.incr('shm_cache.hit')
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return snapshot
+
+    metrics.incr('shm_cache.miss')
+    snapshot = _build(qeez_token, version, redis_conn)
+    if not version:
+        # NOTE: unversioned packets are not cached
+        _unlink(path)
+        return snapshot
+    _unlink(snapshot_path(qeez_token, version - 1))
+    _maybe_evict(len(snapshot.mmap))
+    return snapshot
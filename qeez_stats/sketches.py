@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics answer time sketches module
+
+With `CFG['SKETCHES']['ENABLED']`, ingest keeps log-bucketed (HDR-style)
+histograms of packets' answer times per token (hash `_qs:<token>`) and per
+question (`_qs:<token>:<rnd_id>:<cat_id>:<stp_id>`). A bucket covers values
+within `ACCURACY` relative error, values are clamped to
+[`MIN_VALUE`, `MAX_VALUE`], so a sketch has a bounded number of fields.
+Sketches merge by adding bucket counts, so quantiles of many tokens
+(competition-wide views) need no packet decoding at all.
+
+Bucket counted for every packet is kept in `_qsidx:<token>` hash, so a
+resent packet moves its count instead of adding another one. Updates are
+atomic (a Lua script, or a retried WATCH transaction without scripting), so
+concurrent ingests of a token never lose counts.
+'''
+
+import logging
+import math
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import (
+    PACKET_SEP,
+    call_script,
+    get_redis,
+    register_lua,
+    to_str,
+    watch_transaction,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+SKETCH_ID_FMT = '_qs:%s'
+SKETCH_Q_ID_FMT = '_qs:%s:%s'
+SKETCH_IDX_ID_FMT = '_qsidx:%s'
+
+QUESTION_PARTS = slice(3, 6)
+
+# KEYS: buckets hash, token-wide sketch, question sketches
+# ARGV: expire, then per packet: field, bucket index, question sketch's
+#   KEYS index
+UPDATE_LUA = '''
+local touched = {}
+for idx = 2, #ARGV, 3 do
+    local old = redis.call('HGET', KEYS[1], ARGV[idx])
+    if old ~= ARGV[idx + 1] then
+        redis.call('HSET', KEYS[1], ARGV[idx], ARGV[idx + 1])
+        for _, key in ipairs({2, tonumber(ARGV[idx + 2])}) do
+            if old then
+                redis.call('HINCRBY', KEYS[key], old, -1)
+            end
+            redis.call('HINCRBY', KEYS[key], ARGV[idx + 1], 1)
+            touched[key] = true
+        end
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+for key = 2, #KEYS do
+    if touched[key] then
+        redis.call('EXPIRE', KEYS[key], ARGV[1])
+    end
+end
+'''
+
+register_lua('sketches', UPDATE_LUA)
+
+
+def sketch_id(qeez_token, question=None):
+    '''Returns sketch's key (token-wide or of a `rnd:cat:stp` question)
+    '''
+    if question is None:
+        return SKETCH_ID_FMT % qeez_token
+    return SKETCH_Q_ID_FMT % (qeez_token, question)
+
+
+def _gamma():
+    accuracy = CFG['SKETCHES']['ACCURACY']
+    return (1.0 + accuracy) / (1.0 - accuracy)
+
+
+def bucket_index(value, gamma=None):
+    '''Returns bucket's index of a (clamped) value
+    '''
+    cfg = CFG['SKETCHES']
+    value = min(max(value, cfg['MIN_VALUE']), cfg['MAX_VALUE'])
+    return int(math.ceil(math.log(value, gamma or _gamma())))
+
+
+def bucket_value(index, gamma=None):
+    '''Returns representative value of a bucket
+    '''
+    gamma = gamma or _gamma()
+    return 2.0 * gamma ** index / (gamma + 1.0)
+
+
+def _packet_buckets(res_dc):
+    '''Returns {packet key: (question, bucket index)}
+    '''
+    gamma = _gamma()
+    out = {}
+    for key, val in res_dc.items():
+        if isinstance(val, tuple):
+            val = val[0]
+        key = to_str(key)
+        try:
+            out[key] = (
+                PACKET_SEP.join(key.split(PACKET_SEP)[QUESTION_PARTS]),
+                bucket_index(float(to_str(val).split(PACKET_SEP)[1]), gamma))
+        except (IndexError, ValueError):
+            LOG.warning('Bad val: %s', repr(val))
+    return out
+
+
+def update(qeez_token, res_dc, redis_conn=None):
+    '''Adds packets' answer times to token's sketches atomically (with
+    `UPDATE_LUA`, or a WATCH/MULTI/EXEC transaction retried until it
+    succeeds)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    buckets = _packet_buckets(res_dc)
+    if not buckets:
+        return
+    idx_id = SKETCH_IDX_ID_FMT % qeez_token
+    fields = sorted(buckets)
+    expire = CFG['SKETCHES']['EXPIRE']
+    keys = [idx_id, sketch_id(qeez_token)]
+    args = [expire]
+    for field in fields:
+        question, index = buckets[field]
+        sk_id = sketch_id(qeez_token, question)
+        if sk_id not in keys:
+            keys.append(sk_id)
+        args.extend((field, index, keys.index(sk_id) + 1))
+
+    def _update(pipe):
+        olds = pipe.hmget(idx_id, fields)
+        pipe.multi()
+        touched = set([idx_id])
+        for field, old in zip(fields, olds):
+            question, index = buckets[field]
+            if old is not None and int(old) == index:
+                continue
+            pipe.hset(idx_id, field, index)
+            for sk_id in (
+                    sketch_id(qeez_token),
+                    sketch_id(qeez_token, question)):
+                if old is not None:
+                    pipe.hincrby(sk_id, int(old), -1)
+                pipe.hincrby(sk_id, index, 1)
+                touched.add(sk_id)
+        for key in touched:
+            pipe.expire(key, expire)
+
+    call_script(
+        'sketches', keys, args, redis_conn,
+        lambda: watch_transaction(redis_conn, _update, idx_id))
+
+
+def merged(qeez_tokens, question=None, redis_conn=None):
+    '''Returns {bucket index: count} of tokens' sketches merged
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    pipe = redis_conn.pipeline(transaction=False)
+    for qeez_token in qeez_tokens:
+        pipe.hgetall(sketch_id(qeez_token, question))
+    counts = {}
+    for sketch in pipe.execute():
+        for index, count in sketch.items():
+            index = int(index)
+            counts[index] = counts.get(index, 0) + int(count)
+    return counts
+
+
+def quantiles(counts, qs):
+    '''Returns (total count, [values of quantiles]) of a sketch
+    '''
+    gamma = _gamma()
+    items = sorted(
+        (index, count) for index, count in counts.items() if count > 0)
+    total = sum(count for _, count in items)
+    out = []
+    for quantile in qs:
+        if not total:
+            out.append(None)
+            continue
+        rank = quantile * (total - 1)
+        seen = 0
+        for index, count in items:
+            seen += count
+            if seen > rank:
+                break
+        out.append(bucket_value(index, gamma))
+    return total, out
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics write-ahead spool module
+
+With `CFG['SPOOL']['ENABLED']`, ingest requests are acknowledged right after
+being appended to a local, memory-mapped segment file (one per process,
+`<DIR>/spool-<pid>.seg`); a background drainer thread replays spooled
+records to redis in large batches, so ingest latency does not depend on
+redis hiccups (BGSAVE forks, failovers). If the segment is full, requests
+are rejected (HTTP 503), so they are never written to redis before older,
+still spooled ones.
+
+Segment layout: header (magic, write offset, read offset), then a ring
+buffer of records: length, CRC32 and JSON payload. Offsets grow
+monotonically and wrap around the ring (a record not fitting before the end
+is preceded by a wrap marker), so space is reused as soon as records are
+replayed, also under steady load. A segment left by a dead process (it is
+not `flock`-ed anymore) is replayed and removed by drainers (checked every
+`RECOVER_INTERVAL` seconds); exiting prefork workers drain their own
+segments first (see `close_spool`). Replay is at-least-once: a batch
+failing half-way is replayed again.
+'''
+
+import errno
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from zlib import crc32
+
+from redis.exceptions import RedisError
+
+from qeez_stats import metrics
+from qeez_stats.config import CFG
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'QSPL'
+HEADER = struct.Struct('<4sQQ')
+RECORD = struct.Struct('<II')
+WRAP = 0xffffffff
+SEGMENT_FMT = 'spool-%d.seg'
+SEGMENT_GLOB = 'spool-*.seg'
+
+SPOOLS = {}
+SPOOLS_LOCK = threading.Lock()
+
+
+def _encode(record):
+    payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    return RECORD.pack(len(payload), crc32(payload) & 0xffffffff) + payload
+
+
+def _decode(payload):
+    '''Returns (token, atime, packets dict, stat) record
+    '''
+    qeez_token, atime, res_dc, stat = json.loads(payload.decode('utf-8'))
+    res_dc = dict(
+        (_key, tuple(_val) if isinstance(_val, list) else _val)
+        for _key, _val in res_dc.items())
+    return qeez_token, atime, res_dc, stat
+
+
+def _pid_alive(path):
+    '''Tests if process owning segment file (by its name) is alive
+    '''
+    try:
+        pid = int(os.path.basename(path)[6:-4])
+        os.kill(pid, 0)
+    except ValueError:
+        return False
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+class Segment(object):
+    '''Memory-mapped ring buffer spool segment file (locked by its owner)
+    '''
+
+    def __init__(self, path, size=None, blocking=True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fobj = open(path, 'a+b')
+        try:
+            fcntl.flock(
+                self.fobj,
+                fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            self.fobj.close()
+            raise
+        self.fobj.seek(0, os.SEEK_END)
+        if self.fobj.tell() == 0:
+            self.fobj.truncate(size or CFG['SPOOL']['SEGMENT_SIZE'])
+        self.mmap = mmap.mmap(self.fobj.fileno(), 0)
+        self.capacity = len(self.mmap) - HEADER.size
+        magic, self.write_off, self.read_off = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self._set_offsets(HEADER.size, HEADER.size)
+
+    def _set_offsets(self, write_off, read_off):
+        self.write_off, self.read_off = write_off, read_off
+        HEADER.pack_into(self.mmap, 0, MAGIC, write_off, read_off)
+
+    def _position(self, offset):
+        '''Returns (mmap position, bytes to ring's end) of an offset
+        '''
+        pos = HEADER.size + (offset - HEADER.size) % self.capacity
+        return pos, len(self.mmap) - pos
+
+    def append(self, record):
+        '''Appends record, returns False if segment is full
+        '''
+        data = _encode(record)
+        with self.lock:
+            if self.read_off == self.write_off:
+                self._set_offsets(HEADER.size, HEADER.size)
+            pos, tail = self._position(self.write_off)
+            pad = tail if tail < len(data) else 0
+            used = self.write_off - self.read_off
+            if used + pad + len(data) > self.capacity:
+                return False
+            if pad:
+                if pad >= RECORD.size:
+                    RECORD.pack_into(self.mmap, pos, WRAP, 0)
+                pos = HEADER.size
+            self.mmap[pos:pos + len(data)] = data
+            self._set_offsets(
+                self.write_off + pad + len(data), self.read_off)
+        if CFG['SPOOL']['FSYNC']:
+            self.mmap.flush()
+        return True
+
+    def pending(self, limit):
+        '''Returns (records, start offset, offset after them) of up to `limit`
+        records not replayed yet
+        '''
+        with self.lock:
+            start, write_off = self.read_off, self.write_off
+        offset = start
+        records = []
+        while offset < write_off and len(records) < limit:
+            pos, tail = self._position(offset)
+            if tail < RECORD.size:
+                offset += tail
+                continue
+            length, checksum = RECORD.unpack_from(self.mmap, pos)
+            if length == WRAP:
+                offset += tail
+                continue
+            payload = self.mmap[pos + RECORD.size:pos + RECORD.size + length]
+            offset += RECORD.size + length
+            if crc32(payload) & 0xffffffff != checksum:
+                LOG.error('%s: corrupted record skipped', self.path)
+                metrics.incr('spool.corrupted')
+                continue
+            records.append(_decode(payload))
+        return records, start, offset
+
+    def commit(self, offset):
+        '''Marks records up to offset as replayed (only the drainer moves the
+        read offset, appends reset offsets only when nothing is pending)
+        '''
+        with self.lock:
+            if offset >= self.write_off:
+                self._set_offsets(HEADER.size, HEADER.size)
+            else:
+                self._set_offsets(self.write_off, offset)
+
+    def is_empty(self):
+        '''Tests if all records were replayed
+        '''
+        return self.read_off == self.write_off
+
+    def close(self, remove=False):
+        '''Unmaps and unlocks segment (and removes it)
+        '''
+        self.mmap.close()
+        if remove:
+            os.unlink(self.path)
+        self.fobj.close()
+
+
+class Spool(object):
+    '''Process' spool segment with its drainer thread
+
+    `handler` gets lists of (token, atime, packets dict, stat) records and
+    replays them.
+    '''
+
+    def __init__(self, handler, spool_dir=None):
+        self.handler = handler
+        self.dir = spool_dir or CFG['SPOOL']['DIR']
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self.segment = Segment(
+            os.path.join(self.dir, SEGMENT_FMT % os.getpid()))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def append(self, qeez_token, atime, res_dc, stat=None):
+        '''Spools ingest request, returns False if spool is full
+        '''
+        if self.segment.append((qeez_token, atime, res_dc, stat)):
+            metrics.incr('spool.appended')
+            return True
+        metrics.incr('spool.full')
+        return False
+
+    def drain_segment(self, segment):
+        '''Replays segment's pending records in batches, returns their number
+        '''
+        count = 0
+        while True:
+            records, start, offset = segment.pending(CFG['SPOOL']['BATCH'])
+            if offset == start:
+                return count
+            if records:
+                self.handler(records)
+                count += len(records)
+            segment.commit(offset)
+
+    def drain_once(self):
+        '''Replays all pending records, returns their number
+        '''
+        count = self.drain_segment(self.segment)
+        if count:
+            metrics.incr('spool.replayed', count)
+        return count
+
+    def recover(self):
+        '''Replays and removes segments left by dead processes
+        '''
+        count = 0
+        for path in glob.glob(os.path.join(self.dir, SEGMENT_GLOB)):
+            if path == self.segment.path or _pid_alive(path):
+                continue
+            try:
+                segment = Segment(path, blocking=False)
+            except IOError:
+                continue
+            try:
+                count += self.drain_segment(segment)
+            finally:
+                segment.close(remove=segment.is_empty())
+        return count
+
+    def run(self):
+        '''Drainer loop
+        '''
+        recovered_at = None
+        while not self.stopped.is_set():
+            try:
+                now = time.time()
+                if recovered_at is None or \
+                        now - recovered_at >= CFG['SPOOL']['RECOVER_INTERVAL']:
+                    self.recover()
+                    recovered_at = now
+                if not self.drain_once():
+                    self.stopped.wait(CFG['SPOOL']['INTERVAL'])
+            except RedisError as exc:
+                LOG.warning('Spool not drained: %s', repr(exc))
+                metrics.incr('spool.errors')
+                self.stopped.wait(CFG['SPOOL']['RETRY'])
+            except Exception as exc:
+                LOG.exception('Spool drainer failed: %s', repr(exc))
+                self.stopped.wait(CFG['SPOOL']['RETRY'])
+
+    def start(self):
+        '''Starts drainer thread
+        '''
+        self.thread = threading.Thread(
+            target=self.run, name='spool-drainer', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        '''Stops drainer thread
+        '''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+def get_spool(handler):
+    '''Returns this process' spool (with running drainer)
+    '''
+    pid = os.getpid()
+    if pid not in SPOOLS:
+        with SPOOLS_LOCK:
+            if pid not in SPOOLS:
+                spool = Spool(handler)
+                spool.start()
+                SPOOLS[pid] = spool
+    return SPOOLS[pid]
+
+
+def close_spool(timeout=None):
+    '''Stops this process' drainer, replays what is left and removes the
+    (drained) segment, returns number of replayed records
+    '''
+    spool = SPOOLS.pop(os.getpid(), None)
+    if spool is None:
+        return 0
+    spool.stop(timeout)
+    try:
+        count = spool.drain_once()
+    finally:
+        spool.segment.close(remove=spool.segment.is_empty())
+    return count
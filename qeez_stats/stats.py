@@ -4,18 +4,178 @@
 '''
 
 import logging
+import time
 
+from redis.exceptions import WatchError
+from rq import get_current_job
+
+from qeez_stats import metrics, profiling
+from qeez_stats.config import CFG
+from qeez_stats.serializers import dumps_result, loads_result
 from qeez_stats.utils import (
-    retrieve_set,
-    update_set,
+    get_method_by_path,
+    get_packets_redis,
+    get_redis,
+    packets_version,
+    to_str,
+    update_retrieve_set,
 )
 
 
 LOG = logging.getLogger(__name__)
 
+RES_ID_FMT = '_res:%s'
+RES_VER_ID_FMT = '_resver:%s'
+RES_IDX_ID_FMT = '_residx:%s'
+RES_MEMO_ID_FMT = '_resmemo:%s'
+RES_TIME_ID_FMT = '_restime:%s'
+RES_EXPIRE = 24 * 3600
+RES_PRUNE_BATCH = 100
+BATCH_ID_FMT = '_batch:%s'
+CALC_EXTRA_ID_FMT = '_calcx:%s'
+CALC_EXTRA_BATCH_FMT = 'batch:%s'
+CALC_EXTRA_TTL = 7200
+
 
 def stat_collector(stat, stat_token, **_):
     '''Collects stat usage
     '''
-    update_set(stat, stat_token)
-    return retrieve_set(stat)
+    return update_retrieve_set(stat, stat_token)
+
+
+def store_result(stat, qeez_token, res, redis_conn, packets_ver=None):
+    '''Stores token's stat result (in `_res:<stat>` hash) with next
+    monotonic version of stat (and packets version it was calculated of, in
+    `_resmemo:<stat>` hash), returns the version
+
+    The version is taken and the result stored in one WATCH-ed transaction,
+    so versions are committed in order (see `pull_stat_res_delta`). Store
+    times are kept in `_restime:<stat>` sorted set and results not stored
+    again for `RES_EXPIRE` seconds are pruned in the same transaction (up to
+    `RES_PRUNE_BATCH` of them per store).
+    '''
+    blob = dumps_result(res)
+    ver_id = RES_VER_ID_FMT % stat
+    keys = (
+        RES_ID_FMT % stat, RES_IDX_ID_FMT % stat, RES_MEMO_ID_FMT % stat,
+        RES_TIME_ID_FMT % stat)
+    now = time.time()
+    with redis_conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(ver_id)
+                version = int(pipe.get(ver_id) or 0) + 1
+                expired = [
+                    _token for _token in pipe.zrangebyscore(
+                        keys[3], '-inf', now - RES_EXPIRE, start=0,
+                        num=RES_PRUNE_BATCH)
+                    if to_str(_token) != qeez_token]
+                pipe.multi()
+                pipe.set(ver_id, version)
+                if expired:
+                    pipe.hdel(keys[0], *expired)
+                    pipe.zrem(keys[1], *expired)
+                    pipe.hdel(keys[2], *expired)
+                    pipe.zrem(keys[3], *expired)
+                pipe.hset(keys[0], qeez_token, blob)
+                pipe.zadd(keys[1], {qeez_token: version})
+                pipe.zadd(keys[3], {qeez_token: now})
+                if packets_ver:
+                    pipe.hset(keys[2], qeez_token, packets_ver)
+                else:
+                    pipe.hdel(keys[2], qeez_token)
+                for key in keys:
+                    pipe.expire(key, RES_EXPIRE)
+                pipe.execute()
+                return version
+            except WatchError:
+                continue
+
+
+def memoized_result(stat, qeez_token, packets_ver, redis_conn):
+    '''Returns (True, stored result) if it was calculated of the same
+    packets version, (False, None) otherwise
+    '''
+    if not packets_ver:
+        return False, None
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hget(RES_MEMO_ID_FMT % stat, qeez_token)
+    pipe.hget(RES_ID_FMT % stat, qeez_token)
+    memo_ver, blob = pipe.execute()
+    if blob is None or memo_ver is None or int(memo_ver) != packets_ver:
+        return False, None
+    return True, loads_result(blob)
+
+
+def pop_calc_extras(job_id, redis_conn):
+    '''Returns (and removes) options added to a pending calc job by
+    requests coalesced into it (see `queues.enqueue_stat_calc`)
+    '''
+    key = CALC_EXTRA_ID_FMT % job_id
+    pipe = redis_conn.pipeline()
+    pipe.hgetall(key)
+    pipe.delete(key)
+    data, _ = pipe.execute()
+    return dict((to_str(_key), int(_val)) for _key, _val in data.items())
+
+
+def _count_batches(batches, name, redis_conn):
+    '''Increments batches' counter by number of their tokens
+    '''
+    if not batches:
+        return
+    pipe = redis_conn.pipeline(transaction=False)
+    for batch, count in batches.items():
+        pipe.hincrby(BATCH_ID_FMT % batch, name, count)
+    pipe.execute()
+
+
+def run_stat(stat, qeez_token, profile=False, batch=None, force=False, **_):
+    '''Calculates stat for token and stores its result (and collapsed
+    stacks if profiled), counts it as `done` / `failed` in its batch (and
+    batches of requests coalesced into the job)
+
+    With `CALC_MEMOIZE`, unless `force`-d (or profiled), calculation is
+    skipped if token's packets did not change since the stored result.
+    '''
+    batches = {}
+    if batch is not None:
+        batches[batch] = 1
+    job = get_current_job()
+    if job is not None:
+        redis_conn = job.connection
+        extras = pop_calc_extras(job.id, redis_conn)
+        force = force or bool(extras.pop('force', 0))
+        profile = profile or bool(extras.pop('profile', 0))
+        prefix = CALC_EXTRA_BATCH_FMT % ''
+        for name, count in extras.items():
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+                batches[name] = batches.get(name, 0) + count
+    else:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    try:
+        function = get_method_by_path(stat)
+        if not function:
+            raise ValueError('No stat function: %s' % stat)
+        packets_ver = packets_version(
+            qeez_token, redis_conn=get_packets_redis())
+        hit, res = False, None
+        if CFG['CALC_MEMOIZE'] and not (force or profile):
+            hit, res = memoized_result(
+                stat, qeez_token, packets_ver, redis_conn)
+        if hit:
+            metrics.incr('calc.memoized')
+        elif profile or profiling.sampled():
+            with profiling.StackSampler() as sampler:
+                res = function(qeez_token)
+            profiling.store(stat, qeez_token, sampler.collapsed(), redis_conn)
+        else:
+            res = function(qeez_token)
+        if not hit:
+            store_result(stat, qeez_token, res, redis_conn, packets_ver)
+    except Exception:
+        _count_batches(batches, 'failed', redis_conn)
+        raise
+    _count_batches(batches, 'done', redis_conn)
+    return res
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics save stream module
+
+Alternative `save` transport (`SAVE_BACKEND='stream'`): raw packets are
+XADD-ed to a capped Redis stream and consumed in batches by save workers
+forming a consumer group. Entries of dead consumers are reclaimed after
+`SAVE_STREAM_CLAIM_IDLE` ms.
+
+* save worker:
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.streams \
+    --consumer my-worker-nr-x
+* stream monitor:
+$ redis-cli -s /tmp/redis.sock -n 2 xinfo groups _save_stream
+'''
+
+import argparse
+import calendar
+import json
+import logging
+import time
+
+from redis.exceptions import ResponseError
+
+from qeez_stats.config import CFG
+from qeez_stats.utils import get_method_by_path, get_redis, to_str
+
+
+LOG = logging.getLogger(__name__)
+
+SAVE_STREAM_ID = '_save_stream'
+SAVE_GROUP = 'save'
+MAX_DELIVERIES = 5
+
+
+def _encode_entry(qeez_token, res_dc, atime):
+    '''Returns stream entry fields for a save request
+    '''
+    return {
+        'token': qeez_token,
+        'atime': calendar.timegm(atime),
+        'data': json.dumps(res_dc, separators=(',', ':')),
+    }
+
+
+def _decode_entry(fields):
+    '''Returns (qeez_token, atime, res_dc) tuple for stream entry fields
+    '''
+    res_dc = {}
+    for _key, _val in json.loads(to_str(fields[b'data'])).items():
+        res_dc[_key] = tuple(_val) if isinstance(_val, list) else _val
+    return (
+        to_str(fields[b'token']), time.gmtime(int(fields[b'atime'])), res_dc)
+
+
+def stream_stat_save(qeez_token, res_dc, atime=None, redis_conn=None):
+    '''Appends stat to save stream, returns entry ID
+    '''
+    if atime is None:
+        atime = time.gmtime()
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['SAVE_REDIS'])
+    return redis_conn.xadd(
+        SAVE_STREAM_ID, _encode_entry(qeez_token, res_dc, atime),
+        maxlen=CFG['SAVE_STREAM_MAXLEN'], approximate=True)
+
+
+def _entry_age(entry_id, now):
+    '''Returns age (in seconds) of stream entry by its ID
+    '''
+    return max(now - int(to_str(entry_id).split('-', 1)[0]) / 1000.0, 0.0)
+
+
+def stream_backlog(redis_conn, group=SAVE_GROUP, now=None):
+    '''Returns (not acknowledged entries, oldest one's age in seconds) of
+    save stream's consumer group: pending entries and ones not delivered
+    yet (group's lag, whole stream's length on servers not reporting it)
+    '''
+    if now is None:
+        now = time.time()
+    try:
+        groups = redis_conn.xinfo_groups(SAVE_STREAM_ID)
+    except ResponseError:
+        # NOTE: no stream yet
+        return 0, 0.0
+    info = None
+    for _info in groups:
+        if to_str(_info['name']) == group:
+            info = _info
+    if info is None:
+        length = redis_conn.xlen(SAVE_STREAM_ID)
+        oldest = redis_conn.xrange(SAVE_STREAM_ID, count=1)
+        return length, _entry_age(oldest[0][0], now) if oldest else 0.0
+    pending = redis_conn.xpending(SAVE_STREAM_ID, group)
+    lag = info.get('lag')
+    if lag is None:
+        lag = redis_conn.xlen(SAVE_STREAM_ID)
+    if pending['pending']:
+        return pending['pending'] + lag, _entry_age(pending['min'], now)
+    undelivered = redis_conn.xrange(
+        SAVE_STREAM_ID, min='(' + to_str(info['last-delivered-id']), count=1)
+    if not undelivered:
+        return 0, 0.0
+    return lag, _entry_age(undelivered[0][0], now)
+
+
+def ensure_group(redis_conn, group=SAVE_GROUP):
+    '''Creates consumer group (and stream) if needed
+    '''
+    try:
+        redis_conn.xgroup_create(SAVE_STREAM_ID, group, id='0', mkstream=True)
+    except ResponseError as exc:
+        if 'BUSYGROUP' not in str(exc):
+            raise
+        return False
+    return True
+
+
+def process_entries(entries, redis_conn, group=SAVE_GROUP):
+    '''Saves stream entries, acks saved ones, returns (saved, failed) counts
+    '''
+    function = get_method_by_path(CFG['STAT_SAVE_FN'])
+    if not function:
+        LOG.error('No save function: %s', CFG['STAT_SAVE_FN'])
+        return 0, len(entries)
+
+    done_ids = []
+    for entry_id, fields in entries:
+        try:
+            qeez_token, atime, res_dc = _decode_entry(fields)
+        except (KeyError, ValueError) as exc:
+            LOG.error('Bad entry %s: %s', repr(entry_id), repr(exc))
+            done_ids.append(entry_id)
+            continue
+        try:
+            function(qeez_token, atime, res_dc)
+        except Exception as exc:
+            if CFG['RAVEN_CLI']:
+                CFG['RAVEN_CLI'].user_context({
+                    'res_dc': res_dc,
+                })
+                CFG['RAVEN_CLI'].captureException()
+            LOG.exception('%s @ %s', repr(exc), repr(res_dc))
+            continue
+        done_ids.append(entry_id)
+
+    if done_ids:
+        redis_conn.xack(SAVE_STREAM_ID, group, *done_ids)
+    return len(done_ids), len(entries) - len(done_ids)
+
+
+def claim_pending(consumer, redis_conn, group=SAVE_GROUP, count=100,
+                  min_idle=None):
+    '''Claims entries pending too long (dead or failing consumers)
+    '''
+    if min_idle is None:
+        min_idle = CFG['SAVE_STREAM_CLAIM_IDLE']
+    pending = redis_conn.xpending_range(
+        SAVE_STREAM_ID, group, '-', '+', count)
+    claim_ids, drop_ids = [], []
+    for item in pending:
+        if item.get('time_since_delivered', min_idle) < min_idle:
+            continue
+        if item.get('times_delivered', 1) > MAX_DELIVERIES:
+            drop_ids.append(item['message_id'])
+        else:
+            claim_ids.append(item['message_id'])
+
+    if drop_ids:
+        LOG.error('Dropping undeliverable entries: %s', repr(drop_ids))
+        redis_conn.xack(SAVE_STREAM_ID, group, *drop_ids)
+    if not claim_ids:
+        return []
+    return [
+        (entry_id, fields) for entry_id, fields in redis_conn.xclaim(
+            SAVE_STREAM_ID, group, consumer, min_idle, claim_ids)
+        if fields]
+
+
+def consume_stat_saves(consumer, redis_conn=None, group=SAVE_GROUP,
+                       count=100, block=1000, claim=True):
+    '''Processes one batch of (reclaimed or new) entries, returns count
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['SAVE_REDIS'])
+    entries = []
+    if claim:
+        entries = claim_pending(
+            consumer, redis_conn, group=group, count=count)
+    if not entries:
+        res = redis_conn.xreadgroup(
+            group, consumer, {SAVE_STREAM_ID: '>'}, count=count,
+            block=block)
+        entries = res[0][1] if res else []
+    if not entries:
+        return 0
+    saved, failed = process_entries(entries, redis_conn, group=group)
+    return saved + failed
+
+
+def run_save_worker(consumer, redis_conn=None, group=SAVE_GROUP, count=100,
+                    block=1000, burst=False):
+    '''Runs save worker loop, returns number of processed entries
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['SAVE_REDIS'])
+    ensure_group(redis_conn, group=group)
+    claim_interval = CFG['SAVE_STREAM_CLAIM_IDLE'] / 1000.0
+    total, last_claim = 0, 0
+    while True:
+        claim = time.time() - last_claim >= claim_interval
+        if claim:
+            last_claim = time.time()
+        done = consume_stat_saves(
+            consumer, redis_conn=redis_conn, group=group, count=count,
+            block=None if burst else block, claim=claim)
+        total += done
+        if burst and not done:
+            return total
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description='Qeez stats save worker')
+    parser.add_argument('--consumer', required=True)
+    parser.add_argument('--group', default=SAVE_GROUP)
+    parser.add_argument('--count', type=int, default=100,
+                        help='entries per batch')
+    parser.add_argument('--block', type=int, default=1000,
+                        help='max ms to wait for new entries')
+    parser.add_argument('--burst', action='store_true',
+                        help='quit when the stream is drained')
+    args = parser.parse_args(argv)
+    run_save_worker(
+        args.consumer, group=args.group, count=args.count, block=args.block,
+        burst=args.burst)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics workers supervisor module
+
+Keeps between `MIN` and `MAX` local rq worker processes per pool (see
+`CFG['SUPERVISOR']['POOLS']`), scaling them by length and oldest job age
+of pool's queues (sampled like `admission` does):
+
+* a worker is spawned after `UP_CHECKS` consecutive samples reaching
+  `UP_LEN` or `UP_AGE`,
+* the newest worker is retired (SIGTERM - rq finishes its current job
+  first) after `DOWN_CHECKS` consecutive samples within `DOWN_LEN` and
+  `DOWN_AGE`; it is kept as draining (and reaped) until it exits,
+* samples in between reset both streaks (hysteresis).
+
+Decisions are counted as `supervisor.<pool>.up` / `.down` metrics, pool
+sizes and samples are gauges. Supervisor's state and metrics are published
+to `_supervisor:<host>:<pid>` (see `/stats/supervisors`) every `INTERVAL`;
+`<host>:<pid>` is registered in the `_supervisors` ZSET scored by publish
+time, so states are read without scanning the keyspace.
+
+NOTE: with `SAVE_BACKEND='stream'`, save workers are not rq ones - leave the
+`save` pool out and run `qeez_stats.streams` workers instead.
+
+$ REDIS_SOCKET=/tmp/redis.sock python -m qeez_stats.supervisor
+'''
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from qeez_stats import metrics
+from qeez_stats.admission import sample_queue
+from qeez_stats.config import CFG
+from qeez_stats.serializers import get_job_class
+from qeez_stats.utils import get_redis, to_str
+
+
+LOG = logging.getLogger(__name__)
+
+STATE_ID_FMT = '_supervisor:%s'
+REGISTRY_ID = '_supervisors'
+
+UP = 1
+HOLD = 0
+DOWN = -1
+
+
+def redis_url(redis_cfg):
+    '''Returns redis URL of a config (for rq command line)
+    '''
+    return 'unix://%s?db=%d' % (redis_cfg['SOCKET'], redis_cfg['DB'])
+
+
+def worker_command(pool_cfg):
+    '''Returns worker process command of a pool
+    '''
+    if pool_cfg.get('COMMAND'):
+        return list(pool_cfg['COMMAND'])
+    job_class = get_job_class()
+    return [
+        'rq', 'worker', '--url', redis_url(CFG[pool_cfg['REDIS']]),
+        '--worker-class', pool_cfg['WORKER_CLASS'],
+        '--job-class', '%s.%s' % (job_class.__module__, job_class.__name__),
+    ] + list(pool_cfg['QUEUES'])
+
+
+class Scaler(object):
+    '''Hysteresis scaling decisions of a pool
+    '''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.up_streak = 0
+        self.down_streak = 0
+
+    def decide(self, length, age, workers):
+        '''Returns `UP`, `HOLD` or `DOWN` decision for a sample
+        '''
+        cfg = self.cfg
+        if workers < cfg['MIN']:
+            return UP
+        if workers > cfg['MAX']:
+            return DOWN
+        if (cfg['UP_LEN'] and length >= cfg['UP_LEN']) or \
+                (cfg['UP_AGE'] and age >= cfg['UP_AGE']):
+            self.up_streak += 1
+            self.down_streak = 0
+        elif length <= cfg['DOWN_LEN'] and age <= cfg['DOWN_AGE']:
+            self.down_streak += 1
+            self.up_streak = 0
+        else:
+            self.up_streak = self.down_streak = 0
+        if self.up_streak >= cfg['UP_CHECKS'] and workers < cfg['MAX']:
+            self.up_streak = 0
+            return UP
+        if self.down_streak >= cfg['DOWN_CHECKS'] and workers > cfg['MIN']:
+            self.down_streak = 0
+            return DOWN
+        return HOLD
+
+
+class Supervisor(object):
+    '''Local worker pools scaled by their queues' state
+
+    `redis_conn` (if given) is used for all pools, `spawn(pool, cfg)`
+    returns a new `subprocess.Popen`-like worker process.
+    '''
+
+    def __init__(self, pools=None, redis_conn=None, spawn=None):
+        self.pools = pools or CFG['SUPERVISOR']['POOLS']
+        self.redis_conn = redis_conn
+        self.spawn = spawn or self._spawn
+        self.scalers = dict(
+            (name, Scaler(cfg)) for name, cfg in self.pools.items())
+        self.procs = dict((name, []) for name in self.pools)
+        self.draining = dict((name, []) for name in self.pools)
+        self.samples = {}
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def _spawn(_, cfg):
+        return subprocess.Popen(worker_command(cfg))
+
+    def _redis(self, cfg):
+        if self.redis_conn is not None:
+            return self.redis_conn
+        return get_redis(CFG[cfg['REDIS']])
+
+    def sample(self, name):
+        '''Returns (total length, oldest job age) of pool's queues
+        '''
+        cfg = self.pools[name]
+        redis_conn = self._redis(cfg)
+        length, age = 0, 0.0
+        for queue in cfg['QUEUES']:
+            _length, _age = sample_queue(queue, redis_conn)
+            length += _length
+            age = max(age, _age)
+        return length, age
+
+    def reap(self, name):
+        '''Forgets exited (and reaps retired) worker processes of a pool
+        '''
+        alive = []
+        for proc in self.procs[name]:
+            if proc.poll() is None:
+                alive.append(proc)
+            else:
+                LOG.warning('%s worker %d exited: %s',
+                            name, proc.pid, proc.returncode)
+                metrics.incr('supervisor.%s.exited' % name)
+        self.procs[name] = alive
+        draining = []
+        for proc in self.draining[name]:
+            if proc.poll() is None:
+                draining.append(proc)
+            else:
+                LOG.info('%s: retired worker %d exited: %s',
+                         name, proc.pid, proc.returncode)
+        self.draining[name] = draining
+
+    def scale(self, name, decision):
+        '''Applies scaling decision to a pool
+        '''
+        procs = self.procs[name]
+        if decision == UP:
+            procs.append(self.spawn(name, self.pools[name]))
+            LOG.info('%s: worker %d spawned', name, procs[-1].pid)
+            metrics.incr('supervisor.%s.up' % name)
+        elif decision == DOWN:
+            proc = procs.pop()
+            proc.terminate()
+            self.draining[name].append(proc)
+            LOG.info('%s: worker %d retired', name, proc.pid)
+            metrics.incr('supervisor.%s.down' % name)
+
+    def tick(self):
+        '''Samples all pools and scales them (one step each)
+        '''
+        for name in self.pools:
+            self.reap(name)
+            try:
+                length, age = self.sample(name)
+            except RedisError as exc:
+                LOG.error('%s: queues not sampled: %s', name, repr(exc))
+                metrics.incr('supervisor.%s.errors' % name)
+                continue
+            self.samples[name] = (length, age)
+            self.scale(name, self.scalers[name].decide(
+                length, age, len(self.procs[name])))
+            metrics.gauge('supervisor.%s.workers' % name,
+                          len(self.procs[name]))
+            metrics.gauge('supervisor.%s.draining' % name,
+                          len(self.draining[name]))
+            metrics.gauge('supervisor.%s.length' % name, length)
+            metrics.gauge('supervisor.%s.oldest_age' % name, age)
+
+    def state(self):
+        '''Returns pools' state (workers, retired ones still draining, last
+        sample)
+        '''
+        return dict(
+            (name, {
+                'workers': len(self.procs[name]),
+                'draining': len(self.draining[name]),
+                'length': self.samples.get(name, (0, 0.0))[0],
+                'oldest_age': self.samples.get(name, (0, 0.0))[1],
+            }) for name in self.pools)
+
+    def publish(self, redis_conn=None):
+        '''Publishes state and metrics (expiring after a few intervals)
+        and registers supervisor in `REGISTRY_ID`
+        '''
+        if redis_conn is None:
+            redis_conn = self.redis_conn or get_redis(CFG['QUEUE_REDIS'])
+        member = supervisor_id()
+        pipe = redis_conn.pipeline()
+        pipe.set(
+            STATE_ID_FMT % member,
+            json.dumps({
+                'pools': self.state(),
+                'metrics': metrics.snapshot(),
+            }),
+            ex=state_ttl())
+        pipe.zadd(REGISTRY_ID, {member: time.time()})
+        pipe.execute()
+
+    def unpublish(self, redis_conn=None):
+        '''Removes published state and registration
+        '''
+        if redis_conn is None:
+            redis_conn = self.redis_conn or get_redis(CFG['QUEUE_REDIS'])
+        member = supervisor_id()
+        pipe = redis_conn.pipeline()
+        pipe.delete(STATE_ID_FMT % member)
+        pipe.zrem(REGISTRY_ID, member)
+        pipe.execute()
+
+    def run(self):
+        '''Supervisor loop
+        '''
+        while not self.stopped.is_set():
+            self.tick()
+            try:
+                self.publish()
+            except RedisError as exc:
+                LOG.error('State not published: %s', repr(exc))
+            self.stopped.wait(CFG['SUPERVISOR']['INTERVAL'])
+
+    def stop(self, timeout=None):
+        '''Stops loop, retires all workers (kills them, and draining ones,
+        after `timeout`)
+        '''
+        self.stopped.set()
+        try:
+            self.unpublish()
+        except RedisError as exc:
+            LOG.error('State not unpublished: %s', repr(exc))
+        for procs in self.procs.values():
+            for proc in procs:
+                proc.terminate()
+        for procs in list(self.procs.values()) + list(self.draining.values()):
+            for proc in procs:
+                try:
+                    proc.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            del procs[:]
+
+
+def supervisor_id():
+    '''Returns this supervisor's id (`<host>:<pid>`)
+    '''
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def state_ttl():
+    '''Returns published state TTL (a few intervals)
+    '''
+    return max(int(3 * CFG['SUPERVISOR']['INTERVAL']), 1)
+
+
+def supervisors_state(redis_conn=None, now=None):
+    '''Returns published states of running supervisors
+
+    Registry entries not refreshed within state TTL are pruned.
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    if now is None:
+        now = time.time()
+    pipe = redis_conn.pipeline()
+    pipe.zremrangebyscore(REGISTRY_ID, '-inf', '(%f' % (now - state_ttl()))
+    pipe.zrange(REGISTRY_ID, 0, -1)
+    members = [to_str(member) for member in pipe.execute()[1]]
+    out = {}
+    if not members:
+        return out
+    datas = redis_conn.mget([STATE_ID_FMT % member for member in members])
+    for member, data in zip(members, datas):
+        if data is not None:
+            out[member] = json.loads(to_str(data))
+    return out
+
+
+def main(argv=None):
+    '''Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description='Qeez stats supervisor')
+    parser.add_argument('pools', nargs='*', metavar='POOL',
+                        help='pools to run (default: all configured)')
+    parser.add_argument('--stop-timeout', type=float, default=60.0,
+                        help='seconds to wait for retired workers')
+    args = parser.parse_args(argv)
+    pools = CFG['SUPERVISOR']['POOLS']
+    if args.pools:
+        pools = dict((name, pools[name]) for name in args.pools)
+    logging.basicConfig(level=logging.INFO)
+    supervisor = Supervisor(pools=pools)
+
+    def _stop(*_):
+        supervisor.stopped.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop(args.stop_timeout)
+
+
+if __name__ == '__main__':
+    main()
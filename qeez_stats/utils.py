@@ -6,10 +6,15 @@
 import importlib
 import inspect
 import logging
+import itertools
+import random
 import sys
+import time
+from collections import OrderedDict
 from zlib import crc32
 
 from redis import StrictRedis
+from redis.exceptions import RedisError, ResponseError, WatchError
 
 from qeez_stats.config import CFG
 
@@ -18,12 +23,54 @@ LOG = logging.getLogger(__name__)
 
 COLL_ID_FMT = '_coll:%s'
 PACKETS_ID_FMT = '_packets:%s'
+PACKETS_VER_FMT = '_pver:%s'
+PACKETS_CHG_FMT = '_pchg:%s'
+CHANGE_LOG_LEN = 256
+CHANGE_SEP = ','
 PACKET_EXPIRE = 1800
+VERSION_EXPIRE = 7 * 24 * 3600
 PACKET_SEP = ':'
 REDIS_CONNS = {}
+SCRIPTS = {}
+SCRIPTS_STATE = {'missing': False}
+SCRIPT_SOURCES = OrderedDict()
+WATCH_BACKOFF = 0.001
+WATCH_BACKOFF_MAX = 0.1
+PACKET_CACHE = OrderedDict()
+REPLICA_STATE = {}
+REPLICA_RR = {}
 
 DEF_RST = '1:0'
 
+# KEYS: packets hash, packets version, change log
+# ARGV: packets expire, version expire, token, change log length,
+#   field1, value1, ...
+INGEST_LUA = '''
+local fields = {}
+for idx = 5, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[idx]) ~= ARGV[idx + 1] then
+        redis.call('HSET', KEYS[1], ARGV[idx], ARGV[idx + 1])
+        fields[#fields + 1] = ARGV[idx]
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+local cur = redis.call('GET', KEYS[2])
+if #fields == 0 and cur then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return tonumber(cur)
+end
+local ver = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('RPUSH', KEYS[3], table.concat(fields, ','))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[4]), -1)
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return ver
+'''
+
+KEY_FIELDS = (
+    'grp_id', 'loc_id', 'cmp_id', 'rnd_id',
+    'cat_id', 'stp_id', 'gmr_id', 'tm_id')
+
 
 if sys.version_info > (3,):
     def to_bytes(str_buf):  # pragma: PY2to3
@@ -34,6 +81,8 @@ if sys.version_info > (3,):
     def to_str(byte_buf):  # pragma: PY2to3
         '''Converts bytes to UTF-8 string in Py3
         '''
+        if isinstance(byte_buf, str):
+            return byte_buf
         return str(byte_buf, encoding='utf-8')
 else:
     def to_bytes(str_buf):  # pragma: PY2to3
@@ -86,6 +135,87 @@ def get_stat_redis():
     return REDIS_CONNS['stat_redis']
 
 
+def _get_primary_redis(role):
+    '''Returns cached primary redis client of a role
+    '''
+    name = role.lower()
+    if name not in REDIS_CONNS:
+        REDIS_CONNS[name] = get_redis(CFG[role])
+    return REDIS_CONNS[name]
+
+
+def replica_healthy(redis_conn, max_lag):
+    '''Tests if replica is connected to its primary and not lagging more
+    than `max_lag` seconds
+    '''
+    try:
+        info = redis_conn.info('replication')
+    except RedisError as exc:
+        LOG.warning('Replica not available: %s', repr(exc))
+        return False
+    if info.get('role') not in ('slave', 'replica') or \
+            info.get('master_link_status') != 'up':
+        return False
+    return info.get('master_last_io_seconds_ago', max_lag + 1) <= max_lag
+
+
+def _replica_ok(name, redis_conn, now):
+    '''Returns (cached) replica health
+    '''
+    state = REPLICA_STATE.get(name)
+    if state is None or now - state[0] >= CFG['REPLICA_CHECK_INTERVAL']:
+        state = REPLICA_STATE[name] = (
+            now, replica_healthy(redis_conn, CFG['REPLICA_MAX_LAG']))
+    return state[1]
+
+
+def get_read_redis(role, now=None):
+    '''Returns redis client for reads of a role (`STAT_REDIS`,
+    `QUEUE_REDIS`, ...)
+
+    Picks role's `CFG['REPLICAS']` round-robin, skipping unhealthy or
+    lagging ones; falls back to the primary.
+    '''
+    replicas = CFG['REPLICAS'].get(role)
+    if not replicas:
+        return _get_primary_redis(role)
+    if now is None:
+        now = time.time()
+    if role not in REPLICA_RR:
+        REPLICA_RR[role] = itertools.count()
+    start = next(REPLICA_RR[role])
+    for offset in range(len(replicas)):
+        idx = (start + offset) % len(replicas)
+        name = '%s:replica:%d' % (role, idx)
+        if name not in REDIS_CONNS:
+            REDIS_CONNS[name] = get_redis(replicas[idx])
+        if _replica_ok(name, REDIS_CONNS[name], now):
+            return REDIS_CONNS[name]
+    return _get_primary_redis(role)
+
+
+def get_packets_redis():
+    '''Returns redis client for packets reads of stat calculations
+
+    With `CALC_MEMOIZE`, results are memoized on packets version, so the
+    version and packets are both read from the primary (a lagging replica
+    could return packets older than the version); otherwise a replica is
+    used, if configured.
+    '''
+    if CFG['CALC_MEMOIZE']:
+        return _get_primary_redis('STAT_REDIS')
+    return get_read_redis('STAT_REDIS')
+
+
+def reset_redis_conns():
+    '''Drops cached redis clients (e.g. in a freshly forked process)
+    '''
+    for redis_conn in REDIS_CONNS.values():
+        redis_conn.connection_pool.reset()
+    REDIS_CONNS.clear()
+    REPLICA_STATE.clear()
+
+
 def packet_split(key, val, rst=DEF_RST):
     '''Tests if packet parts are OK, returns splitted parts or None
     packet = ('grp_id:loc_id:cmp_id:rnd_id:cat_id:stp_id:gmr_id:tm_id',
@@ -119,8 +249,57 @@ def packet_split(key, val, rst=DEF_RST):
     return (key_parts, val_parts, rst_parts)
 
 
-def decode_raw_packet(raw_packet):
-    '''Decodes one raw packet
+class Packet(object):
+    '''Compact decoded packet
+
+    Named accessors for the 8 key parts, answers (tuple of ints), answer
+    time, points and restriction parts, without per-instance `__dict__`.
+    '''
+
+    __slots__ = KEY_FIELDS + ('answers', 'ans_time', 'points', 'rst')
+
+    def __init__(self, key_parts, answers, ans_time, points, rst):
+        for name, part in zip(KEY_FIELDS, key_parts):
+            setattr(self, name, part)
+        self.answers = answers
+        self.ans_time = ans_time
+        self.points = points
+        self.rst = rst
+
+    @property
+    def key(self):
+        '''Returns tuple of key parts
+        '''
+        return tuple(getattr(self, name) for name in KEY_FIELDS)
+
+    def as_tuple(self):
+        '''Returns packet in `decode_raw_packet` tuple format
+        '''
+        return (
+            self.key,
+            (list(self.answers), self.ans_time, self.points),
+            self.rst)
+
+    def __eq__(self, other):
+        if isinstance(other, Packet):
+            return self.as_tuple() == other.as_tuple()
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Packet(%r, %r, %r, %r, %r)' % (
+            self.key, self.answers, self.ans_time, self.points, self.rst)
+
+
+def decode_raw_packet(raw_packet, compact=False):
+    '''Decodes one raw packet, returns `Packet` instance if `compact` is set
     '''
     if not raw_packet:
         return None
@@ -143,52 +322,357 @@ def decode_raw_packet(raw_packet):
         return None
     key_parts, val_parts, rst_parts = tuple(parts)
 
+    key_parts = tuple(int(part) for part in key_parts)
+    answers = [int(ans) for ans in val_parts[0].split(',') if ans.isdigit()]
+    rst_parts = tuple(int(part) for part in rst_parts)
+    if compact:
+        return Packet(
+            key_parts, tuple(answers), float(val_parts[1]),
+            int(val_parts[2]), rst_parts)
+
     return (
-        tuple(int(part) for part in key_parts),
-        (
-            [int(ans) for ans in val_parts[0].split(',') if ans.isdigit()],
-            float(val_parts[1]),
-            int(val_parts[2]),
-        ),
-        tuple(int(part) for part in rst_parts),
+        key_parts,
+        (answers, float(val_parts[1]), int(val_parts[2])),
+        rst_parts,
     )
 
 
-def decode_raw_packets(raw_packets):
-    '''Decodes multiple raw packets at once
+def iter_decode_raw_packets(raw_packets, compact=False):
+    '''Lazily decodes raw packets (sequence of tuples or a packets' dict)
     '''
-    return [
-        decode_raw_packet(raw_packet) for raw_packet in raw_packets]
+    if isinstance(raw_packets, dict):
+        raw_packets = raw_packets.items()
+    for raw_packet in raw_packets:
+        yield decode_raw_packet(raw_packet, compact=compact)
 
 
-def save_packets_to_stat(qeez_token, res_dc, redis_conn=None):
-    '''Saves packets
+def decode_raw_packets(raw_packets, compact=False):
+    '''Decodes multiple raw packets at once
     '''
-    if redis_conn is None:
-        redis_conn = get_redis(CFG['STAT_REDIS'])
-    key = PACKETS_ID_FMT % qeez_token
+    return list(iter_decode_raw_packets(raw_packets, compact=compact))
 
-    # NOTE: strip rst parts
+
+def _strip_rst(res_dc):
+    '''Returns packets dict without rst parts
+    '''
     _data = {}
     for _key, _val in res_dc.items():
         if isinstance(_val, tuple) and len(_val) == 2:
             _data[_key] = _val[0]
         else:
             _data[_key] = _val
+    return _data
 
-    res = redis_conn.hmset(key, _data)
-    redis_conn.expire(key, PACKET_EXPIRE)
-    return res
 
+def scripts_enabled():
+    '''Tests if Lua scripts are enabled (`STAT_INGEST_LUA`) and were not
+    found missing on the server
+    '''
+    return CFG.get('STAT_INGEST_LUA', True) and not SCRIPTS_STATE['missing']
 
-def retrieve_packets(qeez_token, redis_conn=None):
-    '''Retrieves packets
+
+def load_scripts(redis_conn):
+    '''Preloads Lua scripts into redis' script cache, returns SHA1 digests
+
+    Returns None (and disables scripts in this process) if server-side
+    scripting is missing.
+    '''
+    try:
+        return dict(
+            (name, redis_conn.script_load(script))
+            for name, script in SCRIPT_SOURCES.items())
+    except (ImportError, ResponseError) as exc:
+        LOG.warning('Lua scripting not available: %s', repr(exc))
+        SCRIPTS_STATE['missing'] = True
+    return None
+
+
+def register_lua(name, script):
+    '''Registers Lua script (preloaded by `load_scripts`) as `name`
+    '''
+    SCRIPT_SOURCES[name] = script
+
+
+def get_script(name, redis_conn):
+    '''Returns registered Lua script object (callable)
+    '''
+    if name not in SCRIPTS:
+        SCRIPTS[name] = redis_conn.register_script(SCRIPT_SOURCES[name])
+    return SCRIPTS[name]
+
+
+def _scripts_missing(exc):
+    '''Tests if a script call failed for missing server-side scripting
+    (and disables scripts in this process then)
+    '''
+    if isinstance(exc, ResponseError) and \
+            'unknown command' not in str(exc).lower():
+        return False
+    LOG.warning('Lua scripting not available: %s', repr(exc))
+    SCRIPTS_STATE['missing'] = True
+    return True
+
+
+def call_script(name, keys, args, redis_conn, fallback):
+    '''Runs registered Lua script, or `fallback()` if scripts are disabled
+    or missing
+    '''
+    if scripts_enabled():
+        try:
+            return get_script(name, redis_conn)(
+                keys=keys, args=args, client=redis_conn)
+        except (ImportError, ResponseError) as exc:
+            if not _scripts_missing(exc):
+                raise
+    return fallback()
+
+
+def watch_transaction(redis_conn, func, *keys):
+    '''Runs WATCH/MULTI/EXEC transaction until it succeeds, returns EXEC
+    replies
+
+    `func(pipe)` reads watched `keys` (pipe is in immediate mode), calls
+    `pipe.multi()` and queues commands. Conflicts are retried after
+    jittered exponential backoff (up to `WATCH_BACKOFF_MAX` seconds), so
+    an update is never dropped.
+    '''
+    conflicts = 0
+    with redis_conn.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                func(pipe)
+                return pipe.execute()
+            except WatchError:
+                conflicts += 1
+                time.sleep(random.uniform(0, min(
+                    WATCH_BACKOFF * 2 ** (conflicts - 1), WATCH_BACKOFF_MAX)))
+
+
+register_lua('ingest', INGEST_LUA)
+
+
+def _ingest_lua(items, redis_conn):
+    '''Ingests (token, packets dict) items with EVALSHA calls in one
+    MULTI/EXEC pipeline, returns list of new packets versions
+
+    Packets identical to stored ones are not logged as changed, so if none
+    changed, the version is not bumped (and stat results memoized on it
+    stay valid).
+    '''
+    script = get_script('ingest', redis_conn)
+    pipe = redis_conn.pipeline(transaction=True)
+    for qeez_token, data in items:
+        args = [PACKET_EXPIRE, VERSION_EXPIRE, qeez_token, CHANGE_LOG_LEN]
+        for _key, _val in data.items():
+            args.extend((_key, _val))
+        script(
+            keys=[
+                PACKETS_ID_FMT % qeez_token, PACKETS_VER_FMT % qeez_token,
+                PACKETS_CHG_FMT % qeez_token],
+            args=args, client=pipe)
+    return pipe.execute()
+
+
+def _ingest_pipeline(items, redis_conn):
+    '''Ingests (token, packets dict) items with WATCH/MULTI/EXEC (retried
+    on conflicts), returns list of new packets versions
+
+    Does what `INGEST_LUA` does: stored packets are read (HMGET) first, so
+    only changed fields are written and logged, and the version is bumped
+    only if any changed.
+    '''
+    if not items:
+        return []
+    encoder = redis_conn.connection_pool.get_encoder()
+    keys = []
+    for qeez_token, _ in items:
+        keys.extend((
+            PACKETS_ID_FMT % qeez_token, PACKETS_VER_FMT % qeez_token))
+    with redis_conn.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                reads = redis_conn.pipeline(transaction=False)
+                for qeez_token, data in items:
+                    if data:
+                        reads.hmget(PACKETS_ID_FMT % qeez_token, list(data))
+                    reads.get(PACKETS_VER_FMT % qeez_token)
+                replies = iter(reads.execute())
+                pipe.multi()
+                # NOTE: (True, reply index) of INCR or (False, version)
+                versions = []
+                last = {}
+                written = {}
+                for qeez_token, data in items:
+                    current = written.setdefault(qeez_token, {})
+                    fields = []
+                    olds = next(replies) if data else []
+                    stored_ver = next(replies)
+                    for _key, _old in zip(data, olds):
+                        _new = encoder.decode(encoder.encode(data[_key]))
+                        if current.get(_key, _old) != _new:
+                            current[_key] = _new
+                            fields.append(_key)
+                    key = PACKETS_ID_FMT % qeez_token
+                    ver_key = PACKETS_VER_FMT % qeez_token
+                    cur = last.get(qeez_token)
+                    if cur is None and stored_ver is not None:
+                        cur = (False, int(stored_ver))
+                    if fields:
+                        pipe.hset(key, mapping=dict(
+                            (_key, data[_key]) for _key in fields))
+                    pipe.expire(key, PACKET_EXPIRE)
+                    if not fields and cur is not None:
+                        pipe.expire(ver_key, VERSION_EXPIRE)
+                        versions.append(cur)
+                        continue
+                    pipe.incr(ver_key)
+                    last[qeez_token] = (True, len(pipe.command_stack) - 1)
+                    versions.append(last[qeez_token])
+                    pipe.expire(ver_key, VERSION_EXPIRE)
+                    chg_key = PACKETS_CHG_FMT % qeez_token
+                    pipe.rpush(chg_key, CHANGE_SEP.join(
+                        to_str(_key) for _key in fields))
+                    pipe.ltrim(chg_key, -CHANGE_LOG_LEN, -1)
+                    pipe.expire(chg_key, PACKET_EXPIRE)
+                replies = pipe.execute()
+            except WatchError:
+                continue
+            return [
+                replies[_val] if _ref else _val for _ref, _val in versions]
+
+
+def _ingest(items, redis_conn):
+    '''Ingests (token, stripped packets dict) items, returns list of new
+    packets versions
+    '''
+    if scripts_enabled():
+        try:
+            return _ingest_lua(items, redis_conn)
+        except (ImportError, ResponseError) as exc:
+            if not _scripts_missing(exc):
+                raise
+
+    return _ingest_pipeline(items, redis_conn)
+
+
+def ingest_packets_batch(items, redis_conn=None):
+    '''Ingests many (token, packets dict) items atomically, returns list
+    of new packets versions
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    return _ingest([
+        (qeez_token, _strip_rst(res_dc)) for qeez_token, res_dc in items],
+        redis_conn)
+
+
+def ingest_packets(qeez_token, res_dc, redis_conn=None):
+    '''Saves packets, sets TTL, bumps packets version and logs changed
+    fields in one round trip (with Lua scripting), returns new packets
+    version
     '''
     if redis_conn is None:
         redis_conn = get_redis(CFG['STAT_REDIS'])
+    # NOTE: strip rst parts
+    return _ingest([(qeez_token, _strip_rst(res_dc))], redis_conn)[0]
+
+
+def save_packets_to_stat(qeez_token, res_dc, redis_conn=None):
+    '''Saves packets
+    '''
+    return bool(ingest_packets(qeez_token, res_dc, redis_conn=redis_conn))
+
+
+def packets_version(qeez_token, redis_conn=None):
+    '''Returns current packets version (0 if unknown)
+    '''
+    if redis_conn is None:
+        redis_conn = get_redis(CFG['STAT_REDIS'])
+    return int(redis_conn.get(PACKETS_VER_FMT % qeez_token) or 0)
+
+
+def retrieve_packets(qeez_token, redis_conn=None):
+    '''Retrieves packets (see `get_packets_redis`)
+    '''
+    if redis_conn is None:
+        redis_conn = get_packets_redis()
     return redis_conn.hgetall(PACKETS_ID_FMT % qeez_token)
 
 
+def _changed_fields(qeez_token, version, redis_conn, retries=3):
+    '''Returns (current packets version, fields changed after `version`),
+    fields are None if the change log does not reach back to `version`
+
+    Change log entries are pushed together with version bumps, so the log
+    holds changes of its length's last versions. A shorter log means it was
+    trimmed or expired (along with the packets) in the meantime.
+    '''
+    cur_version = packets_version(qeez_token, redis_conn=redis_conn)
+    for _ in range(retries):
+        if cur_version <= version:
+            return cur_version, [] if cur_version == version else None
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.get(PACKETS_VER_FMT % qeez_token)
+        pipe.llen(PACKETS_CHG_FMT % qeez_token)
+        pipe.lrange(
+            PACKETS_CHG_FMT % qeez_token, version - cur_version, -1)
+        new_version, log_len, changes = pipe.execute()
+        new_version = int(new_version or 0)
+        if new_version == cur_version:
+            if cur_version - version >= log_len:
+                return cur_version, None
+            fields = set()
+            for change in changes:
+                fields.update(to_str(change).split(CHANGE_SEP))
+            fields.discard('')
+            return cur_version, sorted(fields)
+        cur_version = new_version
+    return cur_version, None
+
+
+def retrieve_decoded_packets(qeez_token, compact=False, redis_conn=None):
+    '''Retrieves and decodes packets, like `decode_raw_packets` over
+    `retrieve_packets`, but incrementally
+
+    Decoded packets of recently used tokens are cached per process (up to
+    `CFG['PACKET_CACHE_SIZE']` tokens); only fields changed since the cached
+    packets version are fetched (HMGET) and decoded. Use non-forking rq
+    workers (e.g. `WeightedSimpleWorker`) to keep the cache across jobs.
+    '''
+    if redis_conn is None:
+        redis_conn = get_packets_redis()
+    if qeez_token in PACKET_CACHE:
+        version, packets = PACKET_CACHE.pop(qeez_token)
+        version, fields = _changed_fields(qeez_token, version, redis_conn)
+    else:
+        version, fields = packets_version(
+            qeez_token, redis_conn=redis_conn), None
+    if fields is None:
+        packets = {}
+        for _key, _val in redis_conn.hgetall(
+                PACKETS_ID_FMT % qeez_token).items():
+            packets[to_str(_key)] = decode_raw_packet(
+                (_key, _val), compact=True)
+    elif fields:
+        values = redis_conn.hmget(PACKETS_ID_FMT % qeez_token, fields)
+        for _key, _val in zip(fields, values):
+            if _val is None:
+                packets.pop(_key, None)
+            else:
+                packets[_key] = decode_raw_packet((_key, _val), compact=True)
+
+    PACKET_CACHE[qeez_token] = (version, packets)
+    while len(PACKET_CACHE) > CFG['PACKET_CACHE_SIZE']:
+        PACKET_CACHE.popitem(last=False)
+    if compact:
+        return list(packets.values())
+    return [
+        None if _val is None else _val.as_tuple()
+        for _val in packets.values()]
+
+
 def update_set(stat, stat_token, redis_conn=None):
     '''Updates stats' collector set
     '''
@@ -197,11 +681,23 @@ def update_set(stat, stat_token, redis_conn=None):
     return redis_conn.sadd(COLL_ID_FMT % stat, stat_token)
 
 
-def retrieve_set(stat, redis_conn=None):
-    '''Retrieves stats' collector set
+def update_retrieve_set(stat, stat_token, redis_conn=None):
+    '''Updates stats' collector set and retrieves it (from the primary, to
+    read own write) in one round trip
     '''
     if redis_conn is None:
         redis_conn = get_redis(CFG['STAT_REDIS'])
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.sadd(COLL_ID_FMT % stat, stat_token)
+    pipe.smembers(COLL_ID_FMT % stat)
+    return pipe.execute()[1]
+
+
+def retrieve_set(stat, redis_conn=None):
+    '''Retrieves stats' collector set (from a replica, if configured)
+    '''
+    if redis_conn is None:
+        redis_conn = get_read_redis('STAT_REDIS')
     return redis_conn.smembers(COLL_ID_FMT % stat)
 
 
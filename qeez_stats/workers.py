@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+'''Qeez statistics workers module
+
+Weighted lane worker: instead of rq's strict queue order, every dequeue
+prefers the lane picked by smooth weighted round-robin over
+`CFG['CALC_LANE_WEIGHTS']`, so bulk recalculations progress without
+starving interactive ones (and vice versa).
+
+Calc jobs reuse the per-process decoded packets cache
+(`CFG['PACKET_CACHE_SIZE']`), so run them with the non-forking
+`WeightedSimpleWorker`: `WeightedWorker` forks a child per job, which always
+starts with an empty cache.
+
+$ rqworker --url unix:///tmp/redis.sock?db=1 \
+    --worker-class qeez_stats.workers.WeightedSimpleWorker calc calc_bulk
+'''
+
+import logging
+
+from rq.worker import SimpleWorker, Worker
+
+from qeez_stats.config import CFG
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WeightedOrder(object):
+    '''Smooth weighted round-robin ordering of queues
+    '''
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.current = dict((name, 0) for name in weights)
+
+    def next_order(self, names):
+        '''Returns names ordered by preference for the next dequeue
+        '''
+        total = 0
+        for name in names:
+            weight = self.weights.get(name, 1)
+            self.current[name] = self.current.get(name, 0) + weight
+            total += weight
+        chosen = max(names, key=lambda name: self.current[name])
+        self.current[chosen] -= total
+        rest = sorted(
+            (name for name in names if name != chosen),
+            key=lambda name: -self.weights.get(name, 1))
+        return [chosen] + rest
+
+
+class WeightedMixin(object):
+    '''Reorders worker's queues by lane weights before every dequeue
+    '''
+
+    _order = None
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        if self._order is None:
+            self._order = WeightedOrder(CFG['CALC_LANE_WEIGHTS'])
+        by_name = dict((queue.name, queue) for queue in self.queues)
+        self.queues = [
+            by_name[name] for name in self._order.next_order(list(by_name))]
+        return super(WeightedMixin, self).dequeue_job_and_maintain_ttl(
+            timeout)
+
+
+class WeightedWorker(WeightedMixin, Worker):
+    '''Forking rq worker consuming lanes by weight
+    '''
+
+
+class WeightedSimpleWorker(WeightedMixin, SimpleWorker):
+    '''Non-forking rq worker consuming lanes by weight
+    '''
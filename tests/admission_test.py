@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.admission test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import admission, metrics
+from qeez_stats.queues import enqueue_stat_save
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    from qeez_stats.config import CFG as _CFG
+    utils.get_redis = module.orig_get_redis
+    del module.orig_get_redis
+    _CFG['ADMISSION']['ENABLED'] = False
+    admission.SAMPLES.clear()
+
+
+@pytest.fixture
+def overloaded():
+    from qeez_stats.config import CFG as _CFG
+    cfg = _CFG['ADMISSION']
+    orig = dict(cfg)
+    cfg.update(ENABLED=True, SAVE_MAX_LEN=1, CALC_MAX_LEN=1)
+    admission.SAMPLES.clear()
+    admission.SAMPLES['save'] = admission.SAMPLES['calc'] = \
+        admission.SAMPLES['calc_bulk'] = (float('inf'), 10, 0.0)
+    yield cfg
+    cfg.clear()
+    cfg.update(orig)
+    admission.SAMPLES.clear()
+
+
+@pytest.fixture
+def client():
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    return service.APP.test_client()
+
+
+def test_sample_queue():
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    redis_conn.delete(admission.QUEUE_KEY_FMT % 'save')
+    assert admission.sample_queue('save', redis_conn) == (0, 0.0)
+    enqueue_stat_save(get_token(), {}, redis_conn=redis_conn)
+    length, age = admission.sample_queue('save', redis_conn)
+    assert length == 1
+    assert 0.0 <= age < 60
+
+
+def test_queue_state_cached():
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    admission.SAMPLES.clear()
+    state = admission.queue_state('save', redis_conn, now=100.0)
+    enqueue_stat_save(get_token(), {}, redis_conn=redis_conn)
+    assert admission.queue_state('save', redis_conn, now=100.5) == state
+    assert admission.queue_state(
+        'save', redis_conn, now=200.0)[0] == state[0] + 1
+    assert metrics.snapshot()['gauges']['queue.save.length'] == state[0] + 1
+
+    # NOTE: cached samples are never taken (nor refreshed) by callers
+    assert admission.queue_state('calc_bulk', None, cached=True) == (0, 0.0)
+    enqueue_stat_save(get_token(), {}, redis_conn=redis_conn)
+    assert admission.queue_state(
+        'save', redis_conn, now=300.0, cached=True)[0] == state[0] + 1
+    admission.refresh_samples('calc', redis_conn)
+    assert 'calc_bulk' in admission.SAMPLES
+
+
+def test_admit(overloaded):
+    redis_conn = get_redis(None)
+    assert admission.admit('put', 'save', redis_conn) == admission.DIRECT
+    assert admission.admit('ar_put', 'calc', redis_conn) == admission.SHED
+    assert admission.admit('proc_enq', 'calc', redis_conn) == \
+        admission.REJECT
+    assert admission.admit('other', 'save', redis_conn) == admission.DIRECT
+    overloaded['ENABLED'] = False
+    assert admission.admit('put', 'save', redis_conn) == admission.ACCEPT
+    counters = metrics.snapshot()['counters']
+    assert counters['admission.proc_enq.calc.reject'] >= 1
+    assert counters['admission.put.save.accept'] >= 1
+
+
+def test_admit_lanes(overloaded, monkeypatch):
+    from qeez_stats.config import CFG as _CFG
+    from qeez_stats.queues import LANE_BULK, LANE_INTERACTIVE
+    redis_conn = get_redis(None)
+    admission.SAMPLES['calc_bulk'] = (float('inf'), 0, 0.0)
+    assert admission.admit(
+        'proc_enq', 'calc', redis_conn, lane=LANE_BULK) == admission.ACCEPT
+    assert admission.admit(
+        'proc_enq', 'calc', redis_conn, lane=LANE_INTERACTIVE) == \
+        admission.REJECT
+    admission.SAMPLES['calc'] = (float('inf'), 0, 0.0)
+    admission.SAMPLES['calc_bulk'] = (float('inf'), 10, 0.0)
+    assert admission.admit('ar_put', 'calc', redis_conn) == admission.ACCEPT
+    assert admission.admit(
+        'proc_enq_bulk', 'calc', redis_conn, lane=LANE_BULK) == \
+        admission.REJECT
+
+    # NOTE: lanes' queues come from the config
+    monkeypatch.setitem(
+        _CFG['CALC_LANES'], LANE_INTERACTIVE, 'calc_interactive')
+    admission.SAMPLES['calc_interactive'] = (float('inf'), 10, 0.0)
+    assert admission.stage_queues('calc') == ('calc_interactive',)
+    assert admission.admit('proc_enq', 'calc', redis_conn) == \
+        admission.REJECT
+
+
+def test_service_shed(client, overloaded):
+    resp = client.put(
+        '/stats/ar_put/%s/test_123' % CFG['STAT_CALC_FN'],
+        data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    assert resp.status_code == 200
+    data = flask.json.loads(resp.data)
+    assert data['shed'] is True
+    assert 'job_id' not in data
+
+
+def test_service_reject(client, overloaded):
+    resp = client.put(
+        '/stats/proc_enq/%s/test_123' % CFG['STAT_CALC_FN'],
+        content_type='application/json')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == str(overloaded['RETRY_AFTER'])
+    resp = client.put(
+        '/stats/proc_enq_bulk/%s' % CFG['STAT_CALC_FN'],
+        data=b'["test_123"]', content_type='application/json')
+    assert resp.status_code == 503
+    overloaded['ROUTES'] = {'put': {'save': 'reject'}}
+    resp = client.put(
+        '/stats/put/test_123', data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    assert flask.json.loads(resp.data) == {'error': True, 'status': 503}
+
+
+def test_service_metrics(client):
+    resp = client.get('/stats/metrics')
+    data = flask.json.loads(resp.data)
+    assert data['error'] is False
+    assert set(data['metrics']) == set(['counters', 'gauges'])
+    counters = metrics.snapshot()['counters']
+    assert data['metrics']['counters']['admission.put.save.accept'] >= \
+        counters['admission.put.save.accept']
+
+
+def test_admit_save_stream(monkeypatch):
+    from qeez_stats import streams
+    from qeez_stats.config import CFG as _CFG
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    redis_conn.delete('rq:queue:save', streams.SAVE_STREAM_ID)
+    monkeypatch.setitem(_CFG, 'SAVE_BACKEND', 'stream')
+    monkeypatch.setitem(_CFG['ADMISSION'], 'ENABLED', True)
+    monkeypatch.setitem(_CFG['ADMISSION'], 'SAVE_MAX_LEN', 2)
+    admission.SAMPLES.clear()
+    assert admission.admit('put', 'save', redis_conn) == admission.ACCEPT
+    for _ in range(2):
+        streams.stream_stat_save(get_token(), {}, redis_conn=redis_conn)
+    admission.SAMPLES.clear()
+    # NOTE: backlog of the save stream, not of the (empty) rq queue
+    assert admission.admit('put', 'save', redis_conn) == admission.DIRECT
+    admission.SAMPLES.clear()
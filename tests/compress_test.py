@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.compress test module
+'''
+
+import gzip
+import sys
+
+import flask
+import pytest
+from werkzeug.datastructures import Accept
+
+from qeez_stats import compress, metrics
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import queues, utils
+    module.orig_q_get_redis = queues.get_redis
+    module.orig_u_get_redis = utils.get_redis
+    utils.get_redis = queues.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import queues, utils
+    queues.get_redis = module.orig_q_get_redis
+    utils.get_redis = module.orig_u_get_redis
+    compress.BODY_CACHE.clear()
+
+
+@pytest.fixture
+def min_size():
+    from qeez_stats.config import CFG as _CFG
+    orig = _CFG['COMPRESS_MIN_SIZE']
+    _CFG['COMPRESS_MIN_SIZE'] = 0
+    yield
+    _CFG['COMPRESS_MIN_SIZE'] = orig
+
+
+def test_negotiate():
+    assert compress.negotiate(Accept([('gzip', 1)])) == 'gzip'
+    assert compress.negotiate(Accept([('deflate', 1)])) == compress.IDENTITY
+    assert compress.negotiate(Accept()) == compress.IDENTITY
+
+
+def test_encode_body():
+    body = b'{"result": [1, 2, 3]}'
+    assert compress.encode_body(body, 'gzip') == (body, compress.IDENTITY)
+    body = body * 100
+    enc_body, encoding = compress.encode_body(body, 'gzip')
+    assert encoding == 'gzip'
+    assert gzip.decompress(enc_body) == body
+    assert compress.encode_body(body, compress.IDENTITY) == (
+        body, compress.IDENTITY)
+
+
+def test_body_cache():
+    cache = compress.BodyCache(2, 10)
+    cache.put('a', 1, now=0)
+    cache.put('b', 2, now=0)
+    assert cache.get('a', now=1) == 1
+    cache.put('c', 3, now=1)
+    assert cache.get('b', now=1) is None
+    assert cache.get('a', now=1) == 1
+    assert cache.get('c', now=11) is None
+
+
+def test_service_compressed(min_size):
+    from rq.queue import Queue
+    from rq.worker import SimpleWorker
+    from qeez_stats import queues, service
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    queues.enqueue_stat_calc(stat_id, 'test_gz')
+    SimpleWorker(
+        [Queue('calc', connection=redis_conn)],
+        connection=redis_conn).work(burst=True)
+
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    url = '/stats/result/%s/test_gz' % stat_id
+    hits = metrics.snapshot()['counters'].get('compress.cache.hit', 0)
+    for _ in range(2):
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert flask.json.loads(gzip.decompress(resp.data)) == {
+            'error': False, 'result': 123.1}
+    assert metrics.snapshot()['counters']['compress.cache.hit'] == hits + 1
+
+    resp = client.get(url)
+    assert 'Content-Encoding' not in resp.headers
+    assert flask.json.loads(resp.data) == {'error': False, 'result': 123.1}
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.dedup test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import dedup, metrics
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def dedup_cfg():
+    from qeez_stats.config import CFG as _CFG
+    cfg = _CFG['DEDUP']
+    orig = dict(cfg)
+    cfg['ENABLED'] = True
+    yield cfg
+    cfg.clear()
+    cfg.update(orig)
+
+
+def test_request_key():
+    key = dedup.request_key('tok', 'stat', b'[1]')
+    assert key == dedup.request_key('tok', 'stat', b'[1]')
+    assert key != dedup.request_key('tok', None, b'[1]')
+    assert key != dedup.request_key('tok', 'stat', b'[2]')
+
+
+def test_exact(dedup_cfg):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    key = dedup.request_key(get_token(), None, b'[1]')
+    assert dedup.seen(key, redis_conn) is None
+    dedup.remember(key, {'error': False, 'checksum': 'x'}, redis_conn)
+    assert dedup.seen(key, redis_conn) == {'error': False, 'checksum': 'x'}
+    assert 0 < redis_conn.ttl(dedup.DEDUP_ID_FMT % key) <= 300
+
+
+def test_bloom(dedup_cfg):
+    dedup_cfg.update(BLOOM=True, BLOOM_BITS=1024, WINDOW=10)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    key = dedup.request_key(get_token(), None, b'[1]')
+    assert dedup.seen(key, redis_conn, now=1000) is None
+    dedup.remember(key, {}, redis_conn, now=1000)
+    assert dedup.seen(key, redis_conn, now=1005) is True
+    assert dedup.seen(key, redis_conn, now=1015) is True
+    assert dedup.seen(key, redis_conn, now=1025) is None
+    assert redis_conn.strlen(dedup.BLOOM_ID_FMT % 100) <= 1024 // 8
+
+
+def test_service_duplicate(dedup_cfg):
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    save_redis = get_redis(CFG['SAVE_REDIS'])
+    url = '/stats/ar_put/%s/%s' % (CFG['STAT_CALC_FN'], get_token())
+    data = b'["1:2:3:4:5:6:7:8", "9:10:11"]'
+    resp = client.put(url, data=data, content_type='application/json')
+    orig = flask.json.loads(resp.data)
+    queued = save_redis.llen('rq:queue:save')
+    suppressed = metrics.snapshot()['counters'].get('dedup.suppressed', 0)
+
+    resp = client.put(url, data=data, content_type='application/json')
+    assert flask.json.loads(resp.data) == orig
+    assert save_redis.llen('rq:queue:save') == queued
+    assert metrics.snapshot()['counters']['dedup.suppressed'] == \
+        suppressed + 1
+
+    dedup_cfg['BLOOM'] = True
+    client.put(url, data=data, content_type='application/json')
+    resp = client.put(url, data=data, content_type='application/json')
+    assert flask.json.loads(resp.data) == orig
+
+
+def test_service_remember_failure(dedup_cfg, monkeypatch):
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from qeez_stats import dedup, service
+
+    def _remember(*_):
+        raise RedisConnectionError('down')
+
+    monkeypatch.setattr(dedup, 'remember', _remember)
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    errors = metrics.snapshot()['counters'].get('dedup.errors', 0)
+    resp = client.put(
+        '/stats/put/%s' % get_token(), data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    assert resp.status_code == 200
+    assert flask.json.loads(resp.data)['error'] is False
+    assert metrics.snapshot()['counters']['dedup.errors'] == errors + 1
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.distinct test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import distinct
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def enabled():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['DISTINCT']['ENABLED'] = True
+    yield
+    _CFG['DISTINCT']['ENABLED'] = False
+
+
+def test_update_count():
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    tokens = [get_token(), get_token()]
+    for offset, qeez_token in enumerate(tokens):
+        distinct.update(qeez_token, dict(
+            ('1:%d:3:%d:5:6:%d:%d' % (
+                idx % 3, idx % 2, idx + offset * 50, idx % 4), '1:2:3')
+            for idx in range(100)), redis_conn=redis_conn)
+    distinct.update(tokens[0], {'bad': '1:2:3'}, redis_conn=redis_conn)
+    assert abs(distinct.count(
+        tokens[:1], 'gmr', redis_conn=redis_conn) - 100) <= 2
+    assert abs(distinct.count(tokens, 'gmr', redis_conn=redis_conn) - 150) <= 3
+    assert distinct.count(tokens, 'loc', redis_conn=redis_conn) == 3
+    assert abs(distinct.count(
+        tokens[:1], 'gmr_rnd', group='1', redis_conn=redis_conn) - 50) <= 1
+    assert distinct.count(
+        tokens[:1], 'tm_loc', group='0', redis_conn=redis_conn) == 4
+    assert distinct.count(
+        tokens[:1], 'tm_loc', group='9', redis_conn=redis_conn) == 0
+    assert 0 < redis_conn.ttl(distinct.hll_id(tokens[0], 'tm'))
+
+
+def test_service_distinct(enabled):
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    client.put(
+        '/stats/mput/%s' % qeez_token,
+        data=b'[["1:2:3:4:5:6:7:8", "9:10:11"], ["1:2:3:4:5:7:9:8", "9:1:2"]]',
+        content_type='application/json')
+    resp = client.get('/stats/distinct/gmr_rnd?token=%s&group=4' % qeez_token)
+    assert flask.json.loads(resp.data) == {'error': False, 'result': 2}
+    resp = client.get('/stats/distinct/tm?token=%s' % qeez_token)
+    assert flask.json.loads(resp.data)['result'] == 1
+    assert client.get('/stats/distinct/x?token=y').status_code == 404
+    assert client.get('/stats/distinct/tm').status_code == 400
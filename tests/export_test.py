@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.export test module
+'''
+
+import ast
+import io
+import os
+import struct
+import sys
+import zipfile
+
+from qeez_stats import export
+from qeez_stats.utils import save_packets_to_stat
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+RES_DC = {
+    '1:2:3:4:5:6:7:8': '1,2:2.5:3',
+    '1:2:3:4:5:6:7:9': '4:1.5:5',
+    '1:2:3:4:5:6:7:10': ':0.5:0',
+}
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_e_get_redis = export.get_redis
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = export.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+    export.get_redis = module.orig_e_get_redis
+
+
+def _load_npy(data):
+    assert data[:8] == export.NPY_MAGIC
+    header_len = struct.unpack('<H', data[8:10])[0]
+    header = ast.literal_eval(data[10:10 + header_len].decode('latin1'))
+    assert (10 + header_len) % 64 == 0
+    count = header['shape'][0]
+    fmt = 'd' if header['descr'] == '<f8' else 'q'
+    return list(struct.unpack(
+        '<%d%s' % (count, fmt), data[10 + header_len:]))
+
+
+def _columns(loader):
+    cols = dict((name, loader(name)) for name in export.COLUMNS)
+    rows = sorted(zip(
+        cols['tm_id'], cols['ans_time'], cols['points'], cols['answers_len']))
+    return cols, rows
+
+
+def test_export_token(tmpdir):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    qeez_token = get_token()
+    save_packets_to_stat(qeez_token, RES_DC, redis_conn=redis_conn)
+
+    out_dir = str(tmpdir.join('out'))
+    assert export.export_token(
+        qeez_token, out_dir, redis_conn=redis_conn, batch=2) == 3
+
+    def _load(name):
+        with open(os.path.join(out_dir, name + '.npy'), 'rb') as fobj:
+            return _load_npy(fobj.read())
+
+    cols, rows = _columns(_load)
+    assert rows == [(8, 2.5, 3, 2), (9, 1.5, 5, 1), (10, 0.5, 0, 0)]
+    assert cols['grp_id'] == [1, 1, 1]
+    assert sorted(cols['answers']) == [1, 2, 4]
+
+    assert export.export_token(
+        get_token(), out_dir, redis_conn=redis_conn) == 0
+    assert _load('points') == []
+
+
+def test_export_tokens(tmpdir):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    tokens = [get_token() for _ in range(2)]
+    for qeez_token in tokens:
+        save_packets_to_stat(qeez_token, RES_DC, redis_conn=redis_conn)
+    res = export.export_tokens(tokens, str(tmpdir))
+    assert res == dict((qeez_token, 3) for qeez_token in tokens)
+    assert tmpdir.join(tokens[1], 'answers.npy').check()
+
+
+def test_service_export():
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    save_packets_to_stat(
+        qeez_token, RES_DC, redis_conn=get_redis(CFG['STAT_REDIS']))
+    resp = client.get('/stats/export/%s' % qeez_token)
+    assert resp.status_code == 200
+    zfile = zipfile.ZipFile(io.BytesIO(resp.data))
+    _, rows = _columns(lambda name: _load_npy(zfile.read(name + '.npy')))
+    assert len(rows) == 3
+    assert client.get('/stats/export/%s' % get_token()).status_code == 404
@@ -28,3 +28,15 @@ def stat_fn(*args, **kwargs):
     '''Stub stat function
     '''
     return 123.1
+
+
+def stat_fn_other(*args, **kwargs):
+    '''Stub stat function (with separate results' collector)
+    '''
+    return 123.1
+
+
+def stat_fn_bulk(*args, **kwargs):
+    '''Stub stat function (for bulk processing)
+    '''
+    return 123.1
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.leaderboards test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import leaderboards
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def enabled():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['LEADERBOARDS']['ENABLED'] = True
+    yield
+    _CFG['LEADERBOARDS']['ENABLED'] = False
+
+
+@pytest.mark.parametrize('missing', (False, True))
+def test_update_top_rank(missing, monkeypatch):
+    from qeez_stats import utils
+    monkeypatch.setitem(utils.SCRIPTS_STATE, 'missing', missing)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    qeez_token = get_token()
+    leaderboards.update(qeez_token, {
+        '1:2:3:1:5:6:10:100': '1:2:3',
+        '1:2:3:1:5:7:11:100': ('1:2:5', '1:0'),
+        '1:2:3:2:5:6:10:100': '1:2:4',
+        '1:2:3:2:5:6:12:200': 'bad',
+    }, redis_conn=redis_conn)
+    assert leaderboards.top(qeez_token, 'gmr', redis_conn=redis_conn) == [
+        {'id': '10', 'points': 7}, {'id': '11', 'points': 5}]
+    assert leaderboards.top(qeez_token, 'tm', redis_conn=redis_conn) == [
+        {'id': '100', 'points': 12}]
+    assert leaderboards.top(
+        qeez_token, 'gmr', count=1, rnd='1', redis_conn=redis_conn) == [
+            {'id': '11', 'points': 5}]
+
+    # NOTE: resent packet adds its points' change only
+    leaderboards.update(
+        qeez_token, {'1:2:3:1:5:6:10:100': '1:2:0'}, redis_conn=redis_conn)
+    leaderboards.update(
+        qeez_token, {'1:2:3:1:5:6:10:100': '1:2:0'}, redis_conn=redis_conn)
+    assert leaderboards.rank(qeez_token, 'gmr', '10', redis_conn=redis_conn) \
+        == {'id': '10', 'rank': 2, 'points': 4}
+    assert leaderboards.rank(
+        qeez_token, 'gmr', '12', redis_conn=redis_conn) is None
+    assert 0 < redis_conn.ttl(leaderboards.board_id(qeez_token, 'tm', '2'))
+
+
+def test_service_leaderboard(enabled):
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    client.put(
+        '/stats/mput/%s' % qeez_token,
+        data=b'[["1:2:3:4:5:6:7:8", "9:10:11"], ["1:2:3:4:5:7:9:8", "9:1:2"]]',
+        content_type='application/json')
+    resp = client.get('/stats/leaderboard/%s/gmr?count=1' % qeez_token)
+    assert flask.json.loads(resp.data) == {
+        'error': False, 'result': [{'id': '7', 'points': 11}]}
+    resp = client.get('/stats/leaderboard/%s/tm/8?rnd=4' % qeez_token)
+    assert flask.json.loads(resp.data)['result'] == {
+        'id': '8', 'rank': 1, 'points': 13}
+    assert client.get(
+        '/stats/leaderboard/%s/x' % qeez_token).status_code == 404
+    assert client.get(
+        '/stats/leaderboard/%s/tm?count=0' % qeez_token).status_code == 400
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.loadgen test module
+'''
+
+import sys
+from random import Random
+
+import pytest
+
+from qeez_stats import loadgen
+from qeez_stats.utils import packet_split, save_packets_to_stat
+
+from . import fake_qeez
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+    del module.orig_get_redis
+
+
+def test_parse_mix():
+    assert loadgen.parse_mix('put=2,result') == [('put', 2), ('result', 1)]
+    assert loadgen.parse_mix('put=0,mput=3') == [('mput', 3)]
+    with pytest.raises(ValueError):
+        loadgen.parse_mix('foo=1')
+    with pytest.raises(ValueError):
+        loadgen.parse_mix('put=0')
+
+
+def test_percentile():
+    assert loadgen.percentile([], 50) is None
+    values = list(range(1, 101))
+    assert loadgen.percentile(values, 50) == 50
+    assert loadgen.percentile(values, 99) == 99
+    assert loadgen.percentile([7], 95) == 7
+
+
+def test_game_packets():
+    game = loadgen.Game(get_token(), 10, Random(1))
+    for _ in range(50):
+        key, val = game.packet()
+        assert packet_split(key, val)
+    method, path, body = game.request('ar_mput', 'st', batch=3)
+    assert method == 'PUT'
+    assert path == '/stats/ar_mput/st/' + game.qeez_token
+    assert len(body) == 3
+
+
+def test_count_packets_stat():
+    qeez_token = get_token()
+    save_packets_to_stat(qeez_token, {
+        b'1:2:3:4:5:6:7:8': b'1:2:3', b'a': b'b'})
+    assert loadgen.count_packets_stat(qeez_token) == 1
+
+
+def test_run():
+    rep = loadgen.run(
+        games=3, players=5, requests=10, mix='put,mput,ar_put,result',
+        batch=2, seed=1)
+    assert rep['requests'] == 30
+    assert set(rep['routes']) <= set(loadgen.ROUTES)
+    for stats in rep['routes'].values():
+        assert stats['errors'] == 0
+        assert set(stats['latency_ms']) == set(['p50', 'p95', 'p99'])
+    assert 'total: 30 requests' in loadgen.format_report(rep)
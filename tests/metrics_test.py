@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.metrics test module
+'''
+
+from qeez_stats import metrics
+
+from .config import CFG
+from .commons import get_redis
+
+
+def test_flush():
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    redis_conn.delete(metrics.COUNTERS_ID)
+    metrics.incr('test.flush', 2)
+    metrics.incr('test.flush_float', 0.5)
+    assert metrics.flush(redis_conn) >= 2
+    assert metrics.flush(redis_conn) == 0
+    metrics.incr('test.flush')
+    metrics.flush(redis_conn)
+    counters = metrics.shared_counters(redis_conn)
+    assert counters['test.flush'] == 3
+    assert counters['test.flush_float'] == 0.5
+
+    # NOTE: other (e.g. recycled) processes' counters are summed
+    redis_conn.hincrby(metrics.COUNTERS_ID, 'test.flush', 10)
+    assert metrics.shared_counters(redis_conn)['test.flush'] == 13
+    assert metrics.snapshot()['counters']['test.flush'] == 3
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.profiling test module
+'''
+
+import sys
+import time
+
+from qeez_stats import profiling, stats
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = (
+        utils.get_redis, stats.get_redis, profiling.get_redis)
+    utils.get_redis = stats.get_redis = profiling.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    (utils.get_redis, stats.get_redis,
+     profiling.get_redis) = module.orig_get_redis
+
+
+def _busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def test_stack_sampler():
+    with profiling.StackSampler(interval=0.001) as sampler:
+        _busy_wait(0.05)
+    lines = sampler.collapsed().splitlines()
+    assert lines
+    assert any(
+        'profiling_test.test_stack_sampler;tests.profiling_test._busy_wait'
+        in line for line in lines)
+    assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+
+
+def test_run_stat_profiled(capsys):
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    qeez_token = get_token()
+    stat = CFG['STAT_CALC_FN']
+    stats.run_stat(stat, qeez_token)
+    assert profiling.fetch(stat, qeez_token, redis_conn=redis_conn) is None
+    assert profiling.main([stat, qeez_token]) == 1
+
+    stats.run_stat(stat, qeez_token, profile=True)
+    assert profiling.fetch(stat, qeez_token, redis_conn=redis_conn) \
+        is not None
+    assert 0 < redis_conn.ttl(profiling.PROF_ID_FMT % (stat, qeez_token))
+    assert profiling.main([stat, qeez_token]) == 0
+
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    resp = client.get('/stats/profile/%s/%s' % (stat, qeez_token))
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    assert client.get(
+        '/stats/profile/%s/%s' % (stat, get_token())).status_code == 404
@@ -4,6 +4,7 @@
 '''
 
 import sys
+import time
 
 from rq.job import Job
 from rq.queue import Queue
@@ -125,6 +126,7 @@ def test_pull_stat_res_fail():
 
 
 def test_pull_stat_res_ok():
+    from qeez_stats.config import CFG as _CFG
     from qeez_stats.utils import save_packets_to_stat
     stat_id = CFG['STAT_CALC_FN']
     qeez_token = get_token()
@@ -145,6 +147,9 @@ def test_pull_stat_res_ok():
     res = queues.pull_stat_res(stat_id, qeez_token, redis_conn=None)
     assert isinstance(res, float)
     assert res == 123.1
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    assert redis_conn.hexists(queues.RES_ID_FMT % stat_id, qeez_token)
+    assert 0 < redis_conn.ttl(job.key) <= _CFG['CALC_RESULT_TTL']
 
 
 def test_pull_all_stat_res_fail():
@@ -185,3 +190,215 @@ def test_pull_all_stat_res_ok():
     worker.work(burst=True)
 
     assert queues.pull_all_stat_res(stat_id, redis_conn=redis_conn) == [123.1]
+
+
+def test_enqueue_stat_calc_lanes_coalesced():
+    from qeez_stats import metrics
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    qeez_token = get_token()
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+
+    job = queues.enqueue_stat_calc(
+        stat_id, qeez_token, lane=queues.LANE_BULK)
+    assert job.origin == 'calc_bulk'
+    coalesced = metrics.snapshot()['counters'].get('calc.coalesced', 0)
+    job_2 = queues.enqueue_stat_calc(
+        stat_id, qeez_token, lane=queues.LANE_BULK)
+    assert job_2.id == job.id
+    assert metrics.snapshot()['counters']['calc.coalesced'] == coalesced + 1
+
+    # NOTE: interactive request does not wait for the bulk job
+    job_3 = queues.enqueue_stat_calc(stat_id, qeez_token)
+    assert job_3.id != job.id
+    assert job_3.origin == 'calc'
+    assert metrics.snapshot()['counters']['calc.coalesced'] == coalesced + 1
+
+    queue = Queue(name='calc', connection=redis_conn)
+    worker = SimpleWorker([queue], connection=redis_conn)
+    worker.work(burst=True)
+    assert queues.pull_stat_res(stat_id, qeez_token) == 123.1
+    assert Job.fetch(job.id, connection=redis_conn).get_status() != \
+        'finished'
+
+    worker = SimpleWorker(
+        [Queue(name='calc_bulk', connection=redis_conn)],
+        connection=redis_conn)
+    worker.work(burst=True)
+    assert Job.fetch(job.id, connection=redis_conn).get_status() == \
+        'finished'
+
+
+def test_pull_stat_res_delta():
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    tokens = [get_token() for _ in range(2)]
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    queue = Queue(name='calc', connection=redis_conn)
+    worker = SimpleWorker([queue], connection=redis_conn)
+    worker.work(burst=True)
+
+    _, since = queues.pull_stat_res_delta(stat_id, 0)
+    for qeez_token in tokens:
+        queues.enqueue_stat_calc(stat_id, qeez_token)
+    worker.work(burst=True)
+    res, version = queues.pull_stat_res_delta(stat_id, since)
+    assert version == since + 2
+    assert sorted(_dc['token'] for _dc in res) == sorted(tokens)
+    assert [_dc['result'] for _dc in res] == [123.1, 123.1]
+    assert queues.pull_stat_res_delta(stat_id, version) == ([], version)
+
+    queues.enqueue_stat_calc(stat_id, tokens[0])
+    worker.work(burst=True)
+    res, version_2 = queues.pull_stat_res_delta(stat_id, version)
+    assert res == [{
+        'token': tokens[0], 'version': version + 1, 'result': 123.1}]
+    assert version_2 == version + 1
+    assert queues.pull_stat_res_since(stat_id, tokens[0], version) == (
+        123.1, version_2)
+    assert queues.pull_stat_res_since(stat_id, tokens[1], version) == (
+        None, version)
+
+
+def test_enqueue_stat_calc_bulk():
+    stat_id = CFG['STAT_CALC_FN'] + '_bulk'
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    queue = Queue(name='calc_bulk', connection=redis_conn)
+    worker = SimpleWorker([queue], connection=redis_conn)
+    worker.work(burst=True)
+    tokens = ['bulk%d' % idx for idx in range(5)]
+    queues.enqueue_stat_calc(stat_id, tokens[0], lane=queues.LANE_BULK)
+
+    batch_id = queues.enqueue_stat_calc_bulk(stat_id, qeez_tokens=tokens)
+    progress = queues.batch_progress(batch_id)
+    assert progress['stat'] == stat_id
+    assert (progress['total'], progress['enqueued'], progress['coalesced'],
+            progress['done'], progress['complete']) == (5, 4, 1, 0, False)
+    worker.work(burst=True)
+    progress = queues.batch_progress(batch_id)
+    assert (progress['done'], progress['complete']) == (5, True)
+    assert queues.pull_stat_res(stat_id, tokens[4]) == 123.1
+    assert len(queues.pull_all_stat_res(stat_id)) == 5
+
+    batch_id = queues.enqueue_stat_calc_bulk(
+        stat_id, qeez_tokens=['bulk1', 'bulk2', 'bulk1'])
+    batch_id_2 = queues.enqueue_stat_calc_bulk(stat_id, pattern='bulk[12]')
+    assert queues.batch_progress(batch_id)['total'] == 2
+    assert queues.batch_progress(batch_id_2)['coalesced'] == 2
+    worker.work(burst=True)
+    assert queues.batch_progress(batch_id)['complete'] is True
+    assert queues.batch_progress(batch_id_2)['done'] == 2
+
+    batch_id = queues.enqueue_stat_calc_bulk(stat_id, pattern='bulk[12]')
+    assert queues.batch_progress(batch_id)['enqueued'] == 2
+    worker.work(burst=True)
+    assert queues.batch_progress(batch_id)['done'] == 2
+
+    batch_id = queues.enqueue_stat_calc_bulk(
+        stat_id + '_missing', qeez_tokens=tokens[:1])
+    worker.work(burst=True)
+    assert queues.batch_progress(batch_id)['failed'] == 1
+    assert queues.batch_progress('missing') is None
+
+
+def test_run_stat_memoized(monkeypatch):
+    from qeez_stats import metrics, stats, utils
+    monkeypatch.setattr(stats, 'get_redis', get_redis)
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    qeez_token = get_token()
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'})
+    counters = metrics.snapshot()['counters']
+
+    assert stats.run_stat(stat_id, qeez_token) == 123.1
+    version = queues.stat_res_version(stat_id, qeez_token)
+    assert stats.run_stat(stat_id, qeez_token) == 123.1
+    assert queues.stat_res_version(stat_id, qeez_token) == version
+    assert metrics.snapshot()['counters']['calc.memoized'] == \
+        counters.get('calc.memoized', 0) + 1
+
+    stats.run_stat(stat_id, qeez_token, force=True)
+    version_2 = queues.stat_res_version(stat_id, qeez_token)
+    assert version_2 > version
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:8': '2:2:3'})
+    stats.run_stat(stat_id, qeez_token)
+    assert queues.stat_res_version(stat_id, qeez_token) > version_2
+    assert int(redis_conn.hget(stats.RES_MEMO_ID_FMT % stat_id, qeez_token)) \
+        == utils.packets_version(qeez_token)
+
+
+def test_enqueue_stat_calc_coalesced_force(monkeypatch):
+    from qeez_stats import stats, utils
+    monkeypatch.setattr(stats, 'get_redis', get_redis)
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    qeez_token = get_token()
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'})
+    stats.run_stat(stat_id, qeez_token)
+    version = queues.stat_res_version(stat_id, qeez_token)
+
+    job = queues.enqueue_stat_calc(stat_id, qeez_token)
+    job_2 = queues.enqueue_stat_calc(stat_id, qeez_token, force=True)
+    assert job_2.id == job.id
+    assert redis_conn.hget(stats.CALC_EXTRA_ID_FMT % job.id, 'force') == b'1'
+
+    worker = SimpleWorker(
+        [Queue(name='calc', connection=redis_conn)], connection=redis_conn)
+    worker.work(burst=True)
+    assert queues.stat_res_version(stat_id, qeez_token) > version
+    assert not redis_conn.exists(stats.CALC_EXTRA_ID_FMT % job.id)
+
+
+class _Interleaved(object):
+    '''Redis client running a hook just before its first transaction
+    '''
+
+    def __init__(self, redis_conn, hook):
+        self._redis_conn = redis_conn
+        self._hook = hook
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._redis_conn.pipeline(*args, **kwargs)
+        multi = pipe.multi
+
+        def _multi():
+            if self._hook is not None:
+                hook, self._hook = self._hook, None
+                hook()
+            return multi()
+
+        pipe.multi = _multi
+        return pipe
+
+
+def test_store_result_interleaved():
+    from qeez_stats import stats
+    stat_id = CFG['STAT_CALC_FN'] + '_interleaved'
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    _, since = queues.pull_stat_res_delta(stat_id, 0)
+    versions = {}
+
+    def _store_other():
+        versions['y'] = stats.store_result(stat_id, 'y', 2, redis_conn)
+
+    versions['x'] = stats.store_result(
+        stat_id, 'x', 1, _Interleaved(redis_conn, _store_other))
+    assert versions == {'y': since + 1, 'x': since + 2}
+    res, top = queues.pull_stat_res_delta(stat_id, since)
+    assert top == since + 2
+    assert sorted((_dc['token'], _dc['version']) for _dc in res) == [
+        ('x', since + 2), ('y', since + 1)]
+
+
+def test_store_result_prune():
+    from qeez_stats import stats
+    stat_id = CFG['STAT_CALC_FN'] + '_prune'
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    stats.store_result(stat_id, 'old', 1, redis_conn, 7)
+    stats.store_result(stat_id, 'new', 2, redis_conn, 7)
+    redis_conn.zadd(stats.RES_TIME_ID_FMT % stat_id, {
+        'old': time.time() - stats.RES_EXPIRE - 1})
+    stats.store_result(stat_id, 'new', 3, redis_conn, 8)
+    for fmt in (stats.RES_ID_FMT, stats.RES_MEMO_ID_FMT):
+        assert redis_conn.hkeys(fmt % stat_id) == [b'new']
+    for fmt in (stats.RES_IDX_ID_FMT, stats.RES_TIME_ID_FMT):
+        assert redis_conn.zrange(fmt % stat_id, 0, -1) == [b'new']
+    assert queues.pull_stat_res(stat_id, 'new') == 3
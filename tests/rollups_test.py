@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.rollups test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import rollups
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+NOW = 1500000000
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def enabled():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['ROLLUPS']['ENABLED'] = True
+    yield _CFG['ROLLUPS']
+    _CFG['ROLLUPS']['ENABLED'] = False
+
+
+def test_bucket_start():
+    assert rollups.bucket_start(60, 119.9) == 60
+    assert rollups.bucket_start(3600, 7200) == 7200
+
+
+def test_record_query():
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    rollups.record('tok_a', {
+        '1:2:3:4:5:6:7:8': ('1:2.5:3', '1:0'),
+        '1:2:3:4:5:6:7:9': '2:1.5:5',
+    }, redis_conn=redis_conn, now=NOW + 10)
+    rollups.record('tok_b', {
+        '1:2:3:4:5:6:7:8': '1:1:1',
+    }, redis_conn=redis_conn, now=NOW + 70)
+
+    res = rollups.query('m', NOW, NOW + 70, redis_conn=redis_conn)
+    assert [_dc['ts'] for _dc in res] == [NOW, NOW + 60]
+    assert [_dc['packets'] for _dc in res] == [2, 1]
+    assert res[0]['points'] == 8
+    assert res[0]['avg_points'] == 4.0
+    assert res[0]['avg_ans_time'] == 2.0
+    assert [_dc['games'] for _dc in res] == [1, 1]
+
+    res = rollups.query('h', NOW, NOW + 70, redis_conn=redis_conn)
+    assert res[0]['packets'] == 3
+    assert res[0]['games'] == 2
+    assert 0 < redis_conn.ttl(rollups.ROLL_ID_FMT % ('h', res[0]['ts']))
+
+    res = rollups.query('m', NOW + 600, NOW + 600, redis_conn=redis_conn)
+    assert res == [{
+        'ts': NOW + 600, 'packets': 0, 'points': 0, 'avg_points': None,
+        'avg_ans_time': None, 'games': 0}]
+
+
+def test_service_rollups(enabled):
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    resp = client.put(
+        '/stats/put/test_roll', data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    assert resp.status_code == 200
+    resp = client.get('/stats/rollups/m')
+    data = flask.json.loads(resp.data)
+    assert data['step'] == 60
+    assert len(data['result']) == 60
+    # NOTE: the PUT could fall into the previous minute
+    assert sum(_dc['packets'] for _dc in data['result'][-2:]) >= 1
+    assert sum(_dc['games'] for _dc in data['result'][-2:]) >= 1
+
+    assert client.get('/stats/rollups/x').status_code == 404
+    assert client.get(
+        '/stats/rollups/m?start=0&end=%d' % NOW).status_code == 400
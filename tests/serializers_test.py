@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.serializers test module
+'''
+
+import sys
+
+import pytest
+from rq.job import Job
+from rq.worker import SimpleWorker
+
+from qeez_stats import queues, serializers
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    from qeez_stats.config import CFG as _CFG
+    module.orig_q_get_redis = queues.get_redis
+    module.orig_u_get_redis = utils.get_redis
+    utils.get_redis = queues.get_redis = get_redis
+    _CFG['QUEUE_SERIALIZER'] = 'json'
+    fake_qeez.stat_fn_json = fake_qeez.stat_fn
+    for name in ('save', 'calc'):
+        get_redis(None).delete(queues.get_queue(name, get_redis(None)).key)
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    from qeez_stats.config import CFG as _CFG
+    queues.get_redis = module.orig_q_get_redis
+    utils.get_redis = module.orig_u_get_redis
+    _CFG['QUEUE_SERIALIZER'] = 'pickle'
+    del fake_qeez.stat_fn_json
+
+
+def test_json_serializer():
+    ser = serializers.JSONSerializer
+    assert ser.loads(ser.dumps({'a': (1, 2)})) == {'a': [1, 2]}
+    assert ser.loads(ser.dumps(set([b'b', b'a']))) == ['a', 'b']
+    with pytest.raises(TypeError):
+        ser.dumps(object())
+
+
+def test_get_job_class():
+    assert serializers.get_job_class('pickle') is Job
+    assert serializers.get_job_class('json') is serializers.JSONJob
+    assert serializers.get_job_class() is serializers.JSONJob
+    assert issubclass(serializers.get_job_class('msgpack'), Job)
+
+
+def test_json_job_roundtrip():
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    job = serializers.JSONJob.create(
+        'qeez.api.models.stat_fn', args=(1, 'a'), kwargs={'b': 2},
+        connection=redis_conn, meta={'m': 1})
+    job.save()
+    assert redis_conn.hget(job.key, 'meta') == b'{"m":1}'
+    job = serializers.JSONJob.fetch(job.id, connection=redis_conn)
+    assert job.func_name == 'qeez.api.models.stat_fn'
+    assert job.args == (1, 'a')
+    assert job.kwargs == {'b': 2}
+    assert job.meta == {'m': 1}
+    assert job.perform() == 123.1
+    job.save()
+    assert serializers.JSONJob.fetch(
+        job.id, connection=redis_conn).result == 123.1
+
+
+def test_json_queues():
+    stat_id = CFG['STAT_CALC_FN'] + '_json'
+    qeez_token = get_token()
+    job = queues.enqueue_stat_save(
+        qeez_token, {'1:2:3:4:5:6:7:8': ('1:2:3', '1:0')}, atime=None)
+    assert isinstance(job, serializers.JSONJob)
+    assert job.args[1] > 0
+
+    job = queues.enqueue_stat_calc(stat_id, qeez_token)
+    assert isinstance(job, serializers.JSONJob)
+    for name in ('save', 'calc'):
+        queue = queues.get_queue(name, get_redis(None))
+        worker = SimpleWorker(
+            [queue], connection=queue.connection,
+            job_class=serializers.JSONJob)
+        worker.work(burst=True)
+    assert queues.pull_stat_res(stat_id, qeez_token) == 123.1
+    assert 123.1 in queues.pull_all_stat_res(stat_id)
+
+
+def test_dumps_result():
+    from qeez_stats.config import CFG as _CFG
+    raw = serializers.dumps_result({'a': [1, 2]})
+    assert raw[:2] == b'jr'
+    assert serializers.loads_result(raw) == {'a': [1, 2]}
+    raw = serializers.dumps_result(list(range(1000)))
+    assert raw[:2] == b'jz'
+    assert serializers.loads_result(raw) == list(range(1000))
+    _CFG['QUEUE_SERIALIZER'] = 'pickle'
+    try:
+        raw = serializers.dumps_result(set([1]))
+    finally:
+        _CFG['QUEUE_SERIALIZER'] = 'json'
+    assert raw[:2] == b'pr'
+    with pytest.raises(ValueError):
+        serializers.loads_result(raw)
+    _CFG['QUEUE_SERIALIZER'] = 'pickle'
+    try:
+        assert serializers.loads_result(raw) == set([1])
+    finally:
+        _CFG['QUEUE_SERIALIZER'] = 'json'
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.server test module
+'''
+
+import json
+import sys
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from qeez_stats import server
+
+from . import fake_qeez
+from .commons import FakeStrictRedis, get_redis
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+    del module.orig_get_redis
+
+
+def test_post_fork():
+    from qeez_stats import utils
+    from qeez_stats.config import CFG
+    utils.REDIS_CONNS['stat_redis'] = redis_conn = FakeStrictRedis()
+    CFG['RAVEN_CLI'] = object()
+    server.post_fork()
+    assert utils.REDIS_CONNS.get('stat_redis') is not redis_conn
+    assert CFG['RAVEN_CLI'] is None
+
+
+def test_post_fork_hook():
+    calls = []
+    hook = server.post_fork_hook(lambda: calls.append(1))
+    try:
+        server.post_fork()
+        assert calls == [1]
+    finally:
+        server.POST_FORK_HOOKS.remove(hook)
+
+
+def test_pre_exit():
+    calls = []
+
+    def _fail():
+        raise ValueError('hook')
+
+    hooks = [server.pre_exit_hook(_fail),
+             server.pre_exit_hook(lambda: calls.append(1))]
+    try:
+        server.pre_exit()
+        assert calls == [1]
+    finally:
+        for hook in hooks:
+            server.PRE_EXIT_HOOKS.remove(hook)
+    assert server.drain_spool in server.PRE_EXIT_HOOKS
+
+
+def test_serve_max_requests():
+    from qeez_stats.service import APP
+    sock = server.make_socket('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    served = []
+    thread = threading.Thread(
+        target=lambda: served.append(server.serve(APP, sock, max_requests=2)))
+    thread.start()
+    for _ in range(2):
+        try:
+            urlopen('http://127.0.0.1:%d/' % port, timeout=5)
+        except HTTPError as exc:
+            assert exc.code == 404
+            assert json.loads(exc.read().decode('utf-8')) == {
+                'error': True, 'status': 404}
+    thread.join(5)
+    sock.close()
+    assert served == [2]
+
+
+def test_serve_max_idle():
+    from qeez_stats.service import APP
+    sock = server.make_socket('127.0.0.1', 0, reuse_port=True)
+    orig_interval = server.POLL_INTERVAL
+    server.POLL_INTERVAL = 0.05
+    try:
+        assert server.serve(APP, sock, max_idle=0.1) == 0
+        assert server.serve(APP, sock, stopped=lambda: True) == 0
+    finally:
+        server.POLL_INTERVAL = orig_interval
+        sock.close()
+
+
+def test_respawn_delay():
+    assert server.respawn_delay(0) == 0.0
+    assert server.respawn_delay(1) == server.SPAWN_BACKOFF
+    assert server.respawn_delay(3) == 4 * server.SPAWN_BACKOFF
+    assert server.respawn_delay(100) == server.SPAWN_BACKOFF_MAX
+
+
+def test_run_backoff(monkeypatch):
+    handlers = {}
+    spawned = []
+    statuses = [256, 256, 256, 0]
+    clock = [1000.0]
+    sleeps = []
+
+    def _spawn(*_):
+        spawned.append(len(spawned) + 1)
+        return spawned[-1]
+
+    def _wait():
+        if not statuses:
+            handlers[server.signal.SIGTERM]()
+        return spawned[-1], statuses.pop(0) if statuses else 0
+
+    def _sleep(delay):
+        sleeps.append(delay)
+        clock[0] += delay
+
+    monkeypatch.setattr(server, '_spawn', _spawn)
+    monkeypatch.setattr(server.os, 'wait', _wait)
+    monkeypatch.setattr(server.os, 'kill', lambda *_: None)
+    monkeypatch.setattr(
+        server.signal, 'signal',
+        lambda signum, handler: handlers.__setitem__(signum, handler))
+    monkeypatch.setattr(server.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(server.time, 'sleep', _sleep)
+    server.run(None, '127.0.0.1', 0, reuse_port=True)
+    # NOTE: early failures back off, a clean exit resets the streak
+    assert abs(sum(sleeps) - server.SPAWN_BACKOFF * (1 + 2 + 4)) < 1e-6
+    assert len(spawned) == 5
@@ -11,7 +11,7 @@ import pytest
 
 from qeez_stats import service
 from qeez_stats.utils import calc_checksum
-from qeez_stats.queues import STAT_ID_FMT
+from qeez_stats.queues import LANE_BULK, STAT_ID_FMT, calc_job_id
 
 from . import fake_qeez
 from .config import CFG
@@ -120,6 +120,26 @@ def test_stats_put_ok_direct(client):
         'error': False}
 
 
+def test_stats_put_ok_stream(client):
+    from qeez_stats.config import CFG as _CFG
+    from qeez_stats.streams import SAVE_STREAM_ID
+    _data = b'["1:2:3:4:5:6:7:8", "9:10:11", "1:0"]'
+    checksum = calc_checksum(_data)
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    stream_len = redis_conn.xlen(SAVE_STREAM_ID)
+    _CFG['SAVE_BACKEND'] = 'stream'
+    try:
+        resp = client.put(
+            '/stats/put/test_123', data=_data,
+            content_type='application/json')
+    finally:
+        _CFG['SAVE_BACKEND'] = 'rq'
+    assert flask.json.loads(resp.data) == {
+        'checksum': checksum,
+        'error': False}
+    assert redis_conn.xlen(SAVE_STREAM_ID) == stream_len + 1
+
+
 def test_stats_put_ok_direct_len_3_bad_rst(client):
     _data = b'["1:2:3:4:5:6:7:8", "9:10:11", ""]'
     checksum = calc_checksum(_data)
@@ -176,7 +196,8 @@ def test_stats_proc_enq(client):
         '/stats/proc_enq/' + stat_id + '/' + qeez_token,
         content_type='application/json')
     assert flask.json.loads(resp.data) == {'checksum': '00000000',
-        'error': False, 'job_id': STAT_ID_FMT % (stat_id, qeez_token)}
+        'error': False,
+        'job_id': calc_job_id(stat_id, qeez_token, LANE_BULK)}
 
 
 def test_stats_result_get_no_res(client):
@@ -194,3 +215,38 @@ def test_stats_results_get_res_ok(client):
         '/stats/results/' + stat_id,
         content_type='application/json')
     assert flask.json.loads(resp.data) == {'error': False, 'result': [123.1]}
+
+
+def test_stats_results_get_since(client):
+    stat_id = CFG['STAT_CALC_FN'] + '_other'
+    resp = client.get('/stats/results/%s?since=x' % stat_id)
+    assert resp.status_code == 400
+    resp = client.get('/stats/results/%s?since=0' % stat_id)
+    data = flask.json.loads(resp.data)
+    assert data['error'] is False
+    version = data['version']
+    assert all(_dc['version'] <= version for _dc in data['result'])
+    resp = client.get('/stats/results/%s?since=%d' % (stat_id, version))
+    assert flask.json.loads(resp.data) == {
+        'error': False, 'result': [], 'version': version}
+    resp = client.get(
+        '/stats/result/%s/test_123?since=%d' % (stat_id, version))
+    assert flask.json.loads(resp.data) == {
+        'error': False, 'result': None, 'version': version}
+
+
+def test_stats_proc_enq_bulk(client):
+    stat = CFG['STAT_CALC_FN'] + '_bulk'
+    resp = client.put(
+        '/stats/proc_enq_bulk/%s' % stat, data=b'["svcbulk1", "svcbulk2"]',
+        content_type='application/json')
+    data = flask.json.loads(resp.data)
+    assert data['error'] is False
+    assert data['progress']['total'] == 2
+    resp = client.get('/stats/batch/%s' % data['batch_id'])
+    assert flask.json.loads(resp.data)['progress']['stat'] == stat
+    assert client.get('/stats/batch/missing').status_code == 404
+    resp = client.put(
+        '/stats/proc_enq_bulk/%s' % stat, data=b'{"a": 1}',
+        content_type='application/json')
+    assert resp.status_code == 400
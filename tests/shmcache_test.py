@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.shmcache test module
+'''
+
+import os
+import sys
+
+import pytest
+
+from qeez_stats import metrics, shmcache, utils
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    from qeez_stats.config import CFG as _CFG
+    orig = dict(_CFG['SHM_CACHE'])
+    _CFG['SHM_CACHE']['DIR'] = str(tmp_path)
+    shmcache.STATE.update(bytes=0, scanned_at=None)
+    yield _CFG['SHM_CACHE']
+    _CFG['SHM_CACHE'].clear()
+    _CFG['SHM_CACHE'].update(orig)
+    shmcache.STATE.update(bytes=0, scanned_at=None)
+
+
+def test_retrieve_snapshot(cache_dir):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    qeez_token = get_token()
+    utils.ingest_packets(qeez_token, {
+        '1:2:3:4:5:6:7:8': '1,2:2.5:3', '1:2:3:4:5:6:9:8': ':1.0:-1',
+        '1:2:3:4:5:6:10:8': 'bad'}, redis_conn)
+    snapshot = shmcache.retrieve_snapshot(qeez_token, redis_conn=redis_conn)
+    assert len(snapshot) == 2
+    assert sorted(snapshot.packets(), key=lambda _pkt: _pkt.gmr_id) == [
+        _pkt for _pkt in sorted(utils.decode_raw_packets(
+            utils.retrieve_packets(qeez_token, redis_conn), compact=True),
+            key=lambda _pkt: _pkt.gmr_id if _pkt else 0) if _pkt]
+    assert sorted(snapshot.columns['points']) == [-1, 3]
+    assert snapshot.columns['answers'].tolist() == [1, 2]
+
+    hits = metrics.snapshot()['counters'].get('shm_cache.hit', 0)
+    snapshot_2 = shmcache.retrieve_snapshot(
+        qeez_token, redis_conn=redis_conn)
+    assert snapshot_2.columns['gmr_id'].tolist() == \
+        snapshot.columns['gmr_id'].tolist()
+    assert metrics.snapshot()['counters']['shm_cache.hit'] == hits + 1
+
+    # NOTE: new packets version replaces token's snapshot
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:11:8': '3:1:1'}, redis_conn)
+    snapshot_3 = shmcache.retrieve_snapshot(
+        qeez_token, redis_conn=redis_conn)
+    assert len(snapshot_3) == 3
+    assert os.listdir(cache_dir['DIR']) == [os.path.basename(
+        shmcache.snapshot_path(qeez_token, snapshot_3.version))]
+    assert len(snapshot) == 2
+
+
+def test_evict(cache_dir):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    tokens = [get_token() for _ in range(3)]
+    for idx, qeez_token in enumerate(tokens):
+        utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'})
+        shmcache.retrieve_snapshot(qeez_token, redis_conn=redis_conn)
+        path = shmcache.snapshot_path(
+            qeez_token, utils.packets_version(qeez_token))
+        os.utime(path, (idx, idx))
+    size = os.path.getsize(path)
+    cache_dir['MAX_BYTES'] = 2 * size
+    shmcache.evict()
+    assert sorted(os.listdir(cache_dir['DIR'])) == sorted(
+        os.path.basename(shmcache.snapshot_path(
+            qeez_token, utils.packets_version(qeez_token)))
+        for qeez_token in tokens[1:])
+
+    snapshot = shmcache.retrieve_snapshot(get_token(), redis_conn=redis_conn)
+    assert len(snapshot) == 0
+    assert len(os.listdir(cache_dir['DIR'])) == 2
+
+
+def test_evict_scan_interval(cache_dir):
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    qeez_token = get_token()
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'})
+    utils.ingest_packets(qeez_token, {'1:2:3:4:5:6:7:9': '1:2:3'})
+    stale = shmcache.snapshot_path(qeez_token, 0)
+    with open(stale, 'wb') as fobj:
+        fobj.write(b'stale')
+    shmcache.STATE['scanned_at'] = 1e18
+    shmcache.retrieve_snapshot(qeez_token, redis_conn=redis_conn)
+    # NOTE: misses do not scan the directory until it is due
+    assert os.path.exists(stale)
+    assert shmcache.STATE['bytes'] > 0
+
+    shmcache.evict()
+    assert not os.path.exists(stale)
+    assert shmcache.STATE['bytes'] == os.path.getsize(
+        shmcache.snapshot_path(qeez_token, utils.packets_version(qeez_token)))
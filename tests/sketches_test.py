@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.sketches test module
+'''
+
+import sys
+
+import flask
+import pytest
+
+from qeez_stats import sketches
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def enabled():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['SKETCHES']['ENABLED'] = True
+    yield
+    _CFG['SKETCHES']['ENABLED'] = False
+
+
+def test_buckets():
+    from qeez_stats.config import CFG as _CFG
+    cfg = _CFG['SKETCHES']
+    accuracy = cfg['ACCURACY']
+    for value in (0.01, 0.5, 1.0, 3.3, 17.0, 999.0):
+        approx = sketches.bucket_value(sketches.bucket_index(value))
+        assert abs(approx - value) <= accuracy * value + 1e-9
+    assert sketches.bucket_index(0.0) == sketches.bucket_index(
+        cfg['MIN_VALUE'])
+    assert sketches.bucket_index(1e9) == sketches.bucket_index(
+        cfg['MAX_VALUE'])
+
+
+@pytest.mark.parametrize('missing', (False, True))
+def test_update_quantiles(missing, monkeypatch):
+    from qeez_stats import utils
+    monkeypatch.setitem(utils.SCRIPTS_STATE, 'missing', missing)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    tokens = [get_token(), get_token()]
+    for offset, qeez_token in enumerate(tokens):
+        sketches.update(qeez_token, dict(
+            ('1:2:3:4:5:%d:%d:8' % (idx % 2, idx), '1:%d:1' % (
+                idx + offset * 50))
+            for idx in range(1, 51)), redis_conn=redis_conn)
+    total, (median, p90) = sketches.quantiles(
+        sketches.merged(tokens[:1], redis_conn=redis_conn), [0.5, 0.9])
+    assert total == 50
+    assert abs(median - 25) <= 0.5 and abs(p90 - 45) <= 0.5
+    total, (median, ) = sketches.quantiles(
+        sketches.merged(tokens, redis_conn=redis_conn), [0.5])
+    assert total == 100 and abs(median - 50) <= 1
+
+    # NOTE: resent packet moves its count
+    sketches.update(
+        tokens[0], {'1:2:3:4:5:1:1:8': '1:100:1'}, redis_conn=redis_conn)
+    sketches.update(
+        tokens[0], {'1:2:3:4:5:1:1:8': '1:100:1'}, redis_conn=redis_conn)
+    counts = sketches.merged(tokens[:1], redis_conn=redis_conn)
+    assert sum(counts.values()) == 50
+    assert counts[sketches.bucket_index(100)] == 1
+    assert counts.get(sketches.bucket_index(1), 0) == 0
+    assert sum(sketches.merged(
+        tokens[:1], question='4:5:1', redis_conn=redis_conn).values()) == 25
+    assert sketches.quantiles({}, [0.5]) == (0, [None])
+
+
+def test_service_quantiles(enabled):
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    client.put(
+        '/stats/mput/%s' % qeez_token,
+        data=b'[["1:2:3:4:5:6:7:8", "9:10:11"], ["1:2:3:4:5:7:9:8", "9:2:2"]]',
+        content_type='application/json')
+    resp = client.get('/stats/quantiles?token=%s&q=1' % qeez_token)
+    data = flask.json.loads(resp.data)
+    assert data['count'] == 2
+    assert abs(data['result'][0]['ans_time'] - 10) <= 0.1
+    resp = client.get(
+        '/stats/quantiles?token=%s&question=4:5:7' % qeez_token)
+    data = flask.json.loads(resp.data)
+    assert data['count'] == 1
+    assert [_res['q'] for _res in data['result']] == [0.5, 0.9]
+    assert client.get('/stats/quantiles').status_code == 400
+    assert client.get(
+        '/stats/quantiles?token=x&q=2').status_code == 400
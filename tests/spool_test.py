@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.spool test module
+'''
+
+import os
+import sys
+import time
+
+import flask
+import pytest
+
+from qeez_stats import spool
+from qeez_stats.utils import retrieve_packets
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+RES_DC = {'1:2:3:4:5:6:7:8': ('9:10:11', '1:0')}
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+@pytest.fixture
+def spool_cfg(tmpdir):
+    from qeez_stats.config import CFG as _CFG
+    cfg = _CFG['SPOOL']
+    orig = dict(cfg)
+    cfg.update(DIR=str(tmpdir), SEGMENT_SIZE=4096, BATCH=2)
+    yield cfg
+    for _spool in spool.SPOOLS.values():
+        _spool.stop(1)
+        _spool.segment.close()
+    spool.SPOOLS.clear()
+    cfg.clear()
+    cfg.update(orig)
+
+
+def test_segment(spool_cfg, tmpdir):
+    path = str(tmpdir.join('spool-1.seg'))
+    segment = spool.Segment(path)
+    assert segment.is_empty()
+    assert segment.append(('tok', 1, RES_DC, None))
+    assert segment.append(('tok', 2, {}, 'stat'))
+    records, start, offset = segment.pending(10)
+    assert records == [('tok', 1, RES_DC, None), ('tok', 2, {}, 'stat')]
+    assert start == spool.HEADER.size
+    segment.commit(offset)
+    assert segment.is_empty()
+    while segment.append(('tok', 3, RES_DC, None)):
+        pass
+    assert not segment.is_empty()
+    segment.close()
+
+    # NOTE: offsets survive reopening
+    segment = spool.Segment(path)
+    records, _, offset = segment.pending(1000)
+    assert len(records) > 10
+    segment.commit(offset)
+    assert segment.append(('tok', 4, RES_DC, None))
+    segment.close()
+    assert os.path.getsize(path) == 4096
+
+
+def test_segment_ring(spool_cfg, tmpdir):
+    segment = spool.Segment(str(tmpdir.join('spool-2.seg')))
+    assert segment.append(('tok', 0, RES_DC, None))
+    # NOTE: under steady load segment is never empty, space is reused
+    for idx in range(1, 200):
+        assert segment.append(('tok', idx, RES_DC, None))
+        records, _, offset = segment.pending(1)
+        assert records == [('tok', idx - 1, RES_DC, None)]
+        segment.commit(offset)
+    assert not segment.is_empty()
+    assert segment.write_off > segment.capacity
+    while segment.append(('tok', 200, RES_DC, None)):
+        pass
+    records, _, offset = segment.pending(1000)
+    assert records[0] == ('tok', 199, RES_DC, None)
+    assert set(_rec[1] for _rec in records[1:]) == set([200])
+    segment.commit(offset)
+    assert segment.is_empty()
+    segment.close()
+
+
+def test_spool_drain_recover(spool_cfg, tmpdir):
+    orphan = spool.Segment(str(tmpdir.join(spool.SEGMENT_FMT % 99999999)))
+    orphan.append(('orphan', 1, RES_DC, None))
+    orphan.close()
+
+    replayed = []
+    _spool = spool.Spool(replayed.append)
+    for idx in range(5):
+        assert _spool.append('tok', idx, RES_DC)
+    assert _spool.drain_once() == 5
+    assert [len(_batch) for _batch in replayed] == [2, 2, 1]
+    assert _spool.drain_once() == 0
+
+    assert _spool.recover() == 1
+    assert replayed[-1] == [('orphan', 1, RES_DC, None)]
+    assert not tmpdir.join(spool.SEGMENT_FMT % 99999999).check()
+    _spool.segment.close()
+
+
+def test_service_spooled(spool_cfg):
+    from qeez_stats import service
+    spool_cfg['ENABLED'] = True
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    resp = client.put(
+        '/stats/ar_put/%s/%s' % (CFG['STAT_CALC_FN'], qeez_token),
+        data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    data = flask.json.loads(resp.data)
+    assert data['job_id'] == 'stat:%s:%s' % (CFG['STAT_CALC_FN'], qeez_token)
+
+    for _ in range(100):
+        if retrieve_packets(qeez_token):
+            break
+        time.sleep(0.02)
+    assert retrieve_packets(qeez_token) == {b'1:2:3:4:5:6:7:8': b'9:10:11'}
+    for _ in range(100):
+        if get_redis(None).exists('rq:job:%s' % data['job_id']):
+            break
+        time.sleep(0.02)
+    assert get_redis(None).exists('rq:job:%s' % data['job_id'])
+    assert spool.SPOOLS[os.getpid()].segment.is_empty()
+
+
+def test_service_spool_full(spool_cfg, monkeypatch):
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from qeez_stats import dedup, service
+    from qeez_stats.config import CFG as _CFG
+    spool_cfg['ENABLED'] = True
+    monkeypatch.setitem(_CFG['DEDUP'], 'ENABLED', True)
+    monkeypatch.setattr(spool.Spool, 'append', lambda *_, **__: False)
+
+    def _seen(*_):
+        raise RedisConnectionError('down')
+
+    monkeypatch.setattr(dedup, 'seen', _seen)
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    qeez_token = get_token()
+    resp = client.put(
+        '/stats/put/%s' % qeez_token,
+        data=b'["1:2:3:4:5:6:7:8", "9:10:11"]',
+        content_type='application/json')
+    assert resp.status_code == 503
+    assert retrieve_packets(qeez_token) == {}
+
+
+def test_close_spool(spool_cfg, tmpdir):
+    replayed = []
+    _spool = spool.get_spool(replayed.extend)
+    _spool.stop(1)
+    assert _spool.append('tok', 1, RES_DC)
+    assert spool.close_spool(1) == 1
+    assert replayed == [('tok', 1, RES_DC, None)]
+    assert os.getpid() not in spool.SPOOLS
+    assert not os.path.exists(_spool.segment.path)
+    assert spool.close_spool() == 0
+
+
+def test_spool_run_recovers(spool_cfg, tmpdir):
+    spool_cfg.update(RECOVER_INTERVAL=0.0, INTERVAL=0.01)
+    replayed = []
+    _spool = spool.get_spool(replayed.extend)
+    orphan_path = str(tmpdir.join(spool.SEGMENT_FMT % 99999998))
+    # NOTE: segments orphaned after drainer start are recovered too
+    time.sleep(0.05)
+    orphan = spool.Segment(orphan_path)
+    orphan.append(('orphan', 1, RES_DC, None))
+    orphan.close()
+    for _ in range(100):
+        if replayed:
+            break
+        time.sleep(0.02)
+    assert replayed == [('orphan', 1, RES_DC, None)]
+    assert not os.path.exists(orphan_path)
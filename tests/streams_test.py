@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.streams test module
+'''
+
+import sys
+from time import gmtime
+
+from qeez_stats import streams
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+SAVED = []
+
+
+def stat_data_save_recording(qeez_token, atime, res_dc):
+    '''Records save calls
+    '''
+    SAVED.append((qeez_token, atime, res_dc))
+    return True
+
+
+def setup_module(module):
+    from qeez_stats.config import CFG as _CFG
+    module.orig_get_redis = streams.get_redis
+    module.orig_stat_save_fn = _CFG['STAT_SAVE_FN']
+    streams.get_redis = get_redis
+    fake_qeez.stat_data_save_recording = stat_data_save_recording
+    get_redis(None).delete(streams.SAVE_STREAM_ID)
+
+
+def teardown_module(module):
+    from qeez_stats.config import CFG as _CFG
+    streams.get_redis = module.orig_get_redis
+    _CFG['STAT_SAVE_FN'] = module.orig_stat_save_fn
+    del fake_qeez.stat_data_save_recording
+
+
+class _Stream(object):
+    '''Stub save stream redis client (of given group state)
+    '''
+
+    def __init__(self, pending=None, lag=0, undelivered=(), length=0):
+        self.pending = pending or {'pending': 0, 'min': None}
+        self.lag = lag
+        self.undelivered = list(undelivered)
+        self.length = length
+
+    def xinfo_groups(self, _):
+        return [{'name': streams.SAVE_GROUP.encode('utf-8'),
+                 'last-delivered-id': b'1005000-0', 'lag': self.lag}]
+
+    def xpending(self, *_):
+        return self.pending
+
+    def xlen(self, _):
+        return self.length
+
+    def xrange(self, _, min='-', count=None):
+        assert min == '(1005000-0'
+        return self.undelivered[:count]
+
+
+def test_encode_decode_entry():
+    atime = gmtime(1500000000)
+    fields = streams._encode_entry(
+        'tok', {'1:2:3:4:5:6:7:8': ('1:2:3', '1:0'), 'a': 'b'}, atime)
+    fields = dict(
+        (key.encode('utf-8'), str(val).encode('utf-8'))
+        for key, val in fields.items())
+    assert streams._decode_entry(fields) == (
+        'tok', atime, {'1:2:3:4:5:6:7:8': ('1:2:3', '1:0'), 'a': 'b'})
+
+
+def test_run_save_worker():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['STAT_SAVE_FN'] = 'qeez.api.models.stat_data_save_recording'
+    del SAVED[:]
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    assert streams.ensure_group(redis_conn) is True
+    assert streams.ensure_group(redis_conn) is False
+
+    tokens = [get_token() for _ in range(5)]
+    for qeez_token in tokens:
+        assert streams.stream_stat_save(
+            qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'})
+    assert streams.run_save_worker('c1', burst=True, count=2) == 5
+    assert [item[0] for item in SAVED] == tokens
+    assert redis_conn.xpending(
+        streams.SAVE_STREAM_ID, streams.SAVE_GROUP)['pending'] == 0
+
+
+def test_claim_pending():
+    from qeez_stats.config import CFG as _CFG
+    _CFG['STAT_SAVE_FN'] = 'qeez.api.models.stat_data_save_failing'
+    del SAVED[:]
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    streams.ensure_group(redis_conn)
+    qeez_token = get_token()
+    streams.stream_stat_save(
+        qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'}, redis_conn=redis_conn)
+
+    assert streams.consume_stat_saves(
+        'c1', block=None, claim=False) == 1
+    assert redis_conn.xpending(
+        streams.SAVE_STREAM_ID, streams.SAVE_GROUP)['pending'] == 1
+
+    _CFG['STAT_SAVE_FN'] = 'qeez.api.models.stat_data_save_recording'
+    entries = streams.claim_pending('c2', redis_conn, min_idle=0)
+    assert len(entries) == 1
+    assert streams.process_entries(entries, redis_conn) == (1, 0)
+    assert SAVED[0][0] == qeez_token
+    assert redis_conn.xpending(
+        streams.SAVE_STREAM_ID, streams.SAVE_GROUP)['pending'] == 0
+
+
+def test_stream_backlog():
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    redis_conn.delete(streams.SAVE_STREAM_ID)
+    assert streams.stream_backlog(redis_conn) == (0, 0.0)
+    for _ in range(2):
+        streams.stream_stat_save(
+            get_token(), {'1:2:3:4:5:6:7:8': '1:2:3'}, atime=gmtime(),
+            redis_conn=redis_conn)
+    length, age = streams.stream_backlog(redis_conn)
+    assert length == 2
+    assert 0.0 <= age < 60
+
+    streams.ensure_group(redis_conn)
+    redis_conn.xreadgroup(
+        streams.SAVE_GROUP, 'c1', {streams.SAVE_STREAM_ID: '>'})
+    redis_conn.xack(
+        streams.SAVE_STREAM_ID, streams.SAVE_GROUP,
+        *[_id for _id, _ in redis_conn.xrange(streams.SAVE_STREAM_ID)])
+    assert streams.stream_backlog(redis_conn) == (0, 0.0)
+
+    # NOTE: pending (oldest one's age) and not delivered entries count
+    stream = _Stream(
+        pending={'pending': 3, 'min': b'1000000-0'}, lag=5,
+        undelivered=[(b'1010000-0', {})])
+    assert streams.stream_backlog(stream, now=1030.0) == (8, 30.0)
+    stream = _Stream(lag=5, undelivered=[(b'1010000-0', {})])
+    assert streams.stream_backlog(stream, now=1030.0) == (5, 20.0)
+    stream = _Stream(lag=None, undelivered=[(b'1010000-0', {})], length=9)
+    assert streams.stream_backlog(stream, now=1030.0) == (9, 20.0)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.supervisor test module
+'''
+
+import sys
+import time
+
+import flask
+
+from qeez_stats import metrics, supervisor
+from qeez_stats.queues import enqueue_stat_save
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+POOL = {
+    'QUEUES': ('save',),
+    'REDIS': 'SAVE_REDIS',
+    'WORKER_CLASS': 'rq.worker.Worker',
+    'MIN': 1,
+    'MAX': 3,
+    'UP_LEN': 2,
+    'UP_AGE': 0,
+    'UP_CHECKS': 2,
+    'DOWN_LEN': 0,
+    'DOWN_AGE': 1.0,
+    'DOWN_CHECKS': 3,
+}
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_get_redis = utils.get_redis
+    utils.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    utils.get_redis = module.orig_get_redis
+
+
+class _Proc(object):
+    '''Stub worker process
+    '''
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+
+def test_scaler():
+    scaler = supervisor.Scaler(POOL)
+    assert scaler.decide(0, 0.0, 0) == supervisor.UP
+    assert scaler.decide(0, 0.0, 4) == supervisor.DOWN
+    assert scaler.decide(5, 0.0, 1) == supervisor.HOLD
+    assert scaler.decide(1, 0.0, 1) == supervisor.HOLD
+    assert scaler.decide(5, 0.0, 1) == supervisor.HOLD
+    assert scaler.decide(5, 0.0, 1) == supervisor.UP
+    assert scaler.decide(5, 0.0, 3) == supervisor.HOLD
+    assert scaler.decide(5, 0.0, 3) == supervisor.HOLD
+    for _ in range(2):
+        assert scaler.decide(0, 0.0, 3) == supervisor.HOLD
+    assert scaler.decide(0, 0.0, 3) == supervisor.DOWN
+    assert scaler.decide(0, 0.0, 1) == supervisor.HOLD
+
+
+def test_supervisor_tick():
+    redis_conn = get_redis(CFG['SAVE_REDIS'])
+    redis_conn.delete('rq:queue:save')
+    procs = []
+
+    def _spawn(name, cfg):
+        assert (name, cfg) == ('save', POOL)
+        procs.append(_Proc(len(procs) + 1))
+        return procs[-1]
+
+    sup = supervisor.Supervisor(
+        pools={'save': POOL}, redis_conn=redis_conn, spawn=_spawn)
+    sup.tick()
+    assert [_proc.pid for _proc in sup.procs['save']] == [1]
+
+    for _ in range(3):
+        enqueue_stat_save(get_token(), {}, redis_conn=redis_conn)
+    sup.tick()
+    sup.tick()
+    assert len(sup.procs['save']) == 2
+    assert metrics.snapshot()['gauges']['supervisor.save.length'] == 3
+
+    procs[0].returncode = 1
+    sup.tick()
+    assert [_proc.pid for _proc in sup.procs['save']] == [2]
+
+    sup.tick()
+    assert [_proc.pid for _proc in sup.procs['save']] == [2, 3]
+    redis_conn.delete('rq:queue:save')
+    for _ in range(3):
+        sup.tick()
+    assert [_proc.pid for _proc in sup.procs['save']] == [2]
+    assert procs[2].returncode == -15
+    assert sup.draining['save'] == [procs[2]]
+    assert sup.state()['save']['draining'] == 1
+    sup.tick()
+    assert sup.draining['save'] == []
+    counters = metrics.snapshot()['counters']
+    assert counters['supervisor.save.down'] >= 1
+    assert counters['supervisor.save.exited'] >= 1
+
+    sup.publish()
+    states = supervisor.supervisors_state(redis_conn)
+    assert states[supervisor.supervisor_id()]['pools']['save'][
+        'workers'] == 1
+    sup.stop()
+    assert procs[1].returncode == -15
+    assert sup.procs['save'] == []
+    assert supervisor.supervisor_id() not in supervisor.supervisors_state(
+        redis_conn)
+
+
+def test_supervisors_state_prune():
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    redis_conn.delete(supervisor.REGISTRY_ID)
+    redis_conn.zadd(supervisor.REGISTRY_ID, {'old:1': 100.0, 'new:2': 200.0})
+    redis_conn.set(supervisor.STATE_ID_FMT % 'old:1', '{"pools": {}}')
+    assert supervisor.supervisors_state(redis_conn, now=110.0) == {
+        'old:1': {'pools': {}}}
+    assert supervisor.supervisors_state(
+        redis_conn, now=100.0 + supervisor.state_ttl() + 1) == {}
+    assert [_member for _member in redis_conn.zrange(
+        supervisor.REGISTRY_ID, 0, -1)] == [b'new:2']
+    redis_conn.delete(supervisor.REGISTRY_ID, supervisor.STATE_ID_FMT % 'old:1')
+
+
+def test_supervisor_processes():
+    pool = dict(POOL, COMMAND=[sys.executable, '-c', 'import time; '
+                               'time.sleep(30)'])
+    sup = supervisor.Supervisor(
+        pools={'save': pool}, redis_conn=get_redis(CFG['SAVE_REDIS']))
+    sup.tick()
+    proc = sup.procs['save'][0]
+    assert proc.poll() is None
+
+    # NOTE: retired worker is reaped (not left a zombie)
+    sup.scale('save', supervisor.DOWN)
+    assert sup.draining['save'] == [proc]
+    for _ in range(100):
+        sup.reap('save')
+        if not sup.draining['save']:
+            break
+        time.sleep(0.05)
+    assert sup.draining['save'] == []
+    assert proc.returncode is not None
+
+    sup.tick()
+    proc = sup.procs['save'][0]
+    sup.stop(5)
+    assert proc.poll() is not None
+
+
+def test_worker_command():
+    cmd = supervisor.worker_command(dict(POOL, REDIS='QUEUE_REDIS'))
+    assert cmd[:2] == ['rq', 'worker']
+    assert cmd[-1] == 'save'
+    assert '--job-class' in cmd
+
+
+def test_service_supervisors():
+    from qeez_stats import service
+    service.APP.config['TESTING'] = True
+    client = service.APP.test_client()
+    resp = client.get('/stats/supervisors')
+    data = flask.json.loads(resp.data)
+    assert data['error'] is False
+    assert isinstance(data['supervisors'], dict)
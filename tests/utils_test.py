@@ -110,6 +110,37 @@ def test_decode_raw_packets():
         assert dec_packet in utils.decode_raw_packets(raw_packets)
 
 
+def test_decode_raw_packet_compact():
+    assert utils.decode_raw_packet([b'', b''], compact=True) is None
+    packet = utils.decode_raw_packet(
+        [b'1:2:3:4:5:6:7:8', b'2,3:6.5:4', b'-1:1'], compact=True)
+    assert isinstance(packet, utils.Packet)
+    assert packet.key == (1, 2, 3, 4, 5, 6, 7, 8)
+    assert (packet.grp_id, packet.gmr_id, packet.tm_id) == (1, 7, 8)
+    assert packet.answers == (2, 3)
+    assert packet.ans_time == 6.5
+    assert packet.points == 4
+    assert packet.rst == (-1, 1)
+    assert packet.as_tuple() == \
+        ((1, 2, 3, 4, 5, 6, 7, 8), ([2, 3], 6.5, 4), (-1, 1))
+    assert not hasattr(packet, '__dict__')
+    with pytest.raises(AttributeError):
+        packet.foo = 1
+
+
+def test_iter_decode_raw_packets():
+    raw_packets = {
+        b'8:7:6:5:4:3:2:1': b'2,3,1:6.5:4',
+        b'1:2:3:4:5:6:7:8': b'1:2:3'}
+    packets = utils.iter_decode_raw_packets(raw_packets, compact=True)
+    assert not isinstance(packets, list)
+    packets = sorted(packets, key=lambda packet: packet.key)
+    assert [packet.as_tuple() for packet in packets] == [
+        ((1, 2, 3, 4, 5, 6, 7, 8), ([1], 2.0, 3), (1, 0)),
+        ((8, 7, 6, 5, 4, 3, 2, 1), ([2, 3, 1], 6.5, 4), (1, 0))]
+    assert utils.decode_raw_packets(raw_packets, compact=True)[0] in packets
+
+
 def test_save_packets_to_stat():
     res_dcs = [
         {'': '', 'a': 'b'},
@@ -163,3 +194,197 @@ def test_retrieve_set():
                 utils.retrieve_set(stat_id, redis_conn)
         except Exception as exc:
             assert exc is None
+
+
+def test_ingest_packets():
+    _qeez_token = get_token()
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    assert utils.packets_version(_qeez_token) == 0
+    assert utils.ingest_packets(_qeez_token, {
+        '1:2:3:4:5:6:7:8': ('1:2:3', '-1:1')}) == 1
+    assert utils.ingest_packets(
+        _qeez_token, {'1:2:3:4:5:6:7:9': '1:2:3'}, redis_conn) == 2
+    assert utils.packets_version(_qeez_token, redis_conn) == 2
+    assert utils.retrieve_packets(_qeez_token) == {
+        b'1:2:3:4:5:6:7:8': b'1:2:3', b'1:2:3:4:5:6:7:9': b'1:2:3'}
+    assert 0 < redis_conn.ttl(utils.PACKETS_ID_FMT % _qeez_token) <= \
+        utils.PACKET_EXPIRE
+    assert redis_conn.lrange(utils.PACKETS_CHG_FMT % _qeez_token, 0, -1) == [
+        b'1:2:3:4:5:6:7:8', b'1:2:3:4:5:6:7:9']
+
+    # NOTE: identical packets do not bump version
+    assert utils.ingest_packets(
+        _qeez_token, {'1:2:3:4:5:6:7:9': '1:2:3'}, redis_conn) == 2
+    assert utils.ingest_packets(_qeez_token, {
+        '1:2:3:4:5:6:7:8': '1:2:3', '1:2:3:4:5:6:7:9': '2:2:3'},
+        redis_conn) == 3
+    assert redis_conn.lrange(
+        utils.PACKETS_CHG_FMT % _qeez_token, -1, -1) == [b'1:2:3:4:5:6:7:9']
+
+
+def test_retrieve_decoded_packets():
+    _qeez_token = get_token()
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    key = utils.PACKETS_ID_FMT % _qeez_token
+    utils.ingest_packets(_qeez_token, {
+        '1:2:3:4:5:6:7:8': '1:2:3', '1:2:3:4:5:6:7:9': '2:2:3'}, redis_conn)
+    res = utils.retrieve_decoded_packets(_qeez_token, redis_conn=redis_conn)
+    assert sorted(res) == sorted(utils.decode_raw_packets(
+        utils.retrieve_packets(_qeez_token, redis_conn)))
+    assert utils.PACKET_CACHE[_qeez_token][0] == 1
+
+    # NOTE: not logged change is not fetched, logged ones are
+    redis_conn.hset(key, '1:2:3:4:5:6:7:7', '7:2:3')
+    utils.ingest_packets(_qeez_token, {
+        '1:2:3:4:5:6:7:9': '3:2:3', '1:2:3:4:5:6:7:10': 'x:2:3'}, redis_conn)
+    res = utils.retrieve_decoded_packets(
+        _qeez_token, compact=True, redis_conn=redis_conn)
+    assert sorted(
+        (_pkt.tm_id, _pkt.answers) for _pkt in res if _pkt) == [
+            (8, (1,)), (9, (3,)), (10, ())]
+    assert utils.PACKET_CACHE[_qeez_token][0] == 2
+
+    # NOTE: change log gap makes full reload
+    redis_conn.delete(utils.PACKETS_CHG_FMT % _qeez_token)
+    utils.ingest_packets(_qeez_token, {'1:2:3:4:5:6:7:8': '4:2:3'}, redis_conn)
+    res = utils.retrieve_decoded_packets(_qeez_token, redis_conn=redis_conn)
+    assert sorted(res) == sorted(utils.decode_raw_packets(
+        utils.retrieve_packets(_qeez_token, redis_conn)))
+    assert len(res) == 4
+
+
+def test_load_scripts(monkeypatch):
+    pytest.importorskip('lupa')
+    monkeypatch.setitem(utils.SCRIPTS_STATE, 'missing', False)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    shas = utils.load_scripts(redis_conn)
+    assert set(shas) == set(utils.SCRIPT_SOURCES)
+    assert 'ingest' in shas
+    assert redis_conn.script_exists(*shas.values()) == [True] * len(shas)
+    assert utils.scripts_enabled()
+
+
+def test_load_scripts_missing(monkeypatch):
+    from redis.exceptions import ResponseError
+    from qeez_stats.config import CFG as _CFG
+    monkeypatch.setitem(utils.SCRIPTS_STATE, 'missing', False)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+
+    def _script_load(_):
+        raise ResponseError("unknown command 'SCRIPT'")
+
+    monkeypatch.setattr(redis_conn, 'script_load', _script_load)
+    assert utils.load_scripts(redis_conn) is None
+    assert _CFG['STAT_INGEST_LUA'] is True
+    assert not utils.scripts_enabled()
+    # NOTE: ingest falls back to pipeline
+    _qeez_token = get_token()
+    assert utils.ingest_packets(
+        _qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'}, redis_conn) == 1
+    assert utils.ingest_packets(
+        _qeez_token, {'1:2:3:4:5:6:7:8': '1:2:3'}, redis_conn) == 1
+    assert utils.ingest_packets(
+        _qeez_token, {'1:2:3:4:5:6:7:8': '2:2:3'}, redis_conn) == 2
+
+
+def test_watch_transaction(monkeypatch):
+    monkeypatch.setattr(utils, 'WATCH_BACKOFF', 0.0)
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    key = '_watch:%s' % get_token()
+    seen = []
+
+    def _func(pipe):
+        seen.append(int(pipe.get(key) or 0))
+        if len(seen) < 3:
+            # NOTE: concurrent write, transaction is retried
+            redis_conn.incr(key)
+        pipe.multi()
+        pipe.incr(key)
+
+    assert utils.watch_transaction(redis_conn, _func, key) == [3]
+    assert seen == [0, 1, 2]
+
+
+class _Replica(object):
+    '''Stub replica client
+    '''
+
+    def __init__(self, info):
+        self._info = info
+
+    def info(self, _):
+        if self._info is None:
+            raise utils.RedisError('down')
+        return self._info
+
+
+def test_replica_healthy():
+    info = {
+        'role': 'slave', 'master_link_status': 'up',
+        'master_last_io_seconds_ago': 1}
+    assert utils.replica_healthy(_Replica(info), 5)
+    assert not utils.replica_healthy(_Replica(info), 0)
+    assert not utils.replica_healthy(_Replica(None), 5)
+    assert not utils.replica_healthy(
+        _Replica(dict(info, master_link_status='down')), 5)
+    assert not utils.replica_healthy(_Replica(dict(info, role='master')), 5)
+
+
+def test_get_read_redis(monkeypatch):
+    from qeez_stats.config import CFG as _CFG
+    info = {
+        'role': 'slave', 'master_link_status': 'up',
+        'master_last_io_seconds_ago': 0}
+    conns = {
+        'primary': get_redis(None), 'r0': _Replica(info),
+        'r1': _Replica(None)}
+    monkeypatch.setattr(utils, 'get_redis', lambda cfg: conns[cfg['NAME']])
+    monkeypatch.setitem(_CFG, 'STAT_REDIS', {'NAME': 'primary'})
+    monkeypatch.setitem(_CFG, 'QUEUE_REDIS', {'NAME': 'primary'})
+    monkeypatch.setitem(_CFG, 'REPLICAS', {
+        'STAT_REDIS': [{'NAME': 'r0'}, {'NAME': 'r1'}]})
+    utils.reset_redis_conns()
+    try:
+        assert utils.get_read_redis('QUEUE_REDIS', now=0) is \
+            utils.get_read_redis('QUEUE_REDIS', now=0)
+        assert [
+            utils.get_read_redis('STAT_REDIS', now=0)
+            for _ in range(4)] == [conns['r0']] * 4
+        conns['r0']._info = None
+        assert utils.get_read_redis('STAT_REDIS', now=1) is conns['r0']
+        assert utils.get_read_redis(
+            'STAT_REDIS', now=10) is conns['primary']
+
+        # NOTE: memoized calculations read packets from the primary only
+        conns['r0']._info = info
+        utils.REPLICA_STATE.clear()
+        monkeypatch.setitem(_CFG, 'CALC_MEMOIZE', False)
+        assert utils.get_packets_redis() is conns['r0']
+        monkeypatch.setitem(_CFG, 'CALC_MEMOIZE', True)
+        assert utils.get_packets_redis() is conns['primary']
+    finally:
+        utils.REDIS_CONNS.clear()
+        utils.REPLICA_STATE.clear()
+
+
+def test_ingest_packets_batch():
+    tokens = [get_token() for _ in range(2)]
+    redis_conn = get_redis(CFG['STAT_REDIS'])
+    utils.ingest_packets(tokens[0], {'1:2:3:4:5:6:7:8': '1:2:3'}, redis_conn)
+    assert utils.ingest_packets_batch([
+        (tokens[0], {'1:2:3:4:5:6:7:9': ('1:2:3', '1:0')}),
+        (tokens[1], {'1:2:3:4:5:6:7:8': '1:2:3'}),
+    ], redis_conn) == [2, 1]
+    assert utils.retrieve_packets(tokens[0], redis_conn) == {
+        b'1:2:3:4:5:6:7:8': b'1:2:3', b'1:2:3:4:5:6:7:9': b'1:2:3'}
+
+    # NOTE: replayed (unchanged) packets keep versions, repeated tokens
+    # are ingested in order
+    assert utils.ingest_packets_batch([
+        (tokens[1], {'1:2:3:4:5:6:7:8': '1:2:3'}),
+        (tokens[0], {'1:2:3:4:5:6:7:9': '2:2:3'}),
+        (tokens[0], {'1:2:3:4:5:6:7:9': '2:2:3'}),
+        (tokens[0], {'1:2:3:4:5:6:7:8': '3:2:3'}),
+    ], redis_conn) == [1, 3, 3, 4]
+    assert utils.retrieve_packets(tokens[0], redis_conn) == {
+        b'1:2:3:4:5:6:7:8': b'3:2:3', b'1:2:3:4:5:6:7:9': b'2:2:3'}
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+'''qeez_stat.workers test module
+'''
+
+import sys
+
+from rq.queue import Queue
+
+from qeez_stats import queues, workers
+
+from . import fake_qeez
+from .config import CFG
+from .commons import get_redis, get_token
+
+
+sys.modules['qeez'] = fake_qeez
+sys.modules['qeez.api'] = fake_qeez
+sys.modules['qeez.api.models'] = fake_qeez
+
+
+def setup_module(module):
+    from qeez_stats import utils
+    module.orig_q_get_redis = queues.get_redis
+    module.orig_u_get_redis = utils.get_redis
+    utils.get_redis = queues.get_redis = get_redis
+
+
+def teardown_module(module):
+    from qeez_stats import utils
+    queues.get_redis = module.orig_q_get_redis
+    utils.get_redis = module.orig_u_get_redis
+
+
+def test_weighted_order():
+    order = workers.WeightedOrder({'calc': 3, 'calc_bulk': 1})
+    firsts = [
+        order.next_order(['calc', 'calc_bulk'])[0] for _ in range(8)]
+    assert firsts.count('calc') == 6
+    assert firsts.count('calc_bulk') == 2
+    assert order.next_order(['calc_bulk', 'other']) == ['calc_bulk', 'other']
+
+
+def test_weighted_worker():
+    redis_conn = get_redis(CFG['QUEUE_REDIS'])
+    stat_id = CFG['STAT_CALC_FN']
+    tokens = [get_token() for _ in range(2)]
+    queues.enqueue_stat_calc(stat_id, tokens[0], lane=queues.LANE_BULK)
+    queues.enqueue_stat_calc(stat_id, tokens[1])
+    lanes = [
+        Queue(name, connection=redis_conn)
+        for name in ('calc', 'calc_bulk')]
+    worker = workers.WeightedSimpleWorker(lanes, connection=redis_conn)
+    worker.work(burst=True)
+    for qeez_token in tokens:
+        assert queues.pull_stat_res(stat_id, qeez_token) == 123.1